@@ -1,21 +1,19 @@
 import datetime
+import time
 import traceback
 import warnings
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
-from django.contrib.auth.models import User
-from django.core.mail import EmailMultiAlternatives
 from django.db.models import Q
-from django.http import QueryDict
-from django.template import loader
 from django.utils.timezone import now
 
 from cl.alerts.models import Alert, RealTimeQueue
-from cl.lib import search_utils
+from cl.alerts.utils import group_alerts, make_alert_search_params, send_hits
 from cl.lib.command_utils import VerboseCommand, logger
-from cl.lib.scorched_utils import ExtraSolrInterface
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.search_utils import regroup_snippets
-from cl.search.forms import SearchForm
 from cl.stats.utils import tally_stat
 
 # Only do this number of RT items at a time. If there are more, they will be
@@ -23,50 +21,6 @@ from cl.stats.utils import tally_stat
 MAX_RT_ITEM_QUERY = 1000
 
 
-class InvalidDateError(Exception):
-    pass
-
-
-def get_cut_off_date(rate, d=datetime.date.today()):
-    """Given a rate of dly, wly or mly and a date, returns the date after which
-    new results should be considered a hit for an cl.
-    """
-    cut_off_date = None
-    if rate == Alert.REAL_TIME:
-        # use a couple days ago to limit results without risk of leaving out
-        # important items (this will be filtered further later).
-        cut_off_date = d - datetime.timedelta(days=10)
-    elif rate == Alert.DAILY:
-        cut_off_date = d
-    elif rate == Alert.WEEKLY:
-        cut_off_date = d - datetime.timedelta(days=7)
-    elif rate == Alert.MONTHLY:
-        if datetime.date.today().day > 28:
-            raise InvalidDateError('Monthly alerts cannot be run on the 29th, '
-                                   '30th or 31st.')
-
-        # Get the first of the month of the previous month regardless of the
-        # current date
-        early_last_month = d - datetime.timedelta(days=28)
-        cut_off_date = datetime.datetime(early_last_month.year,
-                                         early_last_month.month, 1)
-    return cut_off_date
-
-
-def send_alert(user_profile, hits):
-    subject = 'New hits for your alerts'
-
-    txt_template = loader.get_template('alert_email.txt')
-    html_template = loader.get_template('alert_email.html')
-    context = {'hits': hits}
-    txt = txt_template.render(context)
-    html = html_template.render(context)
-    msg = EmailMultiAlternatives(subject, txt, settings.DEFAULT_ALERTS_EMAIL,
-                                 [user_profile.user.email])
-    msg.attach_alternative(html, "text/html")
-    msg.send(fail_silently=False)
-
-
 class Command(VerboseCommand):
     help = 'Sends the alert emails on a real time, daily, weekly or monthly ' \
            'basis.'
@@ -74,9 +28,9 @@ class Command(VerboseCommand):
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
         self.connections = {
-            'o': ExtraSolrInterface(settings.SOLR_OPINION_URL, mode='r'),
-            'oa': ExtraSolrInterface(settings.SOLR_AUDIO_URL, mode='r'),
-            'r': ExtraSolrInterface(settings.SOLR_RECAP_URL, mode='r'),
+            'o': get_solr_interface(settings.SOLR_OPINION_URL, mode='r'),
+            'oa': get_solr_interface(settings.SOLR_AUDIO_URL, mode='r'),
+            'r': get_solr_interface(settings.SOLR_RECAP_URL, mode='r'),
         }
         self.options = {}
         self.valid_ids = {}
@@ -89,6 +43,12 @@ class Command(VerboseCommand):
             help="The rate to send emails (%s)" %
                  ', '.join(Alert.ALL_FREQUENCIES),
         )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=4,
+            help="The number of searches to run at once.",
+        )
 
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
@@ -101,104 +61,117 @@ class Command(VerboseCommand):
         if options['rate'] == Alert.REAL_TIME:
             self.clean_rt_queue()
 
-    def run_query(self, alert, rate):
-        results = []
-        cd = {}
-        logger.info("Now running the query: %s\n" % alert.query)
-
-        # Make a dict from the query string.
-        qd = QueryDict(alert.query.encode('utf-8'), mutable=True)
-        try:
-            del qd['filed_before']
-        except KeyError:
-            pass
-        qd['order_by'] = 'score desc'
-        cut_off_date = get_cut_off_date(rate)
-        # Default to 'o', if not available, according to the front end.
-        query_type = qd.get('type', 'o')
-        if query_type in ['o', 'r']:
-            qd['filed_after'] = cut_off_date
-        elif query_type == 'oa':
-            qd['argued_after'] = cut_off_date
-        logger.info("Data sent to SearchForm is: %s\n" % qd)
-        search_form = SearchForm(qd)
-        if search_form.is_valid():
-            cd = search_form.cleaned_data
-
-            if rate == Alert.REAL_TIME and \
-                    len(self.valid_ids[query_type]) == 0:
-                # Bail out. No results will be found if no valid_ids.
-                return query_type, results
-
-            main_params = search_utils.build_main_query(cd, facet=False)
-            main_params.update({
-                'rows': '20',
-                'start': '0',
-                'hl.tag.pre': '<em><strong>',
-                'hl.tag.post': '</strong></em>',
-                'caller': 'cl_send_alerts:%s' % query_type,
-            })
-
-            if rate == Alert.REAL_TIME:
-                main_params['fq'].append('id:(%s)' % ' OR '.join(
-                    [str(i) for i in self.valid_ids[query_type]]
-                ))
+    def make_search_params(self, query_type, cd, rate):
+        """Make the Solr parameters for an alert's search.
 
-            # Ignore warnings from this bit of code. Otherwise, it complains
-            # about the query URL being too long and having to POST it instead
-            # of being able to GET it.
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                results = self.connections[query_type].query().add_extra(
-                    **main_params).execute()
-            regroup_snippets(results)
-
-        logger.info("There were %s results." % len(results))
-        return qd, results
+        :return: The parameters, or None if the search can't have any
+        results.
+        """
+        if rate == Alert.REAL_TIME and len(self.valid_ids[query_type]) == 0:
+            # No results will be found if no valid_ids.
+            return None
+
+        main_params = make_alert_search_params(query_type, cd)
+        if rate == Alert.REAL_TIME:
+            main_params['fq'].append('id:(%s)' % ' OR '.join(
+                [str(i) for i in self.valid_ids[query_type]]
+            ))
+        return main_params
+
+    def run_search(self, query_type, main_params):
+        results = self.connections[query_type].query().add_extra(
+            **main_params).execute()
+        regroup_snippets(results)
+        return results
+
+    def run_searches(self, groups, rate):
+        """Run the distinct searches of a rate concurrently.
+
+        The searches run on a pool of self.options['threads'] threads, which
+        share the Solr clients, and so their connections.
+
+        :param groups: The distinct searches, from group_alerts.
+        :param rate: The rate being run.
+        :return: A dict mapping the key of each search to its results, or to
+        None if the search failed.
+        """
+        results = {}
+        pool = ThreadPool(self.options['threads'])
+        async_results = OrderedDict()
+        # Ignore warnings from this bit of code. Otherwise, it complains
+        # about the query URL being too long and having to POST it instead
+        # of being able to GET it.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for key, group in groups.items():
+                main_params = self.make_search_params(group['type'],
+                                                      group['cd'], rate)
+                if main_params is None:
+                    results[key] = []
+                    continue
+                async_results[key] = pool.apply_async(
+                    self.run_search, (group['type'], main_params))
+            pool.close()
+            pool.join()
+
+        for key, async_result in async_results.items():
+            try:
+                results[key] = async_result.get()
+            except Exception:
+                traceback.print_exc()
+                logger.info("Search for these alerts failed: %s\n" %
+                            [a.query for a, _ in groups[key]['alerts']])
+                results[key] = None
+            else:
+                logger.info("There were %s results for %s alerts." % (
+                    len(results[key]), len(groups[key]['alerts'])))
+        return results
 
     def send_emails(self, rate):
         """Send out an email to every user whose alert has a new hit for a
         rate.
-        """
-        users = User.objects.filter(alerts__rate=rate).distinct()
 
-        alerts_sent_count = 0
-        for user in users:
-            alerts = user.alerts.filter(rate=rate)
-            logger.info("Running alerts for user '%s': %s" % (user, alerts))
-
-            not_donated_enough = user.profile.total_donated_last_year < \
-                settings.MIN_DONATION['rt_alerts']
-            if not_donated_enough and rate == Alert.REAL_TIME:
-                logger.info('User: %s has not donated enough for their %s '
-                            'RT alerts to be sent.\n' % (user, alerts.count()))
-                continue
-
-            hits = []
+        Alerts that would run the same search are grouped, each distinct
+        search is run once, and the results are fanned back out to the alerts
+        that share them.
+        """
+        t1 = time.time()
+        alerts = Alert.objects.filter(rate=rate).select_related(
+            'user__profile',
+        ).order_by('user_id', 'query', 'pk')
+        if rate == Alert.REAL_TIME:
+            allowed = {}
             for alert in alerts:
-                try:
-                    qd, results = self.run_query(alert, rate)
-                except:
-                    traceback.print_exc()
-                    logger.info("Search for this alert failed: %s\n" %
-                                alert.query)
-                    continue
-
-                # hits is a multi-dimensional array. It consists of alerts,
-                # paired with a list of document dicts, of the form:
-                # [[alert1, [{hit1}, {hit2}, {hit3}]], [alert2, ...]]
-                if len(results) > 0:
-                    hits.append([alert, qd.get('type', 'o'), results])
-                    alert.query_run = qd.urlencode()
-                    alert.date_last_hit = now()
-                    alert.save()
-
-            if len(hits) > 0:
-                alerts_sent_count += 1
-                send_alert(user.profile, hits)
+                user = alert.user
+                if user.pk not in allowed:
+                    donated = user.profile.total_donated_last_year
+                    allowed[user.pk] = \
+                        donated >= settings.MIN_DONATION['rt_alerts']
+                    if not allowed[user.pk]:
+                        logger.info('User: %s has not donated enough for '
+                                    'their RT alerts to be sent.\n' % user)
+            alerts = [a for a in alerts if allowed[a.user_id]]
+        else:
+            alerts = list(alerts)
+
+        groups, invalid = group_alerts(alerts, rate)
+        for alert in invalid:
+            logger.info("Query for this alert is invalid: %s\n" % alert.query)
+        logger.info("Grouped %s %s alerts into %s distinct searches." % (
+            len(alerts), rate, len(groups)))
+        t2 = time.time()
+
+        results = self.run_searches(groups, rate)
+        t3 = time.time()
+
+        alerts_sent_count = send_hits(alerts, groups, results)
+        t4 = time.time()
 
         tally_stat('alerts.sent.%s' % rate, inc=alerts_sent_count)
         logger.info("Sent %s %s email alerts." % (alerts_sent_count, rate))
+        logger.info("Timings for %s alerts: %.2fs grouping, %.2fs searching, "
+                    "%.2fs sending, %.2fs total." % (
+                        rate, t2 - t1, t3 - t2, t4 - t3, t4 - t1))
 
     def clean_rt_queue(self):
         """Clean out any items in the RealTime queue once they've been run or
@@ -1,9 +1,16 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.crypto import get_random_string
 
+from cl.lib.redis_utils import make_redis_interface
 from cl.search.models import Docket
 
+# A counter that goes up whenever an alert changes. The percolator compiles
+# the real-time alerts again when it does.
+ALERTS_VERSION_KEY = 'alerts.version'
+
 
 class Alert(models.Model):
     REAL_TIME = 'rt'
@@ -74,6 +81,15 @@ class Alert(models.Model):
         super(Alert, self).save(*args, **kwargs)
 
 
+@receiver(post_save, sender=Alert)
+@receiver(post_delete, sender=Alert)
+def bump_alerts_version(sender, instance=None, **kwargs):
+    # Wait for the commit, or the alerts could be compiled again before the
+    # change can be seen.
+    transaction.on_commit(
+        lambda: make_redis_interface('ALERTS').incr(ALERTS_VERSION_KEY))
+
+
 class DocketAlert(models.Model):
     date_created = models.DateTimeField(
         help_text="The time when this item was created",
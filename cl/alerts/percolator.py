@@ -0,0 +1,158 @@
+"""Percolation of real-time alerts.
+
+cl_send_alerts runs real-time alerts by polling: every few minutes, each
+alert is run against the whole index, limited to the items in the
+RealTimeQueue. That costs a search per alert, no matter how few new items
+there are, and the filter for the new items can grow past Solr's limit on
+boolean clauses.
+
+Percolation turns that around. As each batch of new items is indexed, the
+batch is loaded into a small stand-in core that has the same schema as the
+real one, and every real-time alert is run against it. Since the stand-in
+core only ever holds a batch, the searches are cheap, and alerts are sent
+seconds after their hits are indexed. The searches of the alerts are compiled
+once, and kept until the alerts change or the day rolls over.
+
+Items that are percolated are taken out of the RealTimeQueue, so
+cl_send_alerts won't send them again. Anything that isn't percolated is left
+for it.
+"""
+import datetime
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+from cl.alerts.models import ALERTS_VERSION_KEY, Alert, RealTimeQueue
+from cl.alerts.utils import group_alerts, make_alert_search_params
+from cl.lib.redis_utils import make_redis_interface
+from cl.lib.scorched_utils import get_solr_interface
+from cl.lib.search_utils import regroup_snippets
+
+# The types of items that real-time alerts are run for, by app label.
+PERCOLATOR_ITEM_TYPES = {
+    'search.Opinion': RealTimeQueue.OPINION,
+    'audio.Audio': RealTimeQueue.ORAL_ARGUMENT,
+}
+
+PERCOLATOR_LOCK_KEY = 'alerts.percolator.lock:%s'
+
+# The compiled alerts of each item type, kept between batches.
+_compiled_alerts = {}
+
+
+def get_alerts_version():
+    """Get something that changes whenever the alerts change, or the day
+    does, since the searches of alerts depend on the date.
+    """
+    r = make_redis_interface('ALERTS')
+    return datetime.date.today(), r.get(ALERTS_VERSION_KEY)
+
+
+def compile_alerts(item_type):
+    """Compile the real-time alerts of an item type into searches.
+
+    Alerts whose users haven't donated enough for real-time alerts are left
+    out, as are alerts that have invalid queries.
+
+    :param item_type: One of RealTimeQueue.ALL_ITEM_TYPES.
+    :return: A dict with the alerts, the distinct searches they make (see
+    group_alerts), and the Solr parameters of each search, keyed like the
+    searches.
+    """
+    alerts = Alert.objects.filter(rate=Alert.REAL_TIME).select_related(
+        'user__profile',
+    ).order_by('user_id', 'query', 'pk')
+    allowed = {}
+    for alert in alerts:
+        user = alert.user
+        if user.pk not in allowed:
+            donated = user.profile.total_donated_last_year
+            allowed[user.pk] = donated >= settings.MIN_DONATION['rt_alerts']
+    alerts = [a for a in alerts if allowed[a.user_id]]
+
+    groups, _ = group_alerts(alerts, Alert.REAL_TIME)
+    groups = OrderedDict((key, group) for key, group in groups.items() if
+                         group['type'] == item_type)
+    params = {}
+    for key, group in groups.items():
+        params[key] = make_alert_search_params(item_type, group['cd'])
+        params[key]['caller'] = 'percolator:%s' % item_type
+    compiled_pks = {alert.pk for group in groups.values() for alert, _ in
+                    group['alerts']}
+    return {
+        'alerts': [alert for alert in alerts if alert.pk in compiled_pks],
+        'groups': groups,
+        'params': params,
+    }
+
+
+def get_compiled_alerts(item_type):
+    """Get the compiled real-time alerts of an item type, compiling them
+    again only if they've changed.
+    """
+    version = get_alerts_version()
+    compiled = _compiled_alerts.get(item_type)
+    if compiled is None or compiled['version'] != version:
+        compiled = compile_alerts(item_type)
+        compiled['version'] = version
+        _compiled_alerts[item_type] = compiled
+    return compiled
+
+
+def percolate(search_dicts, item_type):
+    """Run the real-time alerts of an item type against a batch of items.
+
+    :param search_dicts: The search dicts of the items.
+    :param item_type: One of RealTimeQueue.ALL_ITEM_TYPES.
+    :return: A tuple of the compiled alerts and a dict mapping the key of
+    each of their searches to its results.
+    """
+    compiled = get_compiled_alerts(item_type)
+    si = get_solr_interface(settings.SOLR_PERCOLATOR_URLS[item_type],
+                            mode='rw')
+    results = {}
+    try:
+        si.add(search_dicts)
+        si.commit()
+        for key, params in compiled['params'].items():
+            results[key] = si.query().add_extra(**params).execute()
+            regroup_snippets(results[key])
+    finally:
+        si.delete_all()
+        si.commit()
+    return compiled, results
+
+
+def acquire_percolator_lock(item_type, timeout=5 * 60):
+    """Take the lock for the stand-in core of an item type, which can only
+    hold one batch at a time.
+
+    The lock expires after timeout seconds, in case it's never released.
+
+    :return: A token to release the lock with if it was taken, else None.
+    """
+    r = make_redis_interface('ALERTS')
+    token = uuid.uuid4().hex
+    if r.set(PERCOLATOR_LOCK_KEY % item_type, token, nx=True, ex=timeout):
+        return token
+    return None
+
+
+# Deletes the lock only if it still holds the token, all in one step.
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def release_percolator_lock(item_type, token):
+    """Release the lock for the stand-in core of an item type, unless it
+    expired and was taken by someone else.
+
+    :param token: The token acquire_percolator_lock returned.
+    """
+    r = make_redis_interface('ALERTS')
+    r.eval(RELEASE_LOCK_SCRIPT, 1, PERCOLATOR_LOCK_KEY % item_type, token)
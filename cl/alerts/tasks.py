@@ -1,15 +1,20 @@
+from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template import loader
 from django.utils.timezone import now
 
-from cl.alerts.models import DocketAlert
+from cl.alerts.models import Alert, DocketAlert, RealTimeQueue
+from cl.alerts.percolator import PERCOLATOR_ITEM_TYPES, \
+    acquire_percolator_lock, percolate, release_percolator_lock
+from cl.alerts.utils import send_hits
 from cl.celery import app
 from cl.custom_filters.templatetags.text_filters import best_case_name
 from cl.lib.redis_utils import make_redis_interface
 from cl.lib.string_utils import trunc
 from cl.search.models import Docket, DocketEntry
+from cl.search.search_dicts import make_search_dicts
 from cl.stats.utils import tally_stat
 
 
@@ -117,3 +122,38 @@ def send_docket_alerts(data):
         send_docket_alert(*args)
 
     return data.get('rds_for_solr', [])
+
+
+@app.task(ignore_result=True, max_retries=20)
+def percolate_items(item_pks, app_label):
+    """Run the real-time alerts against items that were just indexed, and
+    send any hits.
+
+    Only items that are in the RealTimeQueue are new, so the rest are left
+    alone. See cl.alerts.percolator.
+
+    :param item_pks: The IDs of the items.
+    :param app_label: The type of the items, a key of PERCOLATOR_ITEM_TYPES.
+    """
+    item_type = PERCOLATOR_ITEM_TYPES[app_label]
+    new_pks = list(RealTimeQueue.objects.filter(
+        item_type=item_type,
+        item_pk__in=item_pks,
+    ).values_list('item_pk', flat=True))
+    if not new_pks:
+        return
+
+    token = acquire_percolator_lock(item_type)
+    if token is None:
+        # Another batch is using the stand-in core.
+        percolate_items.retry(countdown=5)
+    try:
+        search_dicts = make_search_dicts(apps.get_model(app_label), new_pks)
+        compiled, results = percolate(search_dicts, item_type)
+    finally:
+        release_percolator_lock(item_type, token)
+
+    sent = send_hits(compiled['alerts'], compiled['groups'], results)
+    RealTimeQueue.objects.filter(item_type=item_type,
+                                 item_pk__in=new_pks).delete()
+    tally_stat('alerts.sent.%s' % Alert.REAL_TIME, inc=sent)
@@ -1,12 +1,19 @@
+from smtplib import SMTPException
+
+import mock
 from django.contrib.auth.models import User
 from django.core import mail
 from django.urls import reverse
-from django.test import Client, TestCase
+from django.test import Client, TestCase, override_settings
 from django.utils.timezone import now
 from timeout_decorator import timeout_decorator
 
-from cl.alerts.models import Alert, DocketAlert
-from cl.alerts.tasks import send_docket_alert
+from cl.alerts.models import Alert, DocketAlert, RealTimeQueue
+from cl.alerts.percolator import PERCOLATOR_LOCK_KEY, _compiled_alerts, \
+    acquire_percolator_lock, get_compiled_alerts, release_percolator_lock
+from cl.alerts.tasks import percolate_items, send_docket_alert
+from cl.alerts.utils import group_alerts, send_hits
+from cl.lib.redis_utils import make_redis_interface
 from cl.search.models import Docket, DocketEntry, RECAPDocument
 from cl.tests.base import BaseSeleniumTest, SELENIUM_TIMEOUT
 
@@ -66,6 +73,108 @@ class AlertTest(TestCase):
         self.alert.refresh_from_db()
         self.assertEqual(self.alert.rate, new_rate)
 
+    def test_equivalent_alerts_are_grouped(self):
+        """Do alerts that would run the same search share it?"""
+        same_alerts = [self.alert] + [
+            Alert.objects.create(user_id=1001, name='dummy alert',
+                                 rate='dly', query=query)
+            for query in ('q=asdf', 'type=o&q=asdf',
+                          'q=asdf&order_by=score+desc')
+        ]
+        other_alert = Alert.objects.create(user_id=1001, name='dummy alert',
+                                           rate='dly', query='q=asdf&type=oa')
+        groups, invalid = group_alerts(same_alerts + [other_alert], 'dly')
+        self.assertEqual(invalid, [])
+        self.assertEqual(len(groups), 2)
+        alerts_by_type = {group['type']: [a for a, _ in group['alerts']]
+                          for group in groups.values()}
+        self.assertEqual(alerts_by_type['o'], same_alerts)
+        self.assertEqual(alerts_by_type['oa'], [other_alert])
+
+    @mock.patch('cl.alerts.utils.make_alert_email')
+    @mock.patch('cl.alerts.utils.get_connection')
+    def test_alerts_are_marked_hit_only_once_sent(self, mock_get_connection,
+                                                  mock_make_email):
+        """If sending fails partway, are the alerts whose emails weren't sent
+        left for next time?
+        """
+        other_alert = Alert.objects.create(user_id=1002, name='dummy alert',
+                                           rate='dly', query='q=qwerty')
+        alerts = [self.alert, other_alert]
+        groups, _ = group_alerts(alerts, 'dly')
+        results = {key: ['hit'] for key in groups}
+        mock_get_connection.return_value.send_messages.side_effect = [
+            1, SMTPException("Connection lost"),
+        ]
+        with self.assertRaises(SMTPException):
+            send_hits(alerts, groups, results)
+
+        self.alert.refresh_from_db()
+        other_alert.refresh_from_db()
+        self.assertIsNotNone(self.alert.date_last_hit)
+        self.assertIsNone(other_alert.date_last_hit)
+
+
+@override_settings(MIN_DONATION={'rt_alerts': 0, 'docket_alerts': 0})
+class PercolatorTest(TestCase):
+    fixtures = ['test_court.json', 'authtest_data.json']
+
+    def setUp(self):
+        _compiled_alerts.clear()
+        for query in ('q=asdf', 'type=o&q=asdf', 'q=asdf&type=oa'):
+            Alert.objects.create(user_id=1001, name='dummy alert',
+                                 rate=Alert.REAL_TIME, query=query)
+
+    def tearDown(self):
+        _compiled_alerts.clear()
+        Alert.objects.all().delete()
+
+    def test_compiled_alerts_are_reused(self):
+        """Are alerts only compiled again once they change?"""
+        compiled = get_compiled_alerts(RealTimeQueue.OPINION)
+        self.assertEqual(len(compiled['params']), 1)
+        self.assertEqual(len(compiled['alerts']), 2)
+        self.assertIs(compiled, get_compiled_alerts(RealTimeQueue.OPINION))
+
+        # Tests never commit, so run the commit hooks right away.
+        with mock.patch('cl.alerts.models.transaction.on_commit',
+                        side_effect=lambda func: func()):
+            Alert.objects.create(user_id=1001, name='dummy alert',
+                                 rate=Alert.REAL_TIME, query='q=qwerty')
+        recompiled = get_compiled_alerts(RealTimeQueue.OPINION)
+        self.assertIsNot(compiled, recompiled)
+        self.assertEqual(len(recompiled['params']), 2)
+        self.assertEqual(len(recompiled['alerts']), 3)
+
+    def test_lock_is_only_released_by_its_owner(self):
+        """Can a lock that expired and was taken again only be released by
+        its new owner?
+        """
+        item_type = RealTimeQueue.OPINION
+        r = make_redis_interface('ALERTS')
+        r.delete(PERCOLATOR_LOCK_KEY % item_type)
+        old_token = acquire_percolator_lock(item_type)
+        self.assertIsNotNone(old_token)
+        self.assertIsNone(acquire_percolator_lock(item_type))
+
+        # The lock expires, and another batch takes it.
+        r.delete(PERCOLATOR_LOCK_KEY % item_type)
+        new_token = acquire_percolator_lock(item_type)
+        self.assertIsNotNone(new_token)
+
+        release_percolator_lock(item_type, old_token)
+        self.assertIsNone(acquire_percolator_lock(item_type))
+        release_percolator_lock(item_type, new_token)
+        token = acquire_percolator_lock(item_type)
+        self.assertIsNotNone(token)
+        release_percolator_lock(item_type, token)
+
+    def test_only_new_items_are_percolated(self):
+        """Are items that aren't in the RealTimeQueue left alone?"""
+        with mock.patch('cl.alerts.tasks.percolate') as mock_percolate:
+            percolate_items([1, 2], 'search.Opinion')
+        self.assertFalse(mock_percolate.called)
+
 
 class DocketAlertTest(TestCase):
     """Do docket alerts work properly?"""
@@ -0,0 +1,200 @@
+import datetime
+import json
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.http import QueryDict
+from django.template import loader
+from django.utils.timezone import now
+
+from cl.alerts.models import Alert
+from cl.lib import search_utils
+from cl.search.forms import SearchForm
+from cl.search.search_cache import canonicalize_cleaned_data
+
+
+class InvalidDateError(Exception):
+    pass
+
+
+def get_cut_off_date(rate, d=datetime.date.today()):
+    """Given a rate of dly, wly or mly and a date, returns the date after which
+    new results should be considered a hit for an cl.
+    """
+    cut_off_date = None
+    if rate == Alert.REAL_TIME:
+        # use a couple days ago to limit results without risk of leaving out
+        # important items (this will be filtered further later).
+        cut_off_date = d - datetime.timedelta(days=10)
+    elif rate == Alert.DAILY:
+        cut_off_date = d
+    elif rate == Alert.WEEKLY:
+        cut_off_date = d - datetime.timedelta(days=7)
+    elif rate == Alert.MONTHLY:
+        if datetime.date.today().day > 28:
+            raise InvalidDateError('Monthly alerts cannot be run on the 29th, '
+                                   '30th or 31st.')
+
+        # Get the first of the month of the previous month regardless of the
+        # current date
+        early_last_month = d - datetime.timedelta(days=28)
+        cut_off_date = datetime.datetime(early_last_month.year,
+                                         early_last_month.month, 1)
+    return cut_off_date
+
+
+def make_alert_email(user_profile, hits):
+    subject = 'New hits for your alerts'
+
+    txt_template = loader.get_template('alert_email.txt')
+    html_template = loader.get_template('alert_email.html')
+    context = {'hits': hits}
+    txt = txt_template.render(context)
+    html = html_template.render(context)
+    msg = EmailMultiAlternatives(subject, txt, settings.DEFAULT_ALERTS_EMAIL,
+                                 [user_profile.user.email])
+    msg.attach_alternative(html, "text/html")
+    return msg
+
+
+def make_alert_query_dict(query, rate):
+    """Make the query dict for running an alert at a rate.
+
+    :param query: The query string of the alert.
+    :param rate: The rate the alert is being run at.
+    :return: A QueryDict, limited to the items that are new since the alert
+    was last run.
+    """
+    qd = QueryDict(query.encode('utf-8'), mutable=True)
+    try:
+        del qd['filed_before']
+    except KeyError:
+        pass
+    qd['order_by'] = 'score desc'
+    cut_off_date = get_cut_off_date(rate, datetime.date.today())
+    # Default to 'o', if not available, according to the front end.
+    query_type = qd.get('type', 'o')
+    if query_type in ['o', 'r']:
+        qd['filed_after'] = cut_off_date
+    elif query_type == 'oa':
+        qd['argued_after'] = cut_off_date
+    return qd
+
+
+def group_alerts(alerts, rate):
+    """Group alerts that would run the same search.
+
+    Alerts are first grouped by their query string, so that each distinct
+    string goes through the search form only once. Then the cleaned forms
+    are canonicalized (see canonicalize_cleaned_data), so that alerts whose
+    query strings only differ in the order of their parameters, or in
+    parameters that are set to their defaults, share a search too.
+
+    :param alerts: An iterable of Alerts, all with the same rate.
+    :param rate: Their rate.
+    :return: A tuple. The first item is an OrderedDict of the distinct
+    searches, mapping a key for each one to a dict with its type, cleaned
+    data, and a list of (alert, query dict) tuples. The second is a list of
+    the alerts that have invalid queries.
+    """
+    by_query = OrderedDict()
+    for alert in alerts:
+        by_query.setdefault(alert.query, []).append(alert)
+
+    groups = OrderedDict()
+    invalid = []
+    for query, query_alerts in by_query.items():
+        qd = make_alert_query_dict(query, rate)
+        search_form = SearchForm(qd)
+        if not search_form.is_valid():
+            invalid.extend(query_alerts)
+            continue
+        cd = search_form.cleaned_data
+        key = json.dumps([cd['type'], rate, canonicalize_cleaned_data(
+            cd, search_form.fields)])
+        group = groups.setdefault(key, {
+            'type': cd['type'],
+            'cd': cd,
+            'alerts': [],
+        })
+        group['alerts'].extend((alert, qd) for alert in query_alerts)
+    return groups, invalid
+
+
+def make_alert_search_params(query_type, cd):
+    """Make the Solr parameters for the search of an alert.
+
+    :param query_type: The type of the search.
+    :param cd: The cleaned data of the alert's search form.
+    """
+    main_params = search_utils.build_main_query(cd, facet=False)
+    main_params.update({
+        'rows': '20',
+        'start': '0',
+        'hl.tag.pre': '<em><strong>',
+        'hl.tag.post': '</strong></em>',
+        'caller': 'cl_send_alerts:%s' % query_type,
+    })
+    return main_params
+
+
+def send_hits(alerts, groups, results):
+    """Fan the results of the searches of alerts back out to the alerts, and
+    send each user one email with the hits for all of their alerts.
+
+    :param alerts: The alerts that were run, in the order their hits should
+    be listed in the emails.
+    :param groups: The distinct searches of the alerts, from group_alerts.
+    :param results: A dict mapping the key of each search to its results, or
+    to None if the search failed.
+    :return: The number of emails that were sent.
+    """
+    hits_by_user = OrderedDict()
+    hit_alerts = {}
+    for key, group in groups.items():
+        if not results.get(key):
+            continue
+        for alert, qd in group['alerts']:
+            # hits is a multi-dimensional array. It consists of alerts,
+            # paired with a list of document dicts, of the form:
+            # [[alert1, [{hit1}, {hit2}, {hit3}]], [alert2, ...]]
+            hit_alerts[alert.pk] = [alert, group['type'], results[key]]
+            alert.query_run = qd.urlencode()
+    for alert in alerts:
+        if alert.pk in hit_alerts:
+            hits_by_user.setdefault(alert.user, []).append(
+                hit_alerts[alert.pk])
+
+    if not hits_by_user:
+        return 0
+
+    # Alerts are only marked as hit once their email has been sent, so if
+    # sending fails partway, the rest get their hits next time.
+    connection = get_connection(fail_silently=False)
+    sent_alerts = []
+    try:
+        connection.open()
+        for user, hits in hits_by_user.items():
+            connection.send_messages([make_alert_email(user.profile, hits)])
+            sent_alerts.extend(alert for alert, _, _ in hits)
+    finally:
+        connection.close()
+        mark_alerts_hit(sent_alerts)
+    return len(hits_by_user)
+
+
+def mark_alerts_hit(alerts):
+    """Record that alerts had hits that were sent, and the query that found
+    them.
+
+    :param alerts: Alerts with their query_run attribute set.
+    """
+    # Alerts with the same query string have the same query_run, so update
+    # them together.
+    pks_by_query_run = defaultdict(list)
+    for alert in alerts:
+        pks_by_query_run[alert.query_run].append(alert.pk)
+    for query_run, pks in pks_by_query_run.items():
+        Alert.objects.filter(pk__in=pks).update(
+            query_run=query_run, date_last_hit=now(), date_modified=now())
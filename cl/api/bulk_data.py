@@ -0,0 +1,481 @@
+"""Streaming writers for the bulk data.
+
+The bulk data used to be made by writing every item to its own JSON file,
+then globbing the files and reading them back to make the archives. With tens
+of millions of items, that's tens of millions of small files. Instead, items
+are now serialized straight into their shard: a tar.gz of JSON files, or a
+gzipped file of JSON lines. There is a shard per court for types of items
+that have a court, and a single shard, 'all', for the rest. Shards are written
+in parallel by worker processes, and incremental runs only rewrite the shards
+of courts that have changed.
+
+Where the DRF serializer of a type allows it, rows are fetched with values()
+and serialized by ValuesSerializer, which makes the same output without
+loading model instances. Types whose serializers nest other objects, like
+dockets and people, still go through DRF.
+"""
+import gzip
+import os
+import shutil
+import tarfile
+import time
+from collections import OrderedDict
+from io import BytesIO
+from multiprocessing import Pool
+from os.path import join
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections
+from django.db.models import AutoField
+from django.test import RequestFactory
+from django.urls import reverse
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.versioning import URLPathVersioning
+
+from cl.api.utils import BulkJsonHistory
+from cl.audio.models import Audio
+from cl.lib.db_tools import queryset_generator
+from cl.lib.utils import mkdir_p
+from cl.search.models import Opinion, OpinionCluster
+
+# The extension of the shards of each format.
+SHARD_EXTENSIONS = {
+    'json': 'tar.gz',
+    'jsonl': 'jsonl.gz',
+}
+
+# How to make the absolute_url field of items without loading them: the
+# values it needs, and a function to make it from a row with those values.
+# These match the get_absolute_url methods of the models.
+ABSOLUTE_URLS = {
+    Opinion: (
+        ('cluster_id', 'cluster__slug'),
+        lambda row: reverse('view_case', args=[row['cluster_id'],
+                                               row['cluster__slug']]),
+    ),
+    OpinionCluster: (
+        ('id', 'slug'),
+        lambda row: reverse('view_case', args=[row['id'], row['slug']]),
+    ),
+    Audio: (
+        ('id', 'docket__slug'),
+        lambda row: reverse('view_audio_file', args=[row['id'],
+                                                     row['docket__slug']]),
+    ),
+}
+
+# Stands in for the ID of an item when making a URL template.
+URL_TEMPLATE_SENTINEL = '7357735773577357'
+
+
+class UnsupportedSerializerError(Exception):
+    pass
+
+
+def make_bulk_data_context():
+    """Make the serializer context for the bulk data, so its URLs point at
+    the live site.
+    """
+    r = RequestFactory().request()
+    r.META['SERVER_NAME'] = 'www.courtlistener.com'  # Else, it's testserver
+    r.META['SERVER_PORT'] = '443'  # Else, it's 80
+    r.META['wsgi.url_scheme'] = 'https'  # Else, it's http.
+    r.version = 'v3'
+    r.versioning_scheme = URLPathVersioning()
+    return dict(request=r)
+
+
+class _SentinelItem(object):
+    pk = URL_TEMPLATE_SENTINEL
+
+
+def make_url_template(field, request):
+    """Make a %-style template for the URLs of a hyperlinked field, so that
+    URLs can be made without reversing them one at a time.
+    """
+    url = field.get_url(_SentinelItem(), field.view_name, request, None)
+    return url.replace('%', '%%').replace(URL_TEMPLATE_SENTINEL, '%s')
+
+
+class ValuesSerializer(object):
+    """Serialize rows from values() queries the way a DRF serializer
+    serializes model instances.
+
+    Supported fields are model fields, hyperlinks to the item itself or to
+    related items, absolute URLs listed in ABSOLUTE_URLS, and nested lists of
+    related items whose own fields are all model fields. Anything else raises
+    an UnsupportedSerializerError.
+    """
+
+    def __init__(self, serializer, model, context, nested=False):
+        self.model = model
+        self.pk_name = model._meta.pk.attname
+        self.value_names = [self.pk_name]
+        self.request = context['request']
+        self.fields = []
+        for name, field in serializer(context=context).fields.items():
+            self.fields.append(self.plan_field(name, field, context, nested))
+
+    def add_value_name(self, value_name):
+        if value_name not in self.value_names:
+            self.value_names.append(value_name)
+
+    def get_model_field(self, source):
+        try:
+            return self.model._meta.get_field(source)
+        except FieldDoesNotExist:
+            raise UnsupportedSerializerError(
+                "%s isn't a field of %s." % (source, self.model.__name__))
+
+    def plan_field(self, name, field, context, nested):
+        """Work out how to serialize a field of the serializer.
+
+        :return: A tuple of the name of the field, its kind, and what's needed
+        to serialize it.
+        """
+        if isinstance(field, serializers.HyperlinkedIdentityField):
+            if nested:
+                raise UnsupportedSerializerError("Nested hyperlinks.")
+            return (name, 'link', self.pk_name,
+                    make_url_template(field, self.request))
+
+        if field.source == 'get_absolute_url':
+            if nested or self.model not in ABSOLUTE_URLS:
+                raise UnsupportedSerializerError(
+                    "No absolute URL for %s." % self.model.__name__)
+            value_names, make_url = ABSOLUTE_URLS[self.model]
+            for value_name in value_names:
+                self.add_value_name(value_name)
+            return name, 'absolute_url', None, make_url
+
+        if nested and isinstance(field, (serializers.RelatedField,
+                                         serializers.ManyRelatedField,
+                                         serializers.BaseSerializer)):
+            raise UnsupportedSerializerError("Nested relations.")
+
+        if isinstance(field, serializers.ManyRelatedField):
+            if not isinstance(field.child_relation,
+                              serializers.HyperlinkedRelatedField):
+                raise UnsupportedSerializerError(
+                    "%s isn't a list of hyperlinks." % name)
+            self.get_model_field(field.source)
+            return (name, 'links', field.source,
+                    make_url_template(field.child_relation, self.request))
+
+        if isinstance(field, serializers.HyperlinkedRelatedField):
+            model_field = self.get_model_field(field.source)
+            if not model_field.concrete:
+                raise UnsupportedSerializerError(
+                    "%s isn't a foreign key." % name)
+            self.add_value_name(model_field.attname)
+            return (name, 'link', model_field.attname,
+                    make_url_template(field, self.request))
+
+        if isinstance(field, serializers.ListSerializer):
+            relation = self.get_model_field(field.source)
+            if not relation.one_to_many or relation.concrete:
+                raise UnsupportedSerializerError(
+                    "%s isn't a list of related items." % name)
+            child = ValuesSerializer(field.child.__class__,
+                                     relation.related_model, context,
+                                     nested=True)
+            return name, 'nested', relation, child
+
+        if isinstance(field, (serializers.RelatedField,
+                              serializers.BaseSerializer)) or \
+                '.' in field.source or field.source == '*':
+            raise UnsupportedSerializerError("%s can't be serialized from "
+                                             "values." % name)
+
+        model_field = self.get_model_field(field.source)
+        if not model_field.concrete or model_field.is_relation:
+            raise UnsupportedSerializerError("%s isn't a model field." % name)
+        self.add_value_name(model_field.attname)
+        if isinstance(field, serializers.FileField):
+            # DRF makes the URL of a file from a FieldFile.
+            def to_representation(value, field=field, model_field=model_field):
+                return field.to_representation(
+                    model_field.attr_class(None, model_field, value))
+        else:
+            to_representation = field.to_representation
+        return name, 'value', model_field.attname, to_representation
+
+    def get_related(self, pks):
+        """Get the related items of the lists in the output for a chunk of
+        items, in as few queries as there are lists.
+
+        :return: A dict of dicts, mapping the name of each list field to the
+        IDs of the items and their related things.
+        """
+        related = {}
+        for name, kind, source, extra in self.fields:
+            if kind == 'links':
+                links = related[name] = {pk: [] for pk in pks}
+                pairs = self.model.objects.filter(pk__in=pks).order_by(
+                    '%s__pk' % source).values_list('pk', '%s__pk' % source)
+                for pk, related_pk in pairs:
+                    if related_pk is not None:
+                        links[pk].append(extra % related_pk)
+            elif kind == 'nested':
+                relation, child = source, extra
+                children = related[name] = {pk: [] for pk in pks}
+                fk_name = relation.field.attname
+                value_names = [fk_name] + [n for n in child.value_names if
+                                           n != fk_name]
+                rows = relation.related_model.objects.filter(**{
+                    '%s__in' % relation.field.name: pks,
+                }).order_by('pk').values(*value_names)
+                for row in rows:
+                    children[row[fk_name]].append(child.serialize_row(row))
+        return related
+
+    def serialize_row(self, row, related=None):
+        data = {}
+        for name, kind, source, extra in self.fields:
+            if kind == 'value':
+                value = row[source]
+                data[name] = None if value is None else extra(value)
+            elif kind == 'link':
+                value = row[source]
+                data[name] = None if value is None else extra % value
+            elif kind == 'absolute_url':
+                data[name] = extra(row)
+            else:
+                data[name] = related[name][row[self.pk_name]]
+        # Keep the order of the fields, like DRF does.
+        return OrderedDict((name, data[name]) for name, _, _, _ in
+                           self.fields)
+
+    def serialize(self, queryset, chunk_size=1000):
+        """Serialize every item in a queryset, a chunk at a time.
+
+        :return: A generator of tuples of the ID of each item and its data.
+        """
+        rows = queryset.values(*self.value_names)
+        if isinstance(self.model._meta.pk, AutoField):
+            rows = queryset_generator(rows, chunksize=chunk_size)
+        else:
+            rows = rows.order_by('pk')
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                for item in self.serialize_chunk(chunk):
+                    yield item
+                chunk = []
+        for item in self.serialize_chunk(chunk):
+            yield item
+
+    def serialize_chunk(self, rows):
+        if not rows:
+            return []
+        pks = [row[self.pk_name] for row in rows]
+        related = self.get_related(pks)
+        return [(row[self.pk_name], self.serialize_row(row, related)) for
+                row in rows]
+
+
+def get_values_serializer(serializer, model, context):
+    """Get a ValuesSerializer for a DRF serializer, or None if it can't be
+    serialized from values.
+    """
+    try:
+        return ValuesSerializer(serializer, model, context)
+    except UnsupportedSerializerError:
+        return None
+
+
+def serialize_items(queryset, serializer, context):
+    """Serialize the items in a queryset with the fastest serializer that
+    works for them.
+
+    :return: A generator of tuples of the ID of each item and its data.
+    """
+    values_serializer = get_values_serializer(serializer, queryset.model,
+                                              context)
+    if values_serializer is not None:
+        return values_serializer.serialize(queryset)
+    if isinstance(queryset.model._meta.pk, AutoField):
+        items = queryset_generator(queryset)
+    else:
+        items = queryset.order_by('pk')
+    return ((item.pk, serializer(item, context=context).data) for item in
+            items)
+
+
+class ShardWriter(object):
+    """Write serialized items into a shard, without touching the filesystem
+    for each item.
+
+    Shards are written under a temporary name and moved into place when
+    they're closed, so a shard that's there is always complete.
+    """
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self.partial_path = '%s.partial' % path
+        self.renderer = JSONRenderer()
+        self.count = 0
+        if fmt == 'json':
+            self.archive = tarfile.open(self.partial_path, 'w:gz',
+                                        compresslevel=3)
+        else:
+            self.archive = gzip.open(self.partial_path, 'wb',
+                                     compresslevel=3)
+
+    def write(self, pk, data):
+        if self.fmt == 'json':
+            json_str = self.renderer.render(
+                data, accepted_media_type='application/json; indent=2')
+            info = tarfile.TarInfo('%s.json' % pk)
+            info.size = len(json_str)
+            info.mtime = time.time()
+            self.archive.addfile(info, BytesIO(json_str))
+        else:
+            self.archive.write(self.renderer.render(data))
+            self.archive.write('\n')
+        self.count += 1
+
+    def close(self):
+        self.archive.close()
+        os.rename(self.partial_path, self.path)
+
+
+def get_shard_path(directory, shard, fmt):
+    """Get the path of a shard, which is named by its court, or 'all'."""
+    return join(directory, '%s.%s' % (shard or 'all', SHARD_EXTENSIONS[fmt]))
+
+
+def write_shard(args):
+    """Write a shard of the bulk data.
+
+    Run in the worker processes of write_bulk_data.
+
+    :param args: A tuple of the class of the items, their DRF serializer, the
+    attribute of their court, the court of the shard (None for types that
+    don't have courts), the directory of the shard, and its format.
+    :return: A tuple of the court of the shard and the number of items in it.
+    """
+    obj_class, serializer, court_attr, court_id, directory, fmt = args
+    queryset = obj_class.objects.all()
+    if court_attr is not None:
+        queryset = queryset.filter(**{court_attr.replace('.', '__'): court_id})
+    writer = ShardWriter(get_shard_path(directory, court_id, fmt), fmt)
+    for pk, data in serialize_items(queryset, serializer,
+                                    make_bulk_data_context()):
+        writer.write(pk, data)
+    writer.close()
+    return court_id, writer.count
+
+
+def get_changed_courts(obj_class, court_attr, since):
+    """Get the IDs of the courts whose items were modified since a date."""
+    return set(obj_class.objects.filter(date_modified__gte=since).order_by(
+    ).values_list(court_attr.replace('.', '__'), flat=True).distinct())
+
+
+def close_db_connections():
+    """Make sure processes don't share database connections across a fork."""
+    connections.close_all()
+
+
+def write_bulk_data(courts, obj_type_str, obj_class, court_attr, serializer,
+                    bulk_dir, published_dir=None, processes=1, fmt='json'):
+    """Write the shards of the bulk data of a type of item.
+
+    When there is no previous run to build on, every shard is written. When
+    there is, only the shards of courts whose items have changed since it, or
+    whose shards haven't been published, are written again.
+
+    :param courts: Court objects that you expect to make data for.
+    :param obj_type_str: A string to use for the directory name of a type of
+    data. For example, for clusters, it's 'clusters'.
+    :param obj_class: The actual class to make a bulk data for.
+    :param court_attr: A string that can be used to find the court attribute
+    on an object. For example, on clusters, this is currently docket.court_id.
+    :param serializer: A DRF serializer to use to generate the data.
+    :param bulk_dir: A directory to place the shards into.
+    :param published_dir: The directory where the shards of earlier runs are
+    published, if any.
+    :param processes: The number of processes to write the shards with.
+    :param fmt: 'json' for tar.gz files of JSON files, or 'jsonl' for gzipped
+    files of JSON lines.
+    :returns dict: The number of items written to each shard that was
+    written, keyed by court ID, or by None for types without courts.
+    """
+    history = BulkJsonHistory(obj_type_str, bulk_dir)
+    last_good_date = history.get_last_good_date()
+    history.add_current_attempt_and_save()
+    directory = join(bulk_dir, obj_type_str)
+    mkdir_p(directory)
+
+    if court_attr is None:
+        # Non-jurisdiction-centric object types (like schools) get one shard.
+        shards = [None]
+    else:
+        shards = [court.pk for court in courts]
+
+    if last_good_date is None:
+        print("   - Incremental data not found. Working from scratch...")
+    else:
+        print("   - Incremental data found. Only rewriting the shards that "
+              "have changed...")
+        if court_attr is None:
+            changed = set()
+            if obj_class.objects.filter(
+                    date_modified__gte=last_good_date).exists():
+                changed.add(None)
+        else:
+            changed = get_changed_courts(obj_class, court_attr,
+                                         last_good_date)
+        # Shards that were never published have to be written regardless.
+        shards = [shard for shard in shards if shard in changed or
+                  published_dir is None or not os.path.exists(
+                      get_shard_path(published_dir, shard, fmt))]
+
+    if not shards:
+        print("   - No %s-type items have changed. All done here." %
+              obj_type_str)
+        history.mark_success_and_save()
+        return {}
+
+    args = [(obj_class, serializer, court_attr, shard, directory, fmt) for
+            shard in shards]
+    counts = {}
+    if processes > 1:
+        close_db_connections()
+        pool = Pool(processes, initializer=close_db_connections)
+        try:
+            results = pool.imap_unordered(write_shard, args)
+            for shard, count in results:
+                counts[shard] = count
+                print("   - Wrote %s %s to the %s shard." %
+                      (count, obj_type_str, shard or 'all'))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for shard_args in args:
+            shard, count = write_shard(shard_args)
+            counts[shard] = count
+
+    print('   - %s %s written to %s shards.' % (sum(counts.values()),
+                                                obj_type_str, len(counts)))
+    history.mark_success_and_save()
+    return counts
+
+
+def make_all_tar(courts, published_dir, tmp_dir, fmt):
+    """Make the all.tar file by tarring up the published shards of every
+    court, then publish it.
+    """
+    tmp_path = join(tmp_dir, 'all.tar')
+    tar = tarfile.open(tmp_path, 'w')
+    for court in courts:
+        path = get_shard_path(published_dir, court.pk, fmt)
+        if os.path.exists(path):
+            tar.add(path, arcname=os.path.basename(path))
+    tar.close()
+    shutil.move(tmp_path, join(published_dir, 'all.tar'))
@@ -22,6 +22,23 @@ from cl.search.models import Court, Docket, OpinionCluster, Opinion
 class Command(VerboseCommand):
     help = 'Create the bulk files for all jurisdictions and for "all".'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=1,
+            help="The number of processes to write the files of the courts "
+                 "with.",
+        )
+        parser.add_argument(
+            '--format',
+            choices=('json', 'jsonl'),
+            default='json',
+            help="The format of the files. 'json' makes a tar.gz of JSON "
+                 "files for each court, and 'jsonl' makes a gzipped file of "
+                 "JSON lines for each court.",
+        )
+
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
         courts = Court.objects.all()
@@ -99,7 +116,8 @@ class Command(VerboseCommand):
                     len(kwargs_list))
         for kwargs in kwargs_list:
             make_bulk_data_and_swap_it_in(courts, settings.BULK_DATA_DIR,
-                                          kwargs)
+                                          kwargs, options['processes'],
+                                          options['format'])
 
         # Make the citation bulk data
         obj_type_str = 'citations'
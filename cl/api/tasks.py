@@ -1,13 +1,12 @@
 import glob
 import os
 import shutil
-import tarfile
 from os.path import join
 
-from django.test import RequestFactory
 from rest_framework.renderers import JSONRenderer
-from rest_framework.versioning import URLPathVersioning
 
+from cl.api.bulk_data import SHARD_EXTENSIONS, make_all_tar, \
+    make_bulk_data_context, write_bulk_data
 from cl.api.utils import BulkJsonHistory
 from cl.celery import app
 from cl.lib.db_tools import queryset_generator
@@ -17,23 +16,26 @@ from cl.lib.utils import deepgetattr, mkdir_p
 
 @app.task
 @print_timing
-def make_bulk_data_and_swap_it_in(courts, bulk_dir, kwargs):
+def make_bulk_data_and_swap_it_in(courts, bulk_dir, kwargs, processes=1,
+                                  fmt='json'):
     """We can't wrap the handle() function, but we can wrap this one."""
     # Create a directory where we'll put temporary files
     tmp_bulk_dir = join(bulk_dir, 'tmp')
+    obj_type_str = kwargs['obj_type_str']
 
-    print(' - Creating bulk %s files...' % kwargs['obj_type_str'])
-    num_written = write_json_to_disk(courts, bulk_dir=tmp_bulk_dir, **kwargs)
+    print(' - Creating bulk %s files...' % obj_type_str)
+    counts = write_bulk_data(courts, bulk_dir=tmp_bulk_dir,
+                             published_dir=join(bulk_dir, obj_type_str),
+                             processes=processes, fmt=fmt, **kwargs)
 
-    if num_written > 0:
-        print('   - Tarring and compressing all %s files...' %
-              kwargs['obj_type_str'])
-        targz_json_files(courts, tmp_bulk_dir, kwargs['obj_type_str'],
-                         kwargs['court_attr'])
+    if counts:
+        print('   - Swapping in the new %s archives...' % obj_type_str)
+        swap_archives(obj_type_str, bulk_dir, tmp_bulk_dir)
 
-        print('   - Swapping in the new %s archives...' %
-              kwargs['obj_type_str'])
-        swap_archives(kwargs['obj_type_str'], bulk_dir, tmp_bulk_dir)
+        if kwargs['court_attr'] is not None:
+            print('   - Making the all.tar file of %s...' % obj_type_str)
+            make_all_tar(courts, join(bulk_dir, obj_type_str),
+                         join(tmp_bulk_dir, obj_type_str), fmt)
 
 
 def swap_archives(obj_type_str, bulk_dir, tmp_bulk_dir):
@@ -41,8 +43,9 @@ def swap_archives(obj_type_str, bulk_dir, tmp_bulk_dir):
     tmp_gz_dir = join(tmp_bulk_dir, obj_type_str)
     final_gz_dir = join(bulk_dir, obj_type_str)
     mkdir_p(final_gz_dir)
-    for f in glob.glob(join(tmp_gz_dir, '*.tar*')):
-        shutil.move(f, join(final_gz_dir, os.path.basename(f)))
+    for extension in SHARD_EXTENSIONS.values():
+        for f in glob.glob(join(tmp_gz_dir, '*.%s' % extension)):
+            shutil.move(f, join(final_gz_dir, os.path.basename(f)))
 
     # Move the info files too.
     try:
@@ -56,35 +59,6 @@ def swap_archives(obj_type_str, bulk_dir, tmp_bulk_dir):
             raise
 
 
-def targz_json_files(courts, bulk_dir, obj_type_str, court_attr):
-    """Create gz-compressed archives using the JSON on disk."""
-
-    root_path = join(bulk_dir, obj_type_str)
-    if court_attr is not None:
-        for court in courts:
-            tar_path = join(root_path, '%s.tar.gz' % court.pk)
-            tar = tarfile.open(tar_path, "w:gz", compresslevel=3)
-            for name in glob.glob(join(root_path, court.pk, "*.json")):
-                tar.add(name, arcname=os.path.basename(name))
-            tar.close()
-    else:
-        # Non-jurisdictional-centric object type (like an ABA Rating)
-        tar_path = join(root_path, 'all.tar.gz')
-        tar = tarfile.open(tar_path, 'w:gz', compresslevel=3)
-        for name in glob.glob(join(root_path, '*.json')):
-            tar.add(name, arcname=os.path.basename(name))
-        tar.close()
-
-    if court_attr is not None:
-        # Make the all.tar file by tarring up the other files. Non-court-centric
-        # objects already did this.
-        tar = tarfile.open(join(root_path, 'all.tar'), "w")
-        for court in courts:
-            targz = join(root_path, "%s.tar.gz" % court.pk)
-            tar.add(targz, arcname=os.path.basename(targz))
-        tar.close()
-
-
 def write_json_to_disk(courts, obj_type_str, obj_class, court_attr,
                        serializer, bulk_dir):
     """Write all items to disk as json files inside directories named by
@@ -150,13 +124,7 @@ def write_json_to_disk(courts, obj_type_str, obj_class, court_attr,
 
         i = 0
         renderer = JSONRenderer()
-        r = RequestFactory().request()
-        r.META['SERVER_NAME'] = 'www.courtlistener.com'  # Else, it's testserver
-        r.META['SERVER_PORT'] = '443'  # Else, it's 80
-        r.META['wsgi.url_scheme'] = 'https'  # Else, it's http.
-        r.version = 'v3'
-        r.versioning_scheme = URLPathVersioning()
-        context = dict(request=r)
+        context = make_bulk_data_context()
         for item in item_list:
             if i % 1000 == 0:
                 print("Completed %s items so far." % i)
@@ -4,6 +4,7 @@ from __future__ import print_function
 import json
 import shutil
 from datetime import timedelta, date
+from os.path import join
 
 from django.conf import settings
 from django.contrib.auth.models import User, Permission
@@ -14,10 +15,14 @@ from django.http import HttpRequest, JsonResponse
 from django.test import Client, override_settings, RequestFactory, TestCase, \
     TransactionTestCase
 from django.utils.timezone import now
+from rest_framework.renderers import JSONRenderer
 from rest_framework.status import HTTP_200_OK, HTTP_403_FORBIDDEN
 
+from cl.api.bulk_data import ValuesSerializer, make_bulk_data_context, \
+    write_bulk_data
 from cl.api.utils import BulkJsonHistory, SEND_API_WELCOME_EMAIL_COUNT
 from cl.api.views import coverage_data
+from cl.audio.api_serializers import AudioSerializer
 from cl.audio.api_views import AudioViewSet
 from cl.audio.models import Audio
 from cl.lib.redis_utils import make_redis_interface
@@ -25,6 +30,8 @@ from cl.lib.test_helpers import IndexedSolrTestCase
 from cl.scrapers.management.commands.cl_scrape_oral_arguments import \
     Command as OralArgumentCommand
 from cl.scrapers.test_assets import test_oral_arg_scraper
+from cl.search.api_serializers import CourtSerializer, DocketSerializer, \
+    OpinionClusterSerializer, OpinionSerializer
 from cl.search.models import Docket, Court, Opinion, OpinionCluster, \
     OpinionsCited
 from cl.stats.models import Event
@@ -898,6 +905,42 @@ class BulkDataTest(TestCase):
         """Can we successfully generate all bulk files?"""
         call_command('cl_make_bulk_data')
 
+    @override_settings(BULK_DATA_DIR=tmp_data_dir)
+    def test_make_all_bulk_files_as_json_lines(self):
+        call_command('cl_make_bulk_data', format='jsonl')
+
+    def test_values_serializer_matches_drf(self):
+        """Does serializing from values() give what DRF gives?"""
+        context = make_bulk_data_context()
+        renderer = JSONRenderer()
+        for model, serializer in ((Opinion, OpinionSerializer),
+                                  (OpinionCluster, OpinionClusterSerializer),
+                                  (Court, CourtSerializer),
+                                  (Audio, AudioSerializer)):
+            values_serializer = ValuesSerializer(serializer, model, context)
+            for pk, data in values_serializer.serialize(model.objects.all()):
+                item = model.objects.get(pk=pk)
+                self.assertEqual(
+                    json.loads(renderer.render(data)),
+                    json.loads(renderer.render(
+                        serializer(item, context=context).data)),
+                )
+
+    def test_only_changed_courts_are_rewritten(self):
+        courts = Court.objects.all()
+        args = (courts, 'dockets', Docket, 'court_id', DocketSerializer,
+                self.tmp_data_dir)
+        kwargs = {'published_dir': join(self.tmp_data_dir, 'dockets')}
+        counts = write_bulk_data(*args, **kwargs)
+        self.assertEqual(set(counts.keys()), {court.pk for court in courts})
+
+        self.assertEqual(write_bulk_data(*args, **kwargs), {})
+
+        Docket.objects.filter(court_id='test').update(date_modified=now())
+        counts = write_bulk_data(*args, **kwargs)
+        self.assertEqual(counts, {'test': Docket.objects.filter(
+            court_id='test').count()})
+
     def test_database_has_objects_for_bulk_export(self):
         self.assertTrue(Opinion.objects.count() > 0, 'Opinions exist')
         self.assertTrue(Audio.objects.count() > 0, 'Audio exist')
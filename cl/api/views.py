@@ -5,7 +5,8 @@ from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import render, get_object_or_404
 from rest_framework import status
 
-from cl.lib import magic, sunburnt
+from cl.lib import magic
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.search_utils import build_coverage_query, build_court_count_query
 from cl.search.models import Court
 from cl.stats.utils import tally_stat
@@ -35,7 +36,8 @@ def annotate_courts_with_counts(courts, court_count_tuples):
 
 def make_court_variable():
     courts = Court.objects.exclude(jurisdiction=Court.TESTING_COURT)
-    conn = sunburnt.SolrInterface(settings.SOLR_OPINION_URL, mode='r')
+    conn = get_solr_interface(settings.SOLR_OPINION_URL, mode='r',
+                              client='sunburnt')
     response = conn.raw_query(**build_court_count_query()).execute()
     court_count_tuples = response.facet_counts.facet_fields['court_exact']
     courts = annotate_courts_with_counts(courts, court_count_tuples)
@@ -126,7 +128,8 @@ def coverage_data(request, version, court):
     else:
         court_str = 'all'
     q = request.GET.get('q')
-    conn = sunburnt.SolrInterface(settings.SOLR_OPINION_URL, mode='r')
+    conn = get_solr_interface(settings.SOLR_OPINION_URL, mode='r',
+                              client='sunburnt')
     response = conn.raw_query(**build_coverage_query(court_str, q)).execute()
     counts = response.facet_counts.facet_ranges[0][1][0][1]
     counts = strip_zero_years(counts)
@@ -2,7 +2,7 @@ from django.conf import settings
 
 from cl.lib import search_utils
 from cl.lib.podcast import iTunesPodcastsFeedGenerator
-from cl.lib.scorched_utils import ExtraSolrInterface
+from cl.lib.scorched_utils import get_solr_interface
 from cl.search.feeds import JurisdictionFeed, get_item
 from cl.search.forms import SearchForm
 
@@ -27,7 +27,7 @@ class JurisdictionPodcast(JurisdictionFeed):
         """
         Returns a list of items to publish in this feed.
         """
-        solr = ExtraSolrInterface(settings.SOLR_AUDIO_URL, mode='r')
+        solr = get_solr_interface(settings.SOLR_AUDIO_URL, mode='r')
         params = {
             'q': '*',
             'fq': 'court_exact:%s' % obj.pk,
@@ -83,7 +83,7 @@ class AllJurisdictionsPodcast(JurisdictionPodcast):
         return None
 
     def items(self, obj):
-        solr = ExtraSolrInterface(settings.SOLR_AUDIO_URL, mode='r')
+        solr = get_solr_interface(settings.SOLR_AUDIO_URL, mode='r')
         params = {
             'q': '*',
             'sort': 'dateArgued desc',
@@ -104,7 +104,7 @@ class SearchPodcast(JurisdictionPodcast):
         search_form = SearchForm(obj.GET)
         if search_form.is_valid():
             cd = search_form.cleaned_data
-            solr = ExtraSolrInterface(settings.SOLR_AUDIO_URL, mode='r')
+            solr = get_solr_interface(settings.SOLR_AUDIO_URL, mode='r')
             main_params = search_utils.build_main_query(cd, highlight=False,
                                                         facet=False)
             main_params.update({
@@ -2,13 +2,12 @@ import json
 
 from django.urls import reverse, NoReverseMatch
 from django.db import models
-from django.template import loader
 
 from cl.custom_filters.templatetags.text_filters import best_case_name
 from cl.lib.date_time import midnight_pst
 from cl.lib.model_helpers import make_upload_path
-from cl.lib.search_index_utils import InvalidDocumentError, null_map, \
-    normalize_search_dicts
+from cl.lib.search_index_utils import InvalidDocumentError, \
+    get_audio_text, normalize_search_dicts
 from cl.lib.storage import IncrementingFileSystemStorage
 from cl.lib.utils import deepgetattr
 from cl.people_db.models import Person
@@ -188,8 +187,8 @@ class Audio(models.Model):
         """
         super(Audio, self).save(*args, **kwargs)
         if index:
-            from cl.search.tasks import add_items_to_solr
-            add_items_to_solr([self.pk], 'audio.Audio', force_commit)
+            from cl.search.outbox import index_items
+            index_items([self.pk], 'audio.Audio', force_commit)
 
     def delete(self, *args, **kwargs):
         """
@@ -246,8 +245,7 @@ class Audio(models.Model):
                 % self.pk
             )
 
-        text_template = loader.get_template('indexes/audio_text.txt')
-        out['text'] = text_template.render({'item': self}).translate(null_map)
+        out['text'] = get_audio_text(self)
 
         return normalize_search_dicts(out)
 
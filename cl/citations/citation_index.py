@@ -0,0 +1,316 @@
+# coding=utf-8
+"""A compact, local index of the citations in the database.
+
+The index maps each citation (volume, reporter, page) to the opinions that
+have it, along with the few fields that are needed to pick the right one: the
+cluster, the date filed, the court and the precedential status. It lets the
+citator resolve most citations without sending a query to Solr.
+
+The index is stored as a directory of sorted numpy arrays, one per column,
+which are memory-mapped when they are loaded. Rows are sorted by a 64-bit hash
+of the normalized citation string, so a lookup is a binary search.
+"""
+import hashlib
+import json
+import os
+import shutil
+import struct
+from collections import namedtuple
+from datetime import date
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Max
+from django.utils.timezone import now
+from dateutil import parser
+
+from cl.citations.match_citations import normalize_citation_string
+from cl.lib.command_utils import logger
+from cl.search.models import Citation, DOCUMENT_STATUSES, OpinionCluster
+
+# The columns of the index, and the numpy type of each.
+COLUMNS = (
+    ('keys', np.int64),
+    ('opinion_ids', np.int64),
+    ('cluster_ids', np.int64),
+    ('date_filed', np.int32),
+    ('courts', np.int16),
+    ('statuses', np.int8),
+)
+
+META_FILE = 'meta.json'
+
+IndexEntry = namedtuple('IndexEntry', [
+    'opinion_id', 'cluster_id', 'date_filed', 'court_id',
+    'precedential_status',
+])
+
+
+def make_key(volume, reporter, page):
+    """Make the 64-bit key for a citation.
+
+    Collisions are possible in theory, but with a few tens of millions of
+    citations, they are vanishingly unlikely.
+    """
+    s = normalize_citation_string(u'%s %s %s' % (volume, reporter, page))
+    return struct.unpack('<q', hashlib.md5(s.encode('utf-8')).digest()[:8])[0]
+
+
+class CitationIndex(object):
+    """The citation index, either in memory or memory-mapped from disk."""
+
+    def __init__(self, columns=None, courts=None, built_at=None,
+                 max_citation_id=0):
+        """Create an index.
+
+        :param columns: A dict mapping each name in COLUMNS to a numpy array,
+        all of them sorted by the keys column. If None, the index is empty.
+        :param courts: A list of court IDs. The courts column holds indexes
+        into this list.
+        :param built_at: When the data in the index was pulled from the
+        database.
+        :param max_citation_id: The highest Citation ID in the index. Used to
+        find new citations when the index is refreshed.
+        """
+        if columns is None:
+            columns = {name: np.array([], dtype=dtype) for name, dtype in
+                       COLUMNS}
+        self.columns = columns
+        self.courts = courts or []
+        self.built_at = built_at
+        self.max_citation_id = max_citation_id
+        # Blank is used for items without a precedential status.
+        self.statuses = [s[0] for s in DOCUMENT_STATUSES] + ['']
+
+    def __len__(self):
+        return len(self.columns['keys'])
+
+    def lookup(self, volume, reporter, page):
+        """Get the entries for a citation.
+
+        :return: A list of IndexEntry objects, one per opinion that has the
+        citation.
+        """
+        keys = self.columns['keys']
+        key = make_key(volume, reporter, page)
+        start = np.searchsorted(keys, key, side='left')
+        end = np.searchsorted(keys, key, side='right')
+        entries = []
+        for i in xrange(start, end):
+            date_filed = int(self.columns['date_filed'][i])
+            entries.append(IndexEntry(
+                opinion_id=int(self.columns['opinion_ids'][i]),
+                cluster_id=int(self.columns['cluster_ids'][i]),
+                date_filed=date.fromordinal(date_filed) if date_filed else
+                None,
+                court_id=self.courts[self.columns['courts'][i]],
+                precedential_status=self.statuses[
+                    self.columns['statuses'][i]],
+            ))
+        return entries
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load an index from a directory.
+
+        :param path: The directory the index was saved in.
+        :param mmap: Whether to memory-map the arrays instead of reading them
+        into memory.
+        """
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        columns = {}
+        for name, _ in COLUMNS:
+            columns[name] = np.load(os.path.join(path, '%s.npy' % name),
+                                    mmap_mode='r' if mmap else None)
+        return cls(
+            columns=columns,
+            courts=meta['courts'],
+            built_at=parser.parse(meta['built_at']),
+            max_citation_id=meta['max_citation_id'],
+        )
+
+    def save(self, path):
+        """Save the index to a directory, replacing whatever is there.
+
+        The index is written to a temporary directory first, then moved into
+        place, so readers never see a partial index.
+        """
+        tmp_path = path.rstrip(os.sep) + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, dtype in COLUMNS:
+            np.save(os.path.join(tmp_path, '%s.npy' % name),
+                    np.asarray(self.columns[name], dtype=dtype))
+        with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+            json.dump({
+                'built_at': self.built_at.isoformat(),
+                'courts': self.courts,
+                'max_citation_id': self.max_citation_id,
+                'count': len(self),
+            }, f)
+
+        old_path = path.rstrip(os.sep) + '.old'
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+
+def get_index_rows(citation_qs):
+    """Pull the rows for the index out of the database.
+
+    :param citation_qs: A queryset of search.Citation objects to index.
+    :return: An iterator of (key, opinion_id, cluster_id, date_filed ordinal,
+    court_id, precedential_status) tuples.
+    """
+    rows = citation_qs.values_list(
+        'volume', 'reporter', 'page', 'cluster__sub_opinions__pk',
+        'cluster_id', 'cluster__date_filed', 'cluster__docket__court_id',
+        'cluster__precedential_status',
+    ).order_by().iterator()
+    for (volume, reporter, page, opinion_id, cluster_id, date_filed,
+         court_id, status) in rows:
+        if opinion_id is None:
+            # A cluster without any opinions. Nothing to cite.
+            continue
+        yield (make_key(volume, reporter, page), opinion_id, cluster_id,
+               date_filed.toordinal() if date_filed else 0, court_id, status)
+
+
+def make_columns(rows, courts, statuses, chunk_size=1000000):
+    """Convert rows into sorted columns.
+
+    :param rows: An iterable of rows, as returned by get_index_rows.
+    :param courts: A list of court IDs. New courts are appended to it.
+    :param statuses: A list of precedential statuses.
+    :param chunk_size: The number of rows to hold as Python objects before
+    converting them to numpy arrays.
+    :return: A dict of numpy arrays, sorted by key.
+    """
+    court_lookup = {court: i for i, court in enumerate(courts)}
+    status_lookup = {status: i for i, status in enumerate(statuses)}
+    unknown_status = status_lookup['']
+    chunks = {name: [] for name, _ in COLUMNS}
+
+    def flush(buf):
+        for j, (name, dtype) in enumerate(COLUMNS):
+            chunks[name].append(np.array([r[j] for r in buf], dtype=dtype))
+
+    buf = []
+    for key, opinion_id, cluster_id, date_filed, court_id, status in rows:
+        if court_id not in court_lookup:
+            court_lookup[court_id] = len(courts)
+            courts.append(court_id)
+        buf.append((key, opinion_id, cluster_id, date_filed,
+                    court_lookup[court_id],
+                    status_lookup.get(status, unknown_status)))
+        if len(buf) >= chunk_size:
+            flush(buf)
+            buf = []
+    flush(buf)
+
+    columns = {name: np.concatenate(chunks[name]) for name, _ in COLUMNS}
+    order = np.argsort(columns['keys'], kind='mergesort')
+    return {name: column[order] for name, column in columns.items()}
+
+
+def build_index(path=None):
+    """Build the citation index from scratch and save it.
+
+    :param path: The directory to save the index in. Defaults to
+    settings.CITATION_INDEX_DIR.
+    :return: The new CitationIndex
+    """
+    path = path or settings.CITATION_INDEX_DIR
+    built_at = now()
+    max_citation_id = (Citation.objects.aggregate(Max('pk'))['pk__max'] or 0)
+    index = CitationIndex(built_at=built_at, max_citation_id=max_citation_id)
+    index.columns = make_columns(
+        get_index_rows(Citation.objects.filter(pk__lte=max_citation_id)),
+        index.courts,
+        index.statuses,
+    )
+    index.save(path)
+    logger.info("Built citation index with %s entries at %s", len(index),
+                path)
+    return index
+
+
+def refresh_index(path=None):
+    """Update a saved citation index with the changes made since it was
+    built.
+
+    Clusters that have been modified since the index was built are re-read
+    from the database, as are clusters that have new citations. Deleted items
+    are not detected, so the index should still be rebuilt from time to time.
+
+    :param path: The directory the index is saved in. Defaults to
+    settings.CITATION_INDEX_DIR.
+    :return: The refreshed CitationIndex
+    """
+    path = path or settings.CITATION_INDEX_DIR
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        logger.info("No citation index found at %s. Building one.", path)
+        return build_index(path)
+
+    old = CitationIndex.load(path, mmap=False)
+    built_at = now()
+    max_citation_id = (Citation.objects.aggregate(Max('pk'))['pk__max'] or 0)
+    modified_cluster_ids = set(OpinionCluster.objects.filter(
+        date_modified__gte=old.built_at,
+    ).values_list('pk', flat=True))
+    modified_cluster_ids.update(Citation.objects.filter(
+        pk__gt=old.max_citation_id,
+        pk__lte=max_citation_id,
+    ).values_list('cluster_id', flat=True))
+    logger.info("Refreshing %s clusters in the citation index.",
+                len(modified_cluster_ids))
+
+    # Drop the old rows for the modified clusters, then add them back from
+    # the database.
+    keep = ~np.in1d(old.columns['cluster_ids'],
+                    np.fromiter(modified_cluster_ids, dtype=np.int64))
+    new_columns = make_columns(
+        get_index_rows(Citation.objects.filter(
+            cluster_id__in=modified_cluster_ids,
+            pk__lte=max_citation_id,
+        )),
+        old.courts,
+        old.statuses,
+    )
+    columns = {}
+    for name, _ in COLUMNS:
+        columns[name] = np.concatenate([old.columns[name][keep],
+                                        new_columns[name]])
+    order = np.argsort(columns['keys'], kind='mergesort')
+    index = CitationIndex(
+        columns={name: column[order] for name, column in columns.items()},
+        courts=old.courts,
+        built_at=built_at,
+        max_citation_id=max_citation_id,
+    )
+    index.save(path)
+    logger.info("Refreshed citation index. It now has %s entries.",
+                len(index))
+    return index
+
+
+_loaded_index = {}
+
+
+def get_citation_index(path=None):
+    """Get the saved citation index, loading it once per process.
+
+    The index is reloaded if it has been rebuilt since it was loaded.
+    """
+    path = path or settings.CITATION_INDEX_DIR
+    meta_path = os.path.join(path, META_FILE)
+    mtime = os.path.getmtime(meta_path)
+    cached = _loaded_index.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, CitationIndex.load(path))
+        _loaded_index[path] = cached
+    return cached[1]
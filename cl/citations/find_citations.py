@@ -8,6 +8,7 @@ from juriscraper.lib.html_utils import get_visible_text
 from reporters_db import EDITIONS, REPORTERS, VARIATIONS_ONLY
 
 from cl.citations import reporter_tokenizer
+from cl.lib.decorators import lru_cache
 from cl.lib.roman import isroman
 from cl.search.models import Citation as ModelCitation
 from cl.search.models import Court
@@ -34,7 +35,21 @@ else:
 class Citation(object):
     """Convenience class which represents a single citation found in a
     document.
+
+    Many millions of these get made when the corpus is reprocessed, so the
+    class uses __slots__ instead of an instance __dict__.
     """
+    __slots__ = (
+        'reporter', 'volume', 'page', 'canonical_reporter', 'lookup_index',
+        'extra', 'defendant', 'plaintiff', 'court', 'year', 'reporter_found',
+        'reporter_index', 'match_url', 'match_id',
+    )
+
+    # The attributes used by fuzzy_hash and fuzzy_eq.
+    equality_attributes = (
+        'reporter', 'volume', 'page', 'canonical_reporter', 'lookup_index',
+    )
+
     def __init__(self, reporter, page, volume, canonical_reporter=None,
                  lookup_index=None, extra=None, defendant=None, plaintiff=None,
                  court=None, year=None, match_url=None, match_id=None,
@@ -71,9 +86,16 @@ class Citation(object):
         self.match_url = match_url
         self.match_id = match_id
 
-        self.equality_attributes = [
-            'reporter', 'volume', 'page', 'canonical_reporter', 'lookup_index',
-        ]
+    def as_dict(self):
+        """Get the attributes of the citation as a dict."""
+        return {attr: getattr(self, attr) for attr in self.__slots__}
+
+    def __getstate__(self):
+        return self.as_dict()
+
+    def __setstate__(self, state):
+        for attr, value in state.items():
+            setattr(self, attr, value)
 
     def base_citation(self):
         return u"%d %s %s" % (self.volume, self.reporter, self.page)
@@ -90,10 +112,10 @@ class Citation(object):
         # Uses reporter_found so that we don't update the text. This guards us
         # against accidentally updating things like docket number 22 Cr. 1 as
         # 22 Cranch 1, which is totally wrong.
-        template = u'<span class="volume">%(volume)d</span>\\1' \
-                   u'<span class="reporter">%(reporter)s</span>\\2' \
-                   u'<span class="page">%(page)s</span>'
-        inner_html = template % self.__dict__
+        template = u'<span class="volume">%d</span>\\1' \
+                   u'<span class="reporter">%s</span>\\2' \
+                   u'<span class="page">%s</span>'
+        inner_html = template % (self.volume, self.reporter, self.page)
         span_class = "citation"
         if self.match_url:
             inner_html = u'<a href="%s">%s</a>' % (self.match_url, inner_html)
@@ -132,7 +154,7 @@ class Citation(object):
         # in the models.
         c = ModelCitation(**{
             key: value for key, value in
-            self.__dict__.items() if
+            self.as_dict().items() if
             key in ModelCitation._meta.get_all_field_names()
         })
         c.type = self._get_cite_type()
@@ -158,7 +180,10 @@ class Citation(object):
         return print_string.encode("utf-8")
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, Citation):
+            return False
+        return all(getattr(self, attr) == getattr(other, attr) for attr in
+                   self.__slots__)
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -393,6 +418,124 @@ def is_date_in_reporter(editions, year):
     return False
 
 
+def resolve_reporter_by_year(reporter, year):
+    """Work out the canonical form of a reporter string, using the year of
+    the citation if it's needed.
+
+    This holds the rules that disambiguate_reporters applies to each
+    citation. It depends only on its arguments, so its results can be
+    precomputed or cached.
+
+    :param reporter: The reporter string, as found in the text.
+    :param year: The year of the citation, or None.
+    :return: A tuple of (reporter, canonical_reporter, lookup_index) or None
+    if the reporter cannot be disambiguated.
+    """
+    # Non-variant items (P.R.R., A.2d, Wash., etc.)
+    if REPORTERS.get(EDITIONS.get(reporter)) is not None:
+        canonical_reporter = EDITIONS[reporter]
+        if len(REPORTERS[canonical_reporter]) == 1:
+            # Single reporter, easy-peasy.
+            return reporter, canonical_reporter, 0
+        # Multiple books under this key, but which is correct?
+        if year:
+            # attempt resolution by date
+            possible_indexes = [
+                i for i, book in enumerate(REPORTERS[canonical_reporter])
+                if is_date_in_reporter(book['editions'], year)
+            ]
+            if len(possible_indexes) == 1:
+                # We were able to identify only one hit after filtering by
+                # year.
+                return reporter, canonical_reporter, possible_indexes[0]
+        return None
+
+    # Try doing a variation of an edition.
+    variations = VARIATIONS_ONLY.get(reporter)
+    if variations is None:
+        return None
+    if len(variations) == 1:
+        # Only one variation -- great, use it.
+        canonical_reporter = EDITIONS[variations[0]]
+        books = REPORTERS[canonical_reporter]
+        if len(books) == 1:
+            # It's a single reporter under a misspelled key.
+            return variations[0], canonical_reporter, 0
+        # Multiple reporters under a single misspelled key
+        # (e.g. Wn.2d --> Wash --> Va Reports, Wash or Washington Reports).
+        if year:
+            # attempt resolution by date
+            possible_indexes = [i for i, book in enumerate(books) if
+                                is_date_in_reporter(book['editions'], year)]
+            if len(possible_indexes) == 1:
+                # We were able to identify only one hit after filtering by
+                # year.
+                return variations[0], canonical_reporter, possible_indexes[0]
+        # Attempt resolution by unique variation (e.g. Cr. can only be
+        # Cranch[0])
+        possible_indexes = [i for i, book in enumerate(books) for
+                            variation in book['variations'] if
+                            variation == reporter]
+        if len(possible_indexes) == 1:
+            # We were able to find a single match after filtering by
+            # variation.
+            return variations[0], canonical_reporter, possible_indexes[0]
+        return None
+
+    # Multiple variations, deal with them.
+    possible_citations = []
+    for reporter_key in variations:
+        for i, book in enumerate(REPORTERS[EDITIONS[reporter_key]]):
+            # This inner loop works regardless of the number of reporters
+            # under the key.
+            if is_date_in_reporter(book['editions'], year):
+                possible_citations.append((reporter_key, i))
+    if len(possible_citations) == 1:
+        # We were able to identify only one hit after filtering by year.
+        reporter_key, i = possible_citations[0]
+        return reporter_key, EDITIONS[reporter_key], i
+    return None
+
+
+def needs_year(reporter):
+    """Whether resolve_reporter_by_year can give different answers for a
+    reporter depending on the year.
+    """
+    canonical_reporter = EDITIONS.get(reporter)
+    if REPORTERS.get(canonical_reporter) is not None:
+        return len(REPORTERS[canonical_reporter]) > 1
+    variations = VARIATIONS_ONLY.get(reporter)
+    if variations is None:
+        return False
+    if len(variations) == 1:
+        return len(REPORTERS[EDITIONS[variations[0]]]) > 1
+    return True
+
+
+# The resolution of every reporter that can be resolved without a year,
+# computed once. The rest go through the cache below.
+REPORTER_RESOLUTIONS = {
+    reporter: resolve_reporter_by_year(reporter, None) for reporter in
+    reporter_tokenizer.REPORTER_STRINGS if not needs_year(reporter)
+}
+
+_resolve_reporter_by_year_cached = lru_cache(maxsize=4096)(
+    resolve_reporter_by_year)
+
+
+def resolve_reporter(reporter, year=None):
+    """Get the (reporter, canonical_reporter, lookup_index) tuple for a
+    reporter string, or None if it cannot be disambiguated.
+
+    Uses the precomputed table where the year doesn't matter, and a cache
+    where it does.
+    """
+    try:
+        return REPORTER_RESOLUTIONS[reporter]
+    except KeyError:
+        return _resolve_reporter_by_year_cached(reporter, year)
+
+
 def disambiguate_reporters(citations):
     """Convert a list of citations to a list of unambiguous ones.
 
@@ -415,94 +558,16 @@ def disambiguate_reporters(citations):
     For variants, we just need to sort out the canonical_reporter.
 
     If it's not possible to disambiguate the reporter, we simply have to drop
-    it.
+    it. See resolve_reporter_by_year for the rules.
     """
     unambiguous_citations = []
     for citation in citations:
-        # Non-variant items (P.R.R., A.2d, Wash., etc.)
-        if REPORTERS.get(EDITIONS.get(citation.reporter)) is not None:
-            citation.canonical_reporter = EDITIONS[citation.reporter]
-            if len(REPORTERS[EDITIONS[citation.reporter]]) == 1:
-                # Single reporter, easy-peasy.
-                citation.lookup_index = 0
-                unambiguous_citations.append(citation)
-                continue
-            else:
-                # Multiple books under this key, but which is correct?
-                if citation.year:
-                    # attempt resolution by date
-                    possible_citations = []
-                    for i in range(0, len(REPORTERS[EDITIONS[citation.reporter]])):
-                        if is_date_in_reporter(REPORTERS[EDITIONS[citation.reporter]][i]['editions'], citation.year):
-                            possible_citations.append((citation.reporter, i,))
-                    if len(possible_citations) == 1:
-                        # We were able to identify only one hit after filtering
-                        # by year.
-                        citation.reporter = possible_citations[0][0]
-                        citation.lookup_index = possible_citations[0][1]
-                        unambiguous_citations.append(citation)
-                        continue
-
-        # Try doing a variation of an edition.
-        elif VARIATIONS_ONLY.get(citation.reporter) is not None:
-            if len(VARIATIONS_ONLY[citation.reporter]) == 1:
-                # Only one variation -- great, use it.
-                citation.canonical_reporter = EDITIONS[VARIATIONS_ONLY[citation.reporter][0]]
-                cached_variation = citation.reporter
-                citation.reporter = VARIATIONS_ONLY[citation.reporter][0]
-                if len(REPORTERS[citation.canonical_reporter]) == 1:
-                    # It's a single reporter under a misspelled key.
-                    citation.lookup_index = 0
-                    unambiguous_citations.append(citation)
-                    continue
-                else:
-                    # Multiple reporters under a single misspelled key
-                    # (e.g. Wn.2d --> Wash --> Va Reports, Wash or
-                    #                          Washington Reports).
-                    if citation.year:
-                        # attempt resolution by date
-                        possible_citations = []
-                        for i in range(0, len(REPORTERS[citation.canonical_reporter])):
-                            if is_date_in_reporter(REPORTERS[citation.canonical_reporter][i]['editions'],
-                                                   citation.year):
-                                possible_citations.append((citation.reporter, i))
-                        if len(possible_citations) == 1:
-                            # We were able to identify only one hit after
-                            # filtering by year.
-                            citation.lookup_index = possible_citations[0][1]
-                            unambiguous_citations.append(citation)
-                            continue
-                    # Attempt resolution by unique variation (e.g. Cr. can only
-                    # be Cranch[0])
-                    possible_citations = []
-                    for i in range(0, len(REPORTERS[citation.canonical_reporter])):
-                        for variation in REPORTERS[citation.canonical_reporter][i]['variations'].items():
-                            if variation[0] == cached_variation:
-                                possible_citations.append((variation[1], i))
-                    if len(possible_citations) == 1:
-                        # We were able to find a single match after filtering
-                        # by variation.
-                        citation.lookup_index = possible_citations[0][1]
-                        unambiguous_citations.append(citation)
-                        continue
-            else:
-                # Multiple variations, deal with them.
-                possible_citations = []
-                for reporter_key in VARIATIONS_ONLY[citation.reporter]:
-                    for i in range(0, len(REPORTERS[EDITIONS[reporter_key]])):
-                        # This inner loop works regardless of the number of
-                        # reporters under the key.
-                        if is_date_in_reporter(REPORTERS[EDITIONS[reporter_key]][i]['editions'], citation.year):
-                            possible_citations.append((reporter_key, i,))
-                if len(possible_citations) == 1:
-                    # We were able to identify only one hit after filtering by
-                    # year.
-                    citation.canonical_reporter = EDITIONS[possible_citations[0][0]]
-                    citation.reporter = possible_citations[0][0]
-                    citation.lookup_index = possible_citations[0][1]
-                    unambiguous_citations.append(citation)
-                    continue
-
+        resolution = resolve_reporter(citation.reporter, citation.year)
+        if resolution is None:
+            continue
+        (citation.reporter, citation.canonical_reporter,
+         citation.lookup_index) = resolution
+        unambiguous_citations.append(citation)
     return unambiguous_citations
 
 
@@ -510,22 +575,18 @@ def get_citations(text, html=True, do_post_citation=True, do_defendant=True,
                   disambiguate=True):
     if html:
         text = get_visible_text(text)
-    words = reporter_tokenizer.tokenize(text)
+    words, candidates = reporter_tokenizer.scan(text)
     citations = []
-    # Exclude first and last tokens when looking for reporters, because valid
-    # citations must have a volume before and a page after the reporter.
-    for i in xrange(1, len(words) - 1):
-        # Find reporter
-        if words[i] in (EDITIONS.keys() + VARIATIONS_ONLY.keys()):
-            citation = extract_base_citation(words, i)
-            if citation is None:
-                # Not a valid citation; continue looking
-                continue
-            if do_post_citation:
-                add_post_citation(citation, words)
-            if do_defendant:
-                add_defendant(citation, words)
-            citations.append(citation)
+    for _, _, _, reporter_index in candidates:
+        citation = extract_base_citation(words, reporter_index)
+        if citation is None:
+            # Not a valid citation; continue looking
+            continue
+        if do_post_citation:
+            add_post_citation(citation, words)
+        if do_defendant:
+            add_defendant(citation, words)
+        citations.append(citation)
 
     if disambiguate:
         # Disambiguate or drop all the reporters
@@ -2,7 +2,7 @@ import pandas as pd
 
 from cl.lib.command_utils import VerboseCommand, logger
 from cl.search.models import OpinionsCited, Opinion
-from cl.search.tasks import add_items_to_solr
+from cl.search.outbox import index_items
 
 
 def load_csv(csv_location):
@@ -47,7 +47,7 @@ def process_citations(data, debug):
 
     logger.info("\nUpdating Solr...")
     if not debug:
-        add_items_to_solr(updated_ids, 'search.Opinion')
+        index_items(updated_ids, 'search.Opinion', reason='citation')
     logger.info("Done.")
 
 
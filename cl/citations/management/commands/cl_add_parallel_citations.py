@@ -1,6 +1,14 @@
 # coding=utf-8
-import networkx as nx
+import hashlib
+import json
+import os
+import shutil
+import struct
 import sys
+import tempfile
+
+import networkx as nx
+import numpy as np
 
 from celery.canvas import group
 from django.conf import settings
@@ -9,18 +17,26 @@ from django.db import IntegrityError
 
 from cl.citations.find_citations import Citation
 from cl.citations.match_citations import get_years_from_reporter, \
-    build_date_range
+    build_date_range, BATCH_SIZE, is_batch_candidate, \
+    normalize_citation_string, query_citations_in_batch
 from cl.citations.tasks import get_document_citations, \
     identify_parallel_citations
 from cl.lib.command_utils import VerboseCommand, logger
 from cl.lib.db_tools import queryset_generator
-from cl.lib.sunburnt import sunburnt
+from cl.lib.scorched_utils import get_solr_interface
 from cl.search.models import Opinion, OpinionCluster
 
 # Parallel citations need to be identified this many times before they should be
 # added to the database.
 EDGE_RELEVANCE_THRESHOLD = 20
 
+# The number of edges to read from disk at a time in streaming mode.
+EDGE_CHUNK_SIZE = 5 * 10 ** 6
+
+# The number of new node keys to hold in a set before merging them into the
+# sorted array of keys in streaming mode.
+NODE_BUFFER_SIZE = 10 ** 5
+
 
 def make_edge_list(group):
     """Convert a list of parallel citations into a list of tuples.
@@ -39,6 +55,191 @@ def make_edge_list(group):
     return out
 
 
+def node_key(citation):
+    """Make a 64-bit key for a citation that is the same for all citations
+    that are fuzzy-equal to it (see Citation.fuzzy_eq).
+    """
+    s = u'\t'.join(unicode(getattr(citation, attr)) for attr in
+                   Citation.equality_attributes)
+    return struct.unpack('<q', hashlib.md5(s.encode('utf-8')).digest()[:8])[0]
+
+
+class EdgeList(object):
+    """An on-disk list of parallel citation edges.
+
+    Two files are written to the work directory. The edge file holds a pair
+    of int64 node keys for every edge that is found, in the order they're
+    found (so an edge that's found twice is in the file twice). The node file
+    holds a line of JSON for each node, so that the Citation objects can be
+    rebuilt later on.
+
+    So that each node is only written once, the keys of the nodes that have
+    been written are kept in memory, as a sorted int64 array, with new keys
+    buffered in a small set until there are NODE_BUFFER_SIZE of them. That
+    costs eight bytes a node, which is what the array of nodes that phase two
+    builds from the edges costs anyway.
+    """
+    EDGE_FILE = 'edges.bin'
+    NODE_FILE = 'nodes.jsonl'
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.edge_path = os.path.join(work_dir, self.EDGE_FILE)
+        self.node_path = os.path.join(work_dir, self.NODE_FILE)
+        self.edge_file = open(self.edge_path, 'wb')
+        self.node_file = open(self.node_path, 'w')
+        self.edge_count = 0
+        self.node_keys = np.empty(0, dtype=np.int64)
+        self.new_keys = set()
+
+    def add_groups(self, citation_groups):
+        """Write the edges from the citation groups of one opinion to disk.
+
+        Follows the same rules as Command.add_groups_to_network.
+        """
+        edges = []
+        nodes = {}
+        for group in citation_groups:
+            for edge in make_edge_list(group):
+                if any(e for e in edge if e.reporter_found in ['Id.', 'Cr.']):
+                    # See add_groups_to_network.
+                    break
+                keys = [node_key(c) for c in edge]
+                for key, citation in zip(keys, edge):
+                    nodes.setdefault(key, citation)
+                # Edges are undirected, so store them in a consistent order.
+                edges.append(sorted(keys))
+            else:
+                continue
+            break
+
+        if edges:
+            np.array(edges, dtype=np.int64).tofile(self.edge_file)
+            self.edge_count += len(edges)
+        for key, citation in nodes.items():
+            if self.has_node(key):
+                continue
+            self.new_keys.add(key)
+            self.node_file.write('%d\t%s\n' % (
+                key, json.dumps(citation.as_dict())))
+        if len(self.new_keys) >= NODE_BUFFER_SIZE:
+            self.merge_new_keys()
+
+    def has_node(self, key):
+        """Whether a node has been written to the node file already."""
+        if key in self.new_keys:
+            return True
+        i = np.searchsorted(self.node_keys, key)
+        return i < len(self.node_keys) and self.node_keys[i] == key
+
+    def merge_new_keys(self):
+        """Move the buffered keys into the sorted array of keys."""
+        new_keys = np.fromiter(self.new_keys, dtype=np.int64,
+                               count=len(self.new_keys))
+        self.node_keys = np.union1d(self.node_keys, new_keys)
+        self.new_keys = set()
+
+    @property
+    def node_count(self):
+        return len(self.node_keys) + len(self.new_keys)
+
+    def close(self):
+        self.edge_file.close()
+        self.node_file.close()
+
+    def get_weighted_edges(self, chunk_size=EDGE_CHUNK_SIZE):
+        """Read the edge file and count how many times each edge was found.
+
+        The file is read a chunk at a time, and the counts of each chunk are
+        added to the counts so far, so only the unique edges and one chunk
+        are ever in memory.
+
+        :param chunk_size: The number of edges to read at a time.
+        :return: A tuple of an (n, 2) array of unique edges, sorted, and an
+        array of the weight of each edge.
+        """
+        edges = np.empty((0, 2), dtype=np.int64)
+        weights = np.empty(0, dtype=np.int64)
+        with open(self.edge_path, 'rb') as f:
+            while True:
+                chunk = np.fromfile(f, dtype=np.int64,
+                                    count=chunk_size * 2).reshape(-1, 2)
+                if len(chunk) == 0:
+                    break
+                edges, weights = count_edges(
+                    np.concatenate((edges, chunk)),
+                    np.concatenate((weights,
+                                    np.ones(len(chunk), dtype=np.int64))),
+                )
+        return edges, weights
+
+    def get_citations(self, keys):
+        """Rebuild the Citation objects for some of the nodes.
+
+        :param keys: A set of node keys.
+        :return: A dict mapping each key to a Citation, made from the first
+        time the node was written.
+        """
+        citations = {}
+        with open(self.node_path) as f:
+            for line in f:
+                key, attrs = line.split('\t', 1)
+                key = int(key)
+                if key in keys and key not in citations:
+                    citations[key] = Citation(**json.loads(attrs))
+        return citations
+
+
+def count_edges(edges, weights):
+    """Combine the duplicates in an array of edges, adding up their weights.
+
+    :param edges: An (n, 2) array of edges.
+    :param weights: An array with the weight of each edge.
+    :return: A tuple of an array of the unique edges, sorted, and an array of
+    their total weights.
+    """
+    order = np.lexsort((edges[:, 1], edges[:, 0]))
+    edges = edges[order]
+    weights = weights[order]
+    is_new = np.ones(len(edges), dtype=bool)
+    is_new[1:] = np.any(edges[1:] != edges[:-1], axis=1)
+    starts = np.flatnonzero(is_new)
+    return edges[starts], np.add.reduceat(weights, starts)
+
+
+def find_components(a, b, node_count):
+    """Find the connected components of a graph.
+
+    This is union-find done on whole arrays at a time: every root is hooked
+    onto the smallest root it shares an edge with, then pointer jumping
+    flattens the trees, until no edge joins two different roots. Memory use is
+    a few integers per node and edge.
+
+    :param a: An array with one endpoint of each edge, as node numbers.
+    :param b: An array with the other endpoint of each edge.
+    :param node_count: The number of nodes.
+    :return: An array with the component of each node. Each component is
+    labelled with the smallest node number in it.
+    """
+    labels = np.arange(node_count)
+    while True:
+        root_a = labels[a]
+        root_b = labels[b]
+        crossing = root_a != root_b
+        if not crossing.any():
+            return labels
+        root_a = root_a[crossing]
+        root_b = root_b[crossing]
+        low = np.minimum(root_a, root_b)
+        np.minimum.at(labels, root_a, low)
+        np.minimum.at(labels, root_b, low)
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+
 class Command(VerboseCommand):
     help = ('Parse the entire corpus, identifying parallel citations. Add them '
             'to the database if sufficiently accurate and requested by the '
@@ -47,7 +248,8 @@ class Command(VerboseCommand):
     def __init__(self, stdout=None, stderr=None, no_color=False):
         super(Command, self).__init__(stdout=None, stderr=None, no_color=False)
         self.g = nx.Graph()
-        self.conn = sunburnt.SolrInterface(settings.SOLR_OPINION_URL, mode='r')
+        self.conn = get_solr_interface(settings.SOLR_OPINION_URL, mode='r',
+                                       client='sunburnt')
         self.update_count = 0
 
     def add_arguments(self, parser):
@@ -75,6 +277,20 @@ class Command(VerboseCommand):
             nargs='*',
             help='ids of citing opinions',
         )
+        parser.add_argument(
+            '--streaming',
+            action='store_true',
+            default=False,
+            help="Write the citation network to disk instead of building it "
+                 "in memory. Use this to run across the full corpus without "
+                 "a huge amount of RAM.",
+        )
+        parser.add_argument(
+            '--work_dir',
+            help="The directory to write the network to in streaming mode. "
+                 "If not provided, a temporary directory is used, and "
+                 "deleted when the command is done.",
+        )
 
     def monkey_patch_citation(self):
         Citation.__eq__ = Citation.fuzzy_eq
@@ -136,14 +352,50 @@ class Command(VerboseCommand):
             if not has_good_edge:
                 sub_graph.remove_node(node)
 
-        if len(sub_graph.nodes()) == 0:
+        self.handle_nodes(sub_graph.nodes(), options)
+
+    def match_nodes(self, nodes):
+        """Look up all the nodes in a component with a few batched queries.
+
+        Uses the same filters as match_on_citation, but the citations have to
+        match exactly rather than by proximity.
+
+        :return: A list of (node, results) pairs.
+        """
+        base_citations = sorted({node.base_citation() for node in nodes})
+        docs_by_citation = {}
+        for i in xrange(0, len(base_citations), BATCH_SIZE):
+            docs_by_citation.update(query_citations_in_batch(
+                self.conn, base_citations[i:i + BATCH_SIZE]))
+        result_sets = []
+        for node in nodes:
+            key = normalize_citation_string(node.base_citation())
+            result_sets.append((node, [
+                doc for doc in docs_by_citation.get(key, []) if
+                is_batch_candidate(doc, node, None)
+            ]))
+        return result_sets
+
+    def handle_nodes(self, nodes, options, batch=False):
+        """Add the citations for a group of strongly connected nodes to the
+        database, if they can be matched to a cluster.
+
+        :param nodes: A list of Citation objects.
+        :param options: The options the command was called with.
+        :param batch: Whether to look up the nodes with batched queries
+        (match_nodes) or one at a time (match_on_citation).
+        """
+        if len(nodes) == 0:
             logger.info("  No strong edges found. Pass.\n")
             return
 
         # Look up all remaining nodes in Solr, and make a (node, results) pair.
-        result_sets = []
-        for node in sub_graph.nodes():
-            result_sets.append((node, self.match_on_citation(node)))
+        if batch:
+            result_sets = self.match_nodes(nodes)
+        else:
+            result_sets = []
+            for node in nodes:
+                result_sets.append((node, self.match_on_citation(node)))
 
         if sum(len(results) for node, results in result_sets) == 0:
             logger.info("  Got no results for any citation. Pass.\n")
@@ -218,6 +470,92 @@ class Command(VerboseCommand):
                 else:
                     self.g.add_edge(*edge, weight=1)
 
+    def handle_edge_list(self, edge_list, options):
+        """Find the connected components in an on-disk edge list, and handle
+        each of them as handle_subgraph does.
+        """
+        edges, weights = edge_list.get_weighted_edges()
+        if len(edges) == 0:
+            return
+        node_keys = np.unique(edges)
+        a = np.searchsorted(node_keys, edges[:, 0])
+        b = np.searchsorted(node_keys, edges[:, 1])
+        components = find_components(a, b, len(node_keys))
+
+        # Only nodes with a strong edge are kept.
+        strong = np.zeros(len(node_keys), dtype=bool)
+        is_strong_edge = weights > EDGE_RELEVANCE_THRESHOLD
+        strong[a[is_strong_edge]] = True
+        strong[b[is_strong_edge]] = True
+        logger.info("Found %s unique edges between %s nodes. %s nodes have "
+                    "strong edges.\n", len(edges), len(node_keys),
+                    strong.sum())
+        strong_nodes = np.flatnonzero(strong)
+        citations = edge_list.get_citations(
+            set(node_keys[strong_nodes].tolist()))
+
+        # Go through the components one at a time.
+        strong_nodes = strong_nodes[np.argsort(components[strong_nodes],
+                                               kind='mergesort')]
+        strong_components = components[strong_nodes]
+        boundaries = np.flatnonzero(np.diff(strong_components)) + 1
+        for component in np.split(strong_nodes, boundaries):
+            nodes = [citations[key] for key in node_keys[component].tolist()]
+            self.handle_nodes(nodes, options, batch=True)
+
+    def build_network(self, add_groups, options, edge_list=None):
+        """Find the parallel citations in the opinions, and add them to the
+        network with add_groups.
+
+        :param add_groups: A function that takes the citation groups of an
+        opinion and adds them to the network.
+        :param options: The options the command was called with.
+        :param edge_list: The EdgeList, in streaming mode.
+        """
+        logger.info("## Entering phase one: Building a network object of "
+                    "all citations.\n")
+        q = Opinion.objects.all()
+        if options.get('doc_id'):
+            q = q.filter(pk__in=options['doc_id'])
+        count = q.count()
+        opinions = queryset_generator(q, chunksize=10000)
+
+        node_count = edge_count = completed = 0
+        subtasks = []
+        for o in opinions:
+            subtasks.append(
+                # This will call the second function with the results from the
+                # first.
+                get_document_citations.s(o) | identify_parallel_citations.s()
+            )
+            last_item = (count == completed + 1)
+            if (completed % 50 == 0) or last_item:
+                job = group(subtasks)
+                result = job.apply_async().join()
+                [add_groups(citation_groups) for citation_groups in result]
+                subtasks = []
+
+            completed += 1
+            if edge_list is not None:
+                node_count = edge_list.node_count
+                edge_count = edge_list.edge_count
+            elif completed % 250 == 0 or last_item:
+                # Only do this once in a while.
+                node_count = len(self.g.nodes())
+                edge_count = len(self.g.edges())
+            sys.stdout.write("\r  Completed %s of %s. (%s nodes, %s edges)" % (
+                completed,
+                count,
+                node_count,
+                edge_count,
+            ))
+            sys.stdout.flush()
+
+    @staticmethod
+    def log_phase_two():
+        logger.info("\n\n## Entering phase two: Saving the best edges to "
+                    "the database.\n\n")
+
     @staticmethod
     def do_solr(options):
         """Update Solr if requested, or report if not."""
@@ -266,47 +604,26 @@ class Command(VerboseCommand):
         # Update Citation object to consider similar objects equal.
         self.monkey_patch_citation()
 
-        logger.info("## Entering phase one: Building a network object of "
-                    "all citations.\n")
-        q = Opinion.objects.all()
-        if options.get('doc_id'):
-            q = q.filter(pk__in=options['doc_id'])
-        count = q.count()
-        opinions = queryset_generator(q, chunksize=10000)
-
-        node_count = edge_count = completed = 0
-        subtasks = []
-        for o in opinions:
-            subtasks.append(
-                # This will call the second function with the results from the
-                # first.
-                get_document_citations.s(o) | identify_parallel_citations.s()
-            )
-            last_item = (count == completed + 1)
-            if (completed % 50 == 0) or last_item:
-                job = group(subtasks)
-                result = job.apply_async().join()
-                [self.add_groups_to_network(citation_groups) for
-                 citation_groups in result]
-                subtasks = []
-
-            completed += 1
-            if completed % 250 == 0 or last_item:
-                # Only do this once in a while.
-                node_count = len(self.g.nodes())
-                edge_count = len(self.g.edges())
-            sys.stdout.write("\r  Completed %s of %s. (%s nodes, %s edges)" % (
-                completed,
-                count,
-                node_count,
-                edge_count,
-            ))
-            sys.stdout.flush()
-
-        logger.info("\n\n## Entering phase two: Saving the best edges to "
-                    "the database.\n\n")
-        for sub_graph in nx.connected_component_subgraphs(self.g):
-            self.handle_subgraph(sub_graph, options)
+        if options['streaming']:
+            work_dir = options['work_dir'] or tempfile.mkdtemp()
+            if not os.path.isdir(work_dir):
+                os.makedirs(work_dir)
+            edge_list = EdgeList(work_dir)
+            try:
+                self.build_network(edge_list.add_groups, options,
+                                   edge_list=edge_list)
+                edge_list.close()
+                self.log_phase_two()
+                self.handle_edge_list(edge_list, options)
+            finally:
+                edge_list.close()
+                if not options['work_dir']:
+                    shutil.rmtree(work_dir)
+        else:
+            self.build_network(self.add_groups_to_network, options)
+            self.log_phase_two()
+            for sub_graph in nx.connected_component_subgraphs(self.g):
+                self.handle_subgraph(sub_graph, options)
 
         logger.info("\n\n## Done. Added %s new citations." % self.update_count)
 
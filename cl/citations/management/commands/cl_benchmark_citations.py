@@ -0,0 +1,209 @@
+# coding=utf-8
+import sys
+import time
+
+from juriscraper.lib.html_utils import get_visible_text
+from reporters_db import EDITIONS, VARIATIONS_ONLY
+
+from cl.citations import reporter_tokenizer
+from cl.citations.find_citations import Citation, get_citations, \
+    resolve_reporter, resolve_reporter_by_year
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.search.models import Opinion
+
+
+def legacy_scan(text):
+    """Find reporters the way get_citations did before the reporter strings
+    were precomputed: by concatenating the reporter lists and doing a linear
+    search for every token.
+
+    Kept here only so that it can be benchmarked against the current code.
+    """
+    if reporter_tokenizer.DASHED_CITATION_RE.match(text):
+        words = text.split('-')
+    else:
+        words = []
+        for string in reporter_tokenizer.REPORTER_RE.split(text):
+            if string in EDITIONS.keys() + VARIATIONS_ONLY.keys():
+                words.append(string)
+            else:
+                words.extend(reporter_tokenizer._tokenize(string))
+    candidates = []
+    for i in xrange(1, len(words) - 1):
+        if words[i] in (EDITIONS.keys() + VARIATIONS_ONLY.keys()):
+            candidates.append((words[i - 1], words[i], words[i + 1], i))
+    return words, candidates
+
+
+def legacy_resolve(reporters):
+    """Disambiguate reporters the way disambiguate_reporters did before its
+    results were precomputed and cached: by running all of the rules for every
+    citation.
+
+    :param reporters: A list of (reporter, year) tuples.
+    """
+    return [resolve_reporter_by_year(reporter, year) for reporter, year in
+            reporters]
+
+
+def cached_resolve(reporters):
+    """Disambiguate reporters with the precomputed table and cache."""
+    return [resolve_reporter(reporter, year) for reporter, year in reporters]
+
+
+class LegacyCitation(object):
+    """An object with an instance __dict__, used to measure how much memory a
+    citation took before Citation used __slots__.
+    """
+    pass
+
+
+def legacy_citation_size(citation):
+    """Get the number of bytes a citation would use if it had an instance
+    __dict__ and its own list of equality attributes, as it used to.
+    """
+    legacy = LegacyCitation()
+    for attr in Citation.__slots__:
+        setattr(legacy, attr, getattr(citation, attr))
+    legacy.equality_attributes = list(Citation.equality_attributes)
+    return (sys.getsizeof(legacy) + sys.getsizeof(legacy.__dict__) +
+            sys.getsizeof(legacy.equality_attributes))
+
+
+def get_opinion_text(opinion):
+    """Get the visible text of an opinion, using the same field precedence as
+    get_document_citations.
+    """
+    html = opinion.html_columbia or opinion.html_lawbox or opinion.html
+    if html:
+        return get_visible_text(html)
+    return opinion.plain_text
+
+
+def time_function(f, texts, iterations):
+    """Run f over every text, iterations times, and return the results of the
+    last run along with the best run time in seconds.
+    """
+    best = None
+    results = None
+    for _ in range(iterations):
+        t1 = time.time()
+        results = [f(text) for text in texts]
+        elapsed = time.time() - t1
+        if best is None or elapsed < best:
+            best = elapsed
+    return results, best
+
+
+class Command(VerboseCommand):
+    help = ('Benchmark the citation extraction code against a fixed sample of '
+            'opinions.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--count',
+            type=int,
+            default=500,
+            help="The number of opinions to use as the sample. The sample is "
+                 "always the first opinions in the database, by ID, that have "
+                 "text, so that runs are comparable.",
+        )
+        parser.add_argument(
+            '--start_id',
+            type=int,
+            default=0,
+            help="The opinion ID where the sample should start (inclusive).",
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=3,
+            help="The number of times to run each benchmark. The best run is "
+                 "reported.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        texts = self.get_sample(options['start_id'], options['count'])
+        logger.info("Loaded a sample of %s opinions (%s characters).",
+                    len(texts), sum(len(t) for t in texts))
+        self.benchmark_tokenizer(texts, options['iterations'])
+        self.benchmark_disambiguation(texts, options['iterations'])
+        self.benchmark_memory(texts)
+
+    @staticmethod
+    def get_sample(start_id, count):
+        qs = (Opinion.objects
+              .filter(pk__gte=start_id)
+              .exclude(html_columbia='', html_lawbox='', html='',
+                       plain_text='')
+              .order_by('pk')
+              .only('html_columbia', 'html_lawbox', 'html', 'plain_text'))
+        return [get_opinion_text(o) for o in qs[:count]]
+
+    @staticmethod
+    def report(name, old_time, new_time, unit_count, unit_name):
+        logger.info(
+            "%s: old code took %.3fs (%.1f %s/s), new code took %.3fs "
+            "(%.1f %s/s). Speedup: %.1fx.",
+            name,
+            old_time, unit_count / (old_time or 1e-9), unit_name,
+            new_time, unit_count / (new_time or 1e-9), unit_name,
+            old_time / (new_time or 1e-9),
+        )
+
+    def benchmark_tokenizer(self, texts, iterations):
+        """Compare the precomputed reporter scanner with the old tokenizer and
+        linear reporter lookups.
+        """
+        old_results, old_time = time_function(legacy_scan, texts, iterations)
+        new_results, new_time = time_function(reporter_tokenizer.scan, texts,
+                                              iterations)
+        if old_results != new_results:
+            logger.warning("The old and new tokenizers produced different "
+                           "results on this sample!")
+        self.report('Tokenizer', old_time, new_time, len(texts), 'opinions')
+
+    def benchmark_disambiguation(self, texts, iterations):
+        """Compare the table-driven, cached reporter disambiguation with
+        running the rules for every citation.
+        """
+        reporters = [
+            [(c.reporter, c.year) for c in
+             get_citations(text, html=False, disambiguate=False)]
+            for text in texts
+        ]
+        citation_count = sum(len(r) for r in reporters)
+        old_results, old_time = time_function(legacy_resolve, reporters,
+                                              iterations)
+        new_results, new_time = time_function(cached_resolve, reporters,
+                                              iterations)
+        if old_results != new_results:
+            logger.warning("The old and new disambiguation code produced "
+                           "different results on this sample!")
+        self.report('Disambiguation', old_time, new_time, citation_count,
+                    'citations')
+
+    @staticmethod
+    def benchmark_memory(texts):
+        """Compare the memory used by the citations found in the sample with
+        the memory they would have used before Citation had __slots__.
+
+        Only the citation objects themselves are counted, not the strings and
+        numbers they point to, since those are the same either way.
+        """
+        citations = []
+        for text in texts:
+            citations.extend(get_citations(text, html=False))
+        old_bytes = sum(legacy_citation_size(c) for c in citations)
+        new_bytes = sum(sys.getsizeof(c) for c in citations)
+        count = len(citations) or 1
+        logger.info(
+            "Memory: %s citations took %s bytes (%.0f per citation) with an "
+            "instance __dict__, and %s bytes (%.0f per citation) with "
+            "__slots__. Savings: %.1fx.",
+            len(citations),
+            old_bytes, old_bytes / float(count),
+            new_bytes, new_bytes / float(count),
+            old_bytes / float(new_bytes or 1),
+        )
@@ -0,0 +1,34 @@
+# coding=utf-8
+from django.conf import settings
+
+from cl.citations.citation_index import build_index, refresh_index
+from cl.lib.command_utils import VerboseCommand
+
+
+class Command(VerboseCommand):
+    help = ('Build or refresh the local citation index that cl_find_citations '
+            'can use instead of querying Solr for every citation.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            type=str,
+            default=settings.CITATION_INDEX_DIR,
+            help="The directory where the index is stored.",
+        )
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            default=False,
+            help="Rebuild the index from scratch instead of refreshing it "
+                 "with the items that changed since it was last built. "
+                 "Refreshing does not notice deleted items, so this should "
+                 "be done from time to time.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        if options['rebuild']:
+            build_index(options['path'])
+        else:
+            refresh_index(options['path'])
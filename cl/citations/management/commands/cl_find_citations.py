@@ -1,16 +1,45 @@
 # coding=utf-8
+import multiprocessing
 import time
 import sys
+from collections import deque
 
-from cl.citations.tasks import find_citations_for_opinion_by_pks
-from cl.lib import sunburnt
+from cl.citations.tasks import find_citations_for_opinion_by_pks, \
+    get_document_citations, match_opinion_citations, store_citation_matches
 from cl.lib.argparse_types import valid_date_time
 from cl.lib.celery_utils import CeleryThrottle
-from cl.lib.command_utils import VerboseCommand
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.lib.db_tools import queryset_generator
+from cl.lib.scorched_utils import get_solr_interface
 from cl.search.models import Opinion
+from cl.search.outbox import index_items
 from django.conf import settings
 from django.core.management import call_command
 from django.core.management import CommandError
+from django.db import connections
+
+
+def extract_citations_for_pks(opinion_pks):
+    """Get the citations for a chunk of opinions. Runs in a worker process.
+
+    This is the CPU-bound part of the citator, so it's done in parallel. The
+    reporter tables are loaded when this module is imported, before the pool
+    is forked, so every worker shares the parent's copy.
+
+    :param opinion_pks: A list of search.Opinion PKs
+    :return: A tuple of a list of (opinion, citations) tuples and the number of
+    seconds the extraction took.
+    """
+    t1 = time.time()
+    opinions = Opinion.objects.filter(pk__in=opinion_pks)
+    citations_by_opinion = [(opinion, get_document_citations(opinion)) for
+                            opinion in opinions]
+    return citations_by_opinion, time.time() - t1
+
+
+def close_db_connections():
+    """Make sure processes don't share database connections across a fork."""
+    connections.close_all()
 
 
 class Command(VerboseCommand):
@@ -72,6 +101,26 @@ class Command(VerboseCommand):
                   "the opinions, it is thus generally wise to use "
                   "'concurrently'."),
         )
+        parser.add_argument(
+            '--resolver',
+            type=str,
+            default='solr',
+            choices=('solr', 'index'),
+            help="How to match citations to opinions. 'solr' queries Solr "
+                 "for every citation. 'index' uses the local citation index "
+                 "and only queries Solr for ambiguous citations. Build or "
+                 "refresh the index with cl_build_citation_index before "
+                 "using it.",
+        )
+
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=0,
+            help="Instead of sending the work to Celery, extract citations "
+                 "locally in this many processes, and save the results from "
+                 "this process in bulk. If 0, Celery is used.",
+        )
 
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
@@ -90,7 +139,9 @@ class Command(VerboseCommand):
                                'everything.')
 
         self.index = options['index']
-        self.si = sunburnt.SolrInterface(settings.SOLR_OPINION_URL, mode='rw')
+        self.resolver = options['resolver']
+        self.si = get_solr_interface(settings.SOLR_OPINION_URL, mode='rw',
+                                     client='sunburnt')
 
         # Use query chaining to build the query
         query = Opinion.objects.all()
@@ -109,8 +160,14 @@ class Command(VerboseCommand):
         self.average_per_s = 0
         self.timings = []
         count = query.count()
-        opinion_pks = query.values_list('pk', flat=True).iterator()
-        self.update_documents(opinion_pks, count)
+        if options['processes']:
+            opinion_pks = (row['id'] for row in
+                           queryset_generator(query.values('id')))
+            self.update_documents_locally(opinion_pks, count,
+                                          options['processes'])
+        else:
+            opinion_pks = query.values_list('pk', flat=True).iterator()
+            self.update_documents(opinion_pks, count)
         self.add_to_solr()
 
     def log_progress(self, processed_count, last_pk):
@@ -150,11 +207,111 @@ class Command(VerboseCommand):
             if processed_count % chunk_size == 0 or last_item:
                 throttle.maybe_wait()
                 find_citations_for_opinion_by_pks.delay(
-                    chunk, index_during_subtask)
+                    chunk, index_during_subtask, self.resolver)
                 chunk = []
 
             self.log_progress(processed_count, opinion_pk)
 
+    def update_documents_locally(self, opinion_pks, count, processes):
+        """Find citations in a local process pool.
+
+        The workers load the opinions and extract their citations. Their
+        results are funneled back to this process, which matches them and
+        writes them to the database in bulk, one chunk at a time. At most a
+        few chunks per worker are in flight at once, so a slow writer holds
+        the workers back instead of piling up results in memory.
+        """
+        sys.stdout.write('Graph size is {0:d} nodes.\n'.format(self.count))
+        sys.stdout.flush()
+        chunk_size = 100
+        max_in_flight = processes * 2
+        conn = get_solr_interface(settings.SOLR_OPINION_URL, mode='r',
+                                  client='sunburnt')
+        timings = {'extract': 0.0, 'match': 0.0, 'write': 0.0, 'index': 0.0}
+        processed_count = citation_count = 0
+        start_time = time.time()
+
+        def chunks():
+            chunk = []
+            for opinion_pk in opinion_pks:
+                chunk.append(opinion_pk)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        # Don't share the parent's database connection with the workers.
+        close_db_connections()
+        pool = multiprocessing.Pool(processes,
+                                    initializer=close_db_connections)
+        in_flight = deque()
+        chunk_iter = chunks()
+        try:
+            while True:
+                while len(in_flight) < max_in_flight:
+                    try:
+                        chunk = next(chunk_iter)
+                    except StopIteration:
+                        break
+                    in_flight.append(pool.apply_async(
+                        extract_citations_for_pks, (chunk,)))
+                if not in_flight:
+                    break
+
+                citations_by_opinion, extract_time = in_flight.popleft().get()
+                timings['extract'] += extract_time
+
+                t1 = time.time()
+                all_matches = match_opinion_citations(
+                    citations_by_opinion, self.resolver, conn=conn)
+                t2 = time.time()
+                cluster_ids, opinion_ids = store_citation_matches(
+                    citations_by_opinion, all_matches)
+                t3 = time.time()
+                if self.index == 'concurrently':
+                    if cluster_ids:
+                        index_items(cluster_ids, 'search.OpinionCluster',
+                                    reason='citation')
+                    if opinion_ids:
+                        index_items(opinion_ids, 'search.Opinion',
+                                    reason='citation')
+                t4 = time.time()
+                timings['match'] += t2 - t1
+                timings['write'] += t3 - t2
+                timings['index'] += t4 - t3
+
+                processed_count += len(citations_by_opinion)
+                citation_count += len(all_matches)
+                self.log_local_progress(processed_count, citation_count,
+                                        start_time)
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - start_time
+        logger.info(
+            "\nProcessed %s opinions and %s citations in %.1fs. Time spent "
+            "extracting (summed across %s processes): %.1fs, matching: "
+            "%.1fs, writing: %.1fs, indexing: %.1fs.",
+            processed_count, citation_count, elapsed, processes,
+            timings['extract'], timings['match'], timings['write'],
+            timings['index'],
+        )
+
+    def log_local_progress(self, processed_count, citation_count, start_time):
+        elapsed = (time.time() - start_time) or 1e-9
+        template = ("\rProcessing items locally: {:.0%} ({}/{}, {:.1f} "
+                    "opinions/s, {:.1f} citations/s)")
+        sys.stdout.write(template.format(
+            float(processed_count) / (self.count or 1),  # Percent
+            processed_count,
+            self.count,
+            processed_count / elapsed,
+            citation_count / elapsed,
+        ))
+        sys.stdout.flush()
+
     def add_to_solr(self):
         if self.index == 'all_at_end':
             call_command(
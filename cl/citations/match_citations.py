@@ -1,18 +1,32 @@
 #!/usr/bin/env python
 # encoding utf-8
 
+import re
+from collections import defaultdict
 from datetime import date, datetime
 
 from django.conf import settings
 from reporters_db import REPORTERS
 
 from cl.citations.find_citations import strip_punct
-from cl.lib import sunburnt
+from cl.lib.scorched_utils import get_solr_interface
 
 DEBUG = True
 
 QUERY_LENGTH = 10
 
+# The number of distinct citations to look up per query when matching in
+# batches. Each citation is a clause in the query, so this must stay well below
+# Solr's maxBooleanClauses setting.
+BATCH_SIZE = 100
+
+# The number of rows to request per page of a batched query.
+BATCH_ROWS = 500
+
+# The value precedential_status must have for an item to be citable. This is
+# the same thing as the 'status:Precedential' filter in Solr.
+PRECEDENTIAL = 'Published'
+
 
 def build_date_range(start_year, end_year):
     """Build a date range to be handed off to a solr query."""
@@ -92,15 +106,36 @@ def get_years_from_reporter(citation):
     return start_year, end_year
 
 
-def match_citation(citation, citing_doc=None):
+def get_date_bounds(citation, citing_doc=None):
+    """Get the range of years that a match for the citation must be filed in.
+
+    :param citation: A find_citations.Citation object
+    :param citing_doc: The search.Opinion doing the citing, if known.
+    :return: A tuple of (start_year, end_year)
+    """
+    if citation.year:
+        start_year = end_year = citation.year
+    else:
+        start_year, end_year = get_years_from_reporter(citation)
+        if citing_doc is not None and citing_doc.cluster.date_filed:
+            end_year = min(end_year, citing_doc.cluster.date_filed.year)
+    return start_year, end_year
+
+
+def match_citation(citation, citing_doc=None, conn=None):
     """For a citation object, try to match it to an item in the database using
     a variety of heuristics.
 
+    :param citation: A find_citations.Citation object
+    :param citing_doc: The search.Opinion doing the citing, if known.
+    :param conn: A sunburnt.SolrInterface to use for the queries. If None, a
+    new one is created.
     Returns:
       - a Solr Result object with the results, or an empty list if no hits
     """
-    # TODO: Create shared solr connection for all queries
-    conn = sunburnt.SolrInterface(settings.SOLR_OPINION_URL, mode='r')
+    if conn is None:
+        conn = get_solr_interface(settings.SOLR_OPINION_URL, mode='r',
+                                  client='sunburnt')
     main_params = {
         'q': '*',
         'fq': [
@@ -112,12 +147,7 @@ def match_citation(citation, citing_doc=None):
         # Eliminate self-cites.
         main_params['fq'].append('-id:%s' % citing_doc.pk)
     # Set up filter parameters
-    if citation.year:
-        start_year = end_year = citation.year
-    else:
-        start_year, end_year = get_years_from_reporter(citation)
-        if citing_doc is not None and citing_doc.cluster.date_filed:
-            end_year = min(end_year, citing_doc.cluster.date_filed.year)
+    start_year, end_year = get_date_bounds(citation, citing_doc)
     main_params['fq'].append(
         'dateFiled:%s' % build_date_range(start_year, end_year)
     )
@@ -140,3 +170,163 @@ def match_citation(citation, citing_doc=None):
 
     # Give up.
     return []
+
+
+def normalize_citation_string(s):
+    """Reduce a citation string to its lowercase word tokens, roughly as Solr
+    does when it indexes the citation field, so that phrase matches can be
+    replicated in Python.
+
+    For example, "1 U. S. 1" becomes "1 u s 1".
+    """
+    return u' '.join(re.findall(r'\w+', s.lower(), flags=re.UNICODE))
+
+
+def is_batch_candidate(doc, citation, citing_doc):
+    """Apply the filters that match_citation puts in its query to a document
+    that came back from a batched query.
+    """
+    if citing_doc is not None and doc['id'] == citing_doc.pk:
+        # Self-cite.
+        return False
+    if citation.court and doc.get('court_id') != citation.court:
+        return False
+    date_filed = doc.get('dateFiled')
+    if date_filed is None:
+        return False
+    start_year, end_year = get_date_bounds(citation, citing_doc)
+    # Same bounds as build_date_range.
+    return (datetime(start_year, 1, 1) <= date_filed <=
+            datetime(end_year, 12, 31))
+
+
+def query_citations_in_batch(conn, base_citations):
+    """Look up many citations with a single OR'ed filter query, paging
+    through the results.
+
+    :param conn: A sunburnt.SolrInterface
+    :param base_citations: A list of citation strings, like "1 U.S. 1"
+    :return: A dict mapping the normalized form of each citation string to
+    the list of documents that have it.
+    """
+    wanted = {normalize_citation_string(c) for c in base_citations}
+    params = {
+        'q': '*',
+        'fq': [
+            'status:Precedential',
+            'citation:(%s)' % ' OR '.join('"%s"' % c for c in base_citations),
+        ],
+        'fl': 'id,cluster_id,caseName,citation,court_id,dateFiled',
+        'rows': BATCH_ROWS,
+        'caller': 'citation.match_citations.query_citations_in_batch',
+    }
+    docs_by_citation = defaultdict(list)
+    start = 0
+    while True:
+        params['start'] = start
+        results = conn.raw_query(**params).execute()
+        for doc in results:
+            for cite in doc.get('citation', []):
+                cite = normalize_citation_string(cite)
+                if cite in wanted:
+                    docs_by_citation[cite].append(doc)
+        start += BATCH_ROWS
+        if start >= results.result.numFound:
+            break
+    return docs_by_citation
+
+
+def match_citations_in_batch(pairs, conn=None):
+    """Match many citations at once, using a few large queries instead of one
+    query per citation.
+
+    The year, court and self-cite filters that match_citation uses are applied
+    to each citation in Python. Only citations that have more than one
+    candidate after that, and that have a case name to refine with, are sent
+    through match_citation.
+
+    :param pairs: A list of (citation, citing_doc) tuples, where citation is a
+    find_citations.Citation object, and citing_doc is the search.Opinion doing
+    the citing, or None.
+    :param conn: A sunburnt.SolrInterface to use for all the queries. If None,
+    a new one is created.
+    :return: A list with one item for each pair, in the same order. Each item
+    is a list of the matches for the citation, as match_citation would return.
+    """
+    if conn is None:
+        conn = get_solr_interface(settings.SOLR_OPINION_URL, mode='r',
+                                  client='sunburnt')
+    base_citations = sorted({c.base_citation() for c, _ in pairs})
+    docs_by_citation = {}
+    for i in xrange(0, len(base_citations), BATCH_SIZE):
+        docs_by_citation.update(query_citations_in_batch(
+            conn, base_citations[i:i + BATCH_SIZE]))
+
+    matches = []
+    for citation, citing_doc in pairs:
+        key = normalize_citation_string(citation.base_citation())
+        candidates = [doc for doc in docs_by_citation.get(key, []) if
+                      is_batch_candidate(doc, citation, citing_doc)]
+        if len(candidates) > 1 and citing_doc is not None and \
+                citation.defendant:
+            # Ambiguous. Fall back to the slower path, which can refine by
+            # case name.
+            candidates = match_citation(citation, citing_doc=citing_doc,
+                                        conn=conn)
+        matches.append(candidates)
+    return matches
+
+
+def is_index_candidate(entry, citation, citing_doc):
+    """Apply the filters that match_citation puts in its query to an entry
+    from the local citation index.
+    """
+    if entry.precedential_status != PRECEDENTIAL:
+        # Non-precedential documents aren't cited
+        return False
+    if citing_doc is not None and entry.opinion_id == citing_doc.pk:
+        # Self-cite.
+        return False
+    if citation.court and entry.court_id != citation.court:
+        return False
+    if entry.date_filed is None:
+        return False
+    start_year, end_year = get_date_bounds(citation, citing_doc)
+    return start_year <= entry.date_filed.year <= end_year
+
+
+def match_citations_with_index(pairs, index, conn=None):
+    """Match many citations using the local citation index, only querying
+    Solr when the index has more than one candidate for a citation.
+
+    Citations that are not in the index are not matched. The index should
+    therefore be refreshed before it is used (see cl_build_citation_index).
+
+    :param pairs: A list of (citation, citing_doc) tuples, as for
+    match_citations_in_batch.
+    :param index: A cl.citations.citation_index.CitationIndex
+    :param conn: A sunburnt.SolrInterface to use for any queries that are
+    needed. If None, one is created when it is first needed.
+    :return: A list with one item for each pair, in the same order. Each item
+    is a list of matches for the citation. Matches from the index are dicts
+    with the same 'id' and 'cluster_id' keys as Solr results.
+    """
+    matches = []
+    for citation, citing_doc in pairs:
+        candidates = [
+            entry for entry in
+            index.lookup(citation.volume, citation.reporter, citation.page)
+            if is_index_candidate(entry, citation, citing_doc)
+        ]
+        if len(candidates) > 1:
+            # Ambiguous. Let Solr sort it out.
+            if conn is None:
+                conn = get_solr_interface(settings.SOLR_OPINION_URL, mode='r',
+                                          client='sunburnt')
+            matches.append(match_citation(citation, citing_doc=citing_doc,
+                                          conn=conn))
+        else:
+            matches.append([{'id': entry.opinion_id,
+                             'cluster_id': entry.cluster_id} for
+                            entry in candidates])
+    return matches
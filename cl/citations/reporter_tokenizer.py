@@ -15,6 +15,14 @@ REGEX_LIST.sort(key=len, reverse=True)
 REGEX_STR = '|'.join(map(re.escape, REGEX_LIST))
 REPORTER_RE = re.compile("\s(%s)\s" % REGEX_STR)
 
+# All the reporter strings we know about, frozen once at import so that
+# membership checks are O(1) instead of scanning a freshly concatenated list for
+# every token of every opinion.
+REPORTER_STRINGS = frozenset(REGEX_LIST)
+
+# The corner case of citations like 2007-NMCERT-008.
+DASHED_CITATION_RE = re.compile('\d+\-[A-Za-z]+\-\d+')
+
 
 def normalize_variation(string):
     """Gets the best possible canonicalization of a variant spelling of a
@@ -24,7 +32,7 @@ def normalize_variation(string):
     which is best. Usually, this can be accomplished using the year of the
     item.
     """
-    if string in VARIATIONS_ONLY.keys():
+    if string in VARIATIONS_ONLY:
         if len(VARIATIONS_ONLY[string]) == 1:
             # Simple case
             return VARIATIONS_ONLY[string][0]
@@ -49,17 +57,17 @@ def tokenize(text):
 
        Example:
        >>>tokenize('See Roe v. Wade, 410 U. S. 113 (1973)')
-       ['See', 'Roe', 'v.', 'Wade,', '410', 'U.S.', '113', '(1973)']
+       ['See', 'Roe', 'v.', 'Wade,', '410', 'U. S.', '113', '(1973)']
     """
     # if the text looks likes the corner-case 'digit-REPORTER-digit', splitting
     # by spaces doesn't work
-    if re.match('\d+\-[A-Za-z]+\-\d+', text):
+    if DASHED_CITATION_RE.match(text):
         return text.split('-')
     # otherwise, we just split on spaces to find words
     strings = REPORTER_RE.split(text)
     words = []
     for string in strings:
-        if string in EDITIONS.keys() + VARIATIONS_ONLY.keys():
+        if string in REPORTER_STRINGS:
             words.append(string)
         else:
             # Normalize spaces
@@ -67,6 +75,25 @@ def tokenize(text):
     return words
 
 
+def scan(text):
+    """Tokenize text and pick out every reporter along with its neighbors.
+
+    :param text: The text to scan.
+    :return: A tuple of (words, candidates), where words is the list returned
+    by tokenize, and candidates is a list of (volume, reporter, page, index)
+    tuples, one for each reporter token that has a token on either side of it.
+    The volume and page values are the raw neighboring tokens; it is up to the
+    caller to validate them. The index is the location of the reporter in
+    words.
+    """
+    words = tokenize(text)
+    # Exclude first and last tokens, because valid citations must have a
+    # volume before and a page after the reporter.
+    candidates = [(words[i - 1], words[i], words[i + 1], i) for i in
+                  xrange(1, len(words) - 1) if words[i] in REPORTER_STRINGS]
+    return words, candidates
+
+
 def _tokenize(text):
     # add extra space to make things easier
     text = " " + text + " "
@@ -1,9 +1,19 @@
 import re
+from collections import defaultdict
 from httplib import ResponseNotReady
 
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.urls import reverse
+from django.utils.timezone import now
+
 from cl.celery import app
 from cl.citations import find_citations, match_citations
-from cl.search.models import Opinion, OpinionsCited
+from cl.citations.citation_index import get_citation_index
+from cl.lib.scorched_utils import get_solr_interface
+from cl.search.models import Opinion, OpinionCluster, OpinionsCited
+from cl.search.outbox import index_items
 
 # This is the distance two reporter abbreviations can be from each other if they
 # are considered parallel reporters. For example, "22 U.S. 44, 46 (13 Atl. 33)"
@@ -66,89 +76,236 @@ def get_document_citations(opinion):
     return citations
 
 
+def linkify_citations(text, citations, template=u'%s'):
+    """Replace the citations in a piece of text with their HTML.
+
+    This makes a single pass over the text, looking for all the citations at
+    once, and builds the output with a single join.
+
+    The result is the same as doing a re.sub for each citation in turn,
+    except when the text of one citation can be found inside another's, like
+    1 U.S. 1 inside 11 U.S. 1 or 1 U.S. 12. One re.sub per citation would
+    link it there too, but here volumes and pages only match whole numbers,
+    so only the longer citation is linked.
+
+    :param text: The text or HTML to linkify.
+    :param citations: A list of find_citations.Citation objects.
+    :param template: A template to wrap the HTML of each citation in.
+    :return: The text with the citations replaced.
+    """
+    # For each distinct citation in the text, the regex that finds it and the
+    # replacement to expand with it. When a citation appears more than once
+    # the first one wins, since it would have replaced all the others.
+    replacements = {}
+    patterns = []
+    for citation in citations:
+        key = u' '.join((u'%d %s %s' % (citation.volume,
+                                         citation.reporter_found,
+                                         citation.page)).split())
+        if key in replacements:
+            continue
+        replacements[key] = (re.compile(citation.as_regex()),
+                             template % citation.as_html())
+        # The same pattern as as_regex, without its groups, since Python
+        # limits the number of groups in a regex, and only matching whole
+        # numbers.
+        patterns.append(r"(?<!\d)%d\s+%s\s+%s(?!\d)" % (
+            citation.volume,
+            re.escape(citation.reporter_found),
+            citation.page,
+        ))
+    if not patterns:
+        return text
+
+    all_citations_re = re.compile(u'|'.join(u'(?:%s)' % p for p in patterns))
+    pieces = []
+    last_end = 0
+    for m in all_citations_re.finditer(text):
+        citation_re, repl = replacements[u' '.join(m.group().split())]
+        pieces.append(text[last_end:m.start()])
+        pieces.append(citation_re.match(m.group()).expand(repl))
+        last_end = m.end()
+    pieces.append(text[last_end:])
+    return u''.join(pieces)
+
+
 def create_cited_html(opinion, citations):
     if any([opinion.html_columbia, opinion.html_lawbox, opinion.html]):
         new_html = opinion.html_columbia or opinion.html_lawbox or opinion.html
-        for citation in citations:
-            new_html = re.sub(citation.as_regex(), citation.as_html(),
-                              new_html)
+        new_html = linkify_citations(new_html, citations)
     elif opinion.plain_text:
-        inner_html = opinion.plain_text
-        for citation in citations:
-            repl = u'</pre>%s<pre class="inline">' % citation.as_html()
-            inner_html = re.sub(citation.as_regex(), repl, inner_html)
+        inner_html = linkify_citations(
+            opinion.plain_text,
+            citations,
+            template=u'</pre>%s<pre class="inline">',
+        )
         new_html = u'<pre class="inline">%s</pre>' % inner_html
     return new_html.encode('utf-8')
 
 
 @app.task(bind=True, max_retries=5, ignore_result=True)
-def find_citations_for_opinion_by_pks(self, opinion_pks, index=True):
+def find_citations_for_opinion_by_pks(self, opinion_pks, index=True,
+                                      resolver='solr'):
     """Find citations for search.Opinion objects.
 
     :param opinion_pks: An iterable of search.Opinion PKs
     :param index: Whether to add the item to Solr
+    :param resolver: How to match citations to opinions. 'solr' queries Solr
+    for every citation. 'index' uses the local citation index, and only
+    queries Solr when the index has more than one candidate.
     :return: None
     """
     opinions = Opinion.objects.filter(pk__in=opinion_pks)
-    for opinion in opinions:
-        citations = get_document_citations(opinion)
+    citations_by_opinion = [(opinion, get_document_citations(opinion)) for
+                            opinion in opinions]
+    try:
+        all_matches = match_opinion_citations(citations_by_opinion, resolver)
+    except ResponseNotReady as e:
+        # Threading problem in httplib, which is used in the Solr query.
+        raise self.retry(exc=e, countdown=2)
+
+    cluster_ids, opinion_ids = store_citation_matches(citations_by_opinion,
+                                                      all_matches)
+
+    # Update Solr if requested. In some cases we do it at the end for
+    # performance reasons.
+    if index:
+        if cluster_ids:
+            index_items(cluster_ids, 'search.OpinionCluster',
+                        reason='citation')
+        if opinion_ids:
+            index_items(opinion_ids, 'search.Opinion', reason='citation')
 
-        # List used so we can do one simple update to the citing opinion.
-        opinions_cited = set()
-        for citation in citations:
-            try:
-                matches = match_citations.match_citation(
-                    citation, citing_doc=opinion)
-            except ResponseNotReady as e:
-                # Threading problem in httplib, which is used in the Solr query.
-                raise self.retry(exc=e, countdown=2)
 
+def match_opinion_citations(citations_by_opinion, resolver='solr', conn=None):
+    """Match all the citations in a group of opinions.
+
+    :param citations_by_opinion: A list of (opinion, citations) tuples.
+    :param resolver: Either 'solr' or 'index'. See
+    find_citations_for_opinion_by_pks.
+    :param conn: A sunburnt.SolrInterface to use. If None, one is created.
+    :return: A list of matches for each citation, in the order they appear in
+    citations_by_opinion.
+    """
+    # Match every citation in the group at once, over a single connection.
+    if conn is None:
+        conn = get_solr_interface(settings.SOLR_OPINION_URL, mode='r',
+                                  client='sunburnt')
+    pairs = [(citation, opinion) for opinion, citations in
+             citations_by_opinion for citation in citations]
+    if resolver == 'index':
+        return match_citations.match_citations_with_index(
+            pairs, get_citation_index(), conn=conn)
+    return match_citations.match_citations_in_batch(pairs, conn=conn)
+
+
+def store_citation_matches(citations_by_opinion, all_matches):
+    """Save the citations found in a group of opinions using set-based queries.
+
+    For the whole group this looks up the matched opinions once, diffs the
+    citations each opinion had before with the ones it has now, deletes and
+    inserts OpinionsCited rows in bulk, and adjusts citation_count on every
+    affected cluster with F() updates.
+
+    :param citations_by_opinion: A list of (opinion, citations) tuples, where
+    opinion is a search.Opinion and citations is the list of
+    find_citations.Citation objects found in it.
+    :param all_matches: The matches for each citation, in the order they
+    appear in citations_by_opinion, as returned by
+    match_citations.match_citations_in_batch.
+    :return: A tuple of (cluster_ids, opinion_ids) that need to be updated in
+    Solr. The lists don't overlap: opinions in the clusters aren't repeated.
+    """
+    # Look up every matched opinion at once. The matches only have IDs.
+    matched_ids = {matches[0]['id'] for matches in all_matches if
+                   len(matches) == 1}
+    matched_opinions = {
+        pk: (cluster_id, reverse('view_case', args=[cluster_id, slug])) for
+        pk, cluster_id, slug in Opinion.objects.filter(
+            pk__in=matched_ids,
+        ).values_list('pk', 'cluster_id', 'cluster__slug')
+    }
+
+    # Work out what each opinion cites now, and linkify its citations.
+    new_cited = {}
+    offset = 0
+    for opinion, citations in citations_by_opinion:
+        opinion_matches = all_matches[offset:offset + len(citations)]
+        offset += len(citations)
+        if not citations:
+            # Only update things if we found citations
+            continue
+
+        opinions_cited = set()
+        for citation, matches in zip(citations, opinion_matches):
             # TODO: Figure out what to do if there's more than one
-            if len(matches) == 1:
-                match_id = matches[0]['id']
-                try:
-                    matched_opinion = Opinion.objects.get(pk=match_id)
-
-                    # Increase citation count for matched cluster if it hasn't
-                    # already been cited by this opinion.
-                    if matched_opinion not in opinion.opinions_cited.all():
-                        matched_opinion.cluster.citation_count += 1
-                        matched_opinion.cluster.save(index=index)
-
-                    # Add citation match to the citing opinion's list of cases
-                    # it cites. opinions_cited is a set so duplicates aren't an
-                    # issue
-                    opinions_cited.add(matched_opinion.pk)
-
-                    # URL field will be used for generating inline citation
-                    # html
-                    citation.match_url = matched_opinion.cluster.get_absolute_url()
-                    citation.match_id = matched_opinion.pk
-                except Opinion.DoesNotExist:
-                    # No Opinions returned. Press on.
-                    continue
-                except Opinion.MultipleObjectsReturned:
-                    # Multiple Opinions returned. Press on.
-                    continue
-            else:
-                # No match found for citation
+            if len(matches) != 1 or matches[0]['id'] not in matched_opinions:
+                # No match found for citation, or the matched opinion is gone.
                 # create_stub([citation])
-                pass
+                continue
+            match_id = matches[0]['id']
+            opinions_cited.add(match_id)
+            # URL field will be used for generating inline citation html
+            citation.match_url = matched_opinions[match_id][1]
+            citation.match_id = match_id
+        new_cited[opinion.pk] = opinions_cited
+        opinion.html_with_citations = create_cited_html(opinion, citations)
 
-        # Only update things if we found citations
-        if citations:
-            opinion.html_with_citations = create_cited_html(opinion, citations)
+    # Diff against what was cited before.
+    old_rows = OpinionsCited.objects.filter(
+        citing_opinion_id__in=new_cited.keys(),
+    ).values_list('pk', 'citing_opinion_id', 'cited_opinion_id')
+    old_cited = defaultdict(set)
+    rows_to_delete = []
+    for pk, citing_id, cited_id in old_rows:
+        old_cited[citing_id].add(cited_id)
+        if cited_id not in new_cited[citing_id]:
+            rows_to_delete.append((pk, cited_id))
+    rows_to_create = [
+        OpinionsCited(citing_opinion_id=citing_id, cited_opinion_id=cited_id)
+        for citing_id, cited_ids in new_cited.items() for cited_id in
+        cited_ids - old_cited[citing_id]
+    ]
 
-            # Nuke existing citations
-            OpinionsCited.objects.filter(citing_opinion_id=opinion.pk).delete()
+    # Every citing opinion counts once toward the cited cluster's total.
+    count_changes = defaultdict(int)
+    for row in rows_to_create:
+        count_changes[matched_opinions[row.cited_opinion_id][0]] += 1
+    deleted_cited_clusters = dict(Opinion.objects.filter(
+        pk__in={cited_id for _, cited_id in rows_to_delete},
+    ).values_list('pk', 'cluster_id'))
+    for _, cited_id in rows_to_delete:
+        if cited_id in deleted_cited_clusters:
+            count_changes[deleted_cited_clusters[cited_id]] -= 1
+    clusters_by_change = defaultdict(list)
+    for cluster_id, change in count_changes.items():
+        if change:
+            clusters_by_change[change].append(cluster_id)
 
-            # Create the new ones.
-            OpinionsCited.objects.bulk_create([
-                OpinionsCited(citing_opinion_id=opinion.pk,
-                              cited_opinion_id=pk) for
-                pk in opinions_cited
-            ])
+    # update() skips auto_now, so set date_modified by hand, as save() would.
+    modified = now()
+    with transaction.atomic():
+        for opinion, citations in citations_by_opinion:
+            if opinion.pk in new_cited:
+                Opinion.objects.filter(pk=opinion.pk).update(
+                    html_with_citations=opinion.html_with_citations,
+                    date_modified=modified,
+                )
+        OpinionsCited.objects.filter(
+            pk__in=[pk for pk, _ in rows_to_delete],
+        ).delete()
+        OpinionsCited.objects.bulk_create(rows_to_create)
+        for change, cluster_ids in clusters_by_change.items():
+            OpinionCluster.objects.filter(pk__in=cluster_ids).update(
+                citation_count=F('citation_count') + change,
+                date_modified=modified,
+            )
 
-        # Update Solr if requested. In some cases we do it at the end for
-        # performance reasons.
-        opinion.save(index=index)
+    # Reindexing a cluster reindexes all its opinions, so only return the
+    # citing opinions that aren't in one of those clusters.
+    changed_cluster_ids = {cluster_id for cluster_ids in
+                           clusters_by_change.values() for cluster_id in
+                           cluster_ids}
+    citing_ids = [opinion.pk for opinion, _ in citations_by_opinion if
+                  opinion.cluster_id not in changed_cluster_ids]
+    return sorted(changed_cluster_ids), citing_ids
@@ -1,19 +1,29 @@
 # coding=utf-8
+import pickle
+import re
+import shutil
+import tempfile
 from datetime import date
 
+import numpy as np
 from django.core.management import call_command
 from django.urls import reverse
 from django.test import TestCase, SimpleTestCase
+from django.utils.timezone import now
 from lxml import etree
 from reporters_db import REPORTERS
 
+from cl.citations.citation_index import build_index, CitationIndex, \
+    refresh_index
 from cl.citations.find_citations import get_citations, is_date_in_reporter, \
-    Citation
+    Citation, REPORTER_RESOLUTIONS, resolve_reporter, resolve_reporter_by_year
 from cl.citations.management.commands.cl_add_parallel_citations import \
-    identify_parallel_citations, make_edge_list
-from cl.citations.match_citations import match_citation
-from cl.citations.reporter_tokenizer import tokenize
-from cl.citations.tasks import find_citations_for_opinion_by_pks, create_cited_html
+    EdgeList, find_components, identify_parallel_citations, make_edge_list
+from cl.citations.match_citations import match_citation, \
+    match_citations_in_batch, match_citations_with_index
+from cl.citations.reporter_tokenizer import scan, tokenize
+from cl.citations.tasks import find_citations_for_opinion_by_pks, \
+    create_cited_html, get_document_citations, linkify_citations
 from cl.lib.test_helpers import IndexedSolrTestCase
 from cl.search.models import Opinion, OpinionsCited, OpinionCluster
 
@@ -43,6 +53,20 @@ class CiteTest(TestCase):
                          ['Failed', 'to', 'recognize', '1993', 'Ct. Sup.',
                           '5243-P'])
 
+    def test_reporter_scanner(self):
+        """Does the scanner find reporters and their neighbors?"""
+        self.assertEqual(
+            scan('See Roe v. Wade, 410 U. S. 113 (1973)'),
+            (['See', 'Roe', 'v.', 'Wade,', '410', 'U. S.', '113', '(1973)'],
+             [('410', 'U. S.', '113', 5)]),
+        )
+        # Reporters at the very start or end can't be citations.
+        self.assertEqual(scan('U.S. 1 F.2d'),
+                         (['U.S.', '1', 'F.2d'], []))
+        self.assertEqual(scan('2007-NMCERT-008'),
+                         (['2007', 'NMCERT', '008'],
+                          [('2007', 'NMCERT', '008', 1)]))
+
     def test_find_citations(self):
         """Can we find and make Citation objects from strings?"""
         test_pairs = (
@@ -144,8 +168,8 @@ class CiteTest(TestCase):
                 a,
                 msg='%s\n%s\n\n    !=\n\n%s' % (
                     q,
-                    ",\n".join([str(cite.__dict__) for cite in cites_found]),
-                    ",\n".join([str(cite.__dict__) for cite in a]),
+                    ",\n".join([str(cite.as_dict()) for cite in cites_found]),
+                    ",\n".join([str(cite.as_dict()) for cite in a]),
                 )
             )
             print "✓"
@@ -253,12 +277,38 @@ class CiteTest(TestCase):
                 msg='%s\n%s != \n%s' %
                     (
                         pair[0],
-                        [cite.__dict__ for cite in citations],
-                        [cite.__dict__ for cite in pair[1]]
+                        [cite.as_dict() for cite in citations],
+                        [cite.as_dict() for cite in pair[1]]
                     )
             )
             print "✓"
 
+    def test_resolution_table(self):
+        """Does the precomputed table agree with the disambiguation rules?"""
+        for reporter, resolution in REPORTER_RESOLUTIONS.items():
+            for year in [None, 1800, 1950, date.today().year]:
+                self.assertEqual(
+                    resolution, resolve_reporter_by_year(reporter, year),
+                    msg="%s resolved differently in %s" % (reporter, year),
+                )
+        # Year-dependent reporters go through the cache, and give the same
+        # answer the second time around.
+        self.assertNotIn('Wash.', REPORTER_RESOLUTIONS)
+        for _ in range(2):
+            self.assertEqual(resolve_reporter('Wash.', 1890),
+                             ('Wash.', 'Wash.', 1))
+            self.assertIsNone(resolve_reporter('Cranch', None))
+
+    def test_citation_value_type(self):
+        """Citations are slotted, but still compare and pickle properly."""
+        cite = get_citations('1 U.S. 1 (1982)', html=False)[0]
+        self.assertFalse(hasattr(cite, '__dict__'))
+        self.assertEqual(cite.as_dict()['year'], 1982)
+        self.assertEqual(pickle.loads(pickle.dumps(cite, 2)), cite)
+        other = get_citations('1 U.S. 1 (1983)', html=False)[0]
+        self.assertNotEqual(cite, other)
+        self.assertEqual(cite.fuzzy_hash(), other.fuzzy_hash())
+
     def test_make_html(self):
         """Can we make basic HTML conversions properly?"""
         good_html = ('<pre class="inline">asdf </pre><span class="citation '
@@ -287,6 +337,37 @@ class CiteTest(TestCase):
         )
 
 
+    def test_linkify_matches_sequential_substitution(self):
+        """Does linkifying in one pass give the same HTML as substituting one
+        citation at a time?
+        """
+        s = ('<p>See Roe v. Wade, 410 U. S. 113 (1973); cf. 410 U. S. 113, '
+             '2 U.S. 3, 4-5 (3 Atl. 33), 1 U.S. 1 and 171 Wn.2d\n'
+             '1016.</p>')
+        citations = get_citations(s)
+        for i, citation in enumerate(citations):
+            if i % 2:
+                citation.match_url = '/opinion/%s/foo/' % i
+                citation.match_id = i
+        expected = s
+        for citation in citations:
+            expected = re.sub(citation.as_regex(), citation.as_html(),
+                              expected)
+        self.assertEqual(linkify_citations(s, citations), expected)
+
+    def test_linkify_citations_inside_citations(self):
+        """Is a citation whose text is inside another's only linked where it
+        appears on its own?
+        """
+        s = '11 U.S. 1, 1 U.S. 12 and 1 U.S. 1.'
+        citations = get_citations(s)
+        self.assertEqual(len(citations), 3)
+        html = linkify_citations(s, citations)
+        self.assertEqual(html.count('<span class="volume">'), 3)
+        self.assertIn('<span class="volume">11</span>', html)
+        self.assertIn('<span class="page">12</span>', html)
+
+
 class MatchingTest(IndexedSolrTestCase):
     def test_citation_matching(self):
         """Creates a few documents that contain specific citations, then
@@ -309,6 +390,35 @@ class MatchingTest(IndexedSolrTestCase):
                 % (cited.cluster.citation_count, expected_count)
         )
 
+    def test_citation_matching_twice(self):
+        """Does running the citator again leave the counts alone?"""
+        remove_citations_from_imported_fixtures()
+        find_citations_for_opinion_by_pks.delay([3])
+        find_citations_for_opinion_by_pks.delay([3])
+
+        cited = Opinion.objects.get(pk=2)
+        self.assertEqual(cited.cluster.citation_count, 1)
+        self.assertEqual(
+            OpinionsCited.objects.filter(citing_opinion_id=3).count(),
+            1,
+        )
+
+    def test_citation_removed(self):
+        """If an opinion no longer cites something, is the count lowered?"""
+        remove_citations_from_imported_fixtures()
+        # A stale citation from 3 to 1, which 3 doesn't actually cite.
+        OpinionsCited.objects.create(citing_opinion_id=3, cited_opinion_id=1)
+        OpinionCluster.objects.filter(pk=1).update(citation_count=1)
+        before = now()
+        find_citations_for_opinion_by_pks.delay([3])
+
+        cluster = OpinionCluster.objects.get(pk=1)
+        self.assertEqual(cluster.citation_count, 0)
+        # Consumers that poll by date_modified need to see the new count.
+        self.assertGreaterEqual(cluster.date_modified, before)
+        self.assertFalse(OpinionsCited.objects.filter(
+            citing_opinion_id=3, cited_opinion_id=1).exists())
+
     def test_citation_matching_issue621(self):
         """Make sure that a citation like 1 Wheat 9 doesn't match 9 Wheat 1"""
         # The fixture contains a reference to 9 F. 1, so we expect no results.
@@ -317,6 +427,80 @@ class MatchingTest(IndexedSolrTestCase):
         results = match_citation(citation)
         self.assertEqual([], results)
 
+    def test_batch_matching(self):
+        """Does matching in a batch get the same results as matching one
+        citation at a time?
+        """
+        citing = Opinion.objects.get(pk=3)
+        citations = get_document_citations(citing)
+        # Add a citation that must not match (see issue 621, above).
+        citations.extend(get_citations('1 F. 9 (1795)'))
+        pairs = [(citation, citing) for citation in citations]
+        batch_results = match_citations_in_batch(pairs)
+        self.assertEqual(len(batch_results), len(pairs))
+        for (citation, citing_doc), batch_result in zip(pairs, batch_results):
+            single_result = match_citation(citation, citing_doc=citing_doc)
+            self.assertEqual(
+                [r['id'] for r in batch_result],
+                [r['id'] for r in single_result],
+                msg="Batched and single matching differ for %s" % citation,
+            )
+
+
+class CitationIndexTest(IndexedSolrTestCase):
+    def setUp(self):
+        super(CitationIndexTest, self).setUp()
+        self.index_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+        super(CitationIndexTest, self).tearDown()
+
+    def test_build_and_lookup(self):
+        """Can we build the index and look up citations in it?"""
+        build_index(self.index_dir)
+        index = CitationIndex.load(self.index_dir)
+        self.assertEqual(
+            [e.cluster_id for e in index.lookup(56, 'F.2d', '9')],
+            [2],
+        )
+        # The lookup is as lenient about spacing as Solr is.
+        self.assertEqual(
+            [e.cluster_id for e in index.lookup(56, 'F. 2d', '9')],
+            [2],
+        )
+        self.assertEqual(index.lookup(1, 'F.2d', '1'), [])
+
+    def test_refresh(self):
+        """Do new citations show up when the index is refreshed?"""
+        build_index(self.index_dir)
+        OpinionCluster.objects.get(pk=3).citations.create(
+            volume=1, reporter='U.S.', page='1', type=1)
+        index = refresh_index(self.index_dir)
+        self.assertEqual(
+            [e.cluster_id for e in index.lookup(1, 'U.S.', '1')],
+            [3],
+        )
+        # Existing entries are kept.
+        self.assertEqual(len(index.lookup(56, 'F.2d', '9')), 1)
+
+    def test_index_matching(self):
+        """Does matching with the index get the same results as Solr?"""
+        build_index(self.index_dir)
+        index = CitationIndex.load(self.index_dir)
+        citing = Opinion.objects.get(pk=3)
+        citations = get_document_citations(citing)
+        citations.extend(get_citations('1 F. 9 (1795)'))
+        pairs = [(citation, citing) for citation in citations]
+        for (citation, citing_doc), index_result in zip(
+                pairs, match_citations_with_index(pairs, index)):
+            solr_result = match_citation(citation, citing_doc=citing_doc)
+            self.assertEqual(
+                [r['id'] for r in index_result],
+                [r['id'] for r in solr_result],
+                msg="Index and Solr matching differ for %s" % citation,
+            )
+
 
 class CitationFeedTest(IndexedSolrTestCase):
 
@@ -470,6 +654,48 @@ class ParallelCitationTest(SimpleTestCase):
                 a,
             )
 
+    def test_finding_components(self):
+        """Can we find connected components without networkx?"""
+        components = find_components(
+            np.array([0, 1, 3, 5, 6]),
+            np.array([1, 2, 4, 6, 7]),
+            9,
+        )
+        self.assertEqual(components.tolist(), [0, 0, 0, 3, 3, 5, 5, 5, 8])
+
+    def test_edge_list(self):
+        """Can we write parallel citations to disk and read them back?"""
+        work_dir = tempfile.mkdtemp()
+        try:
+            edge_list = EdgeList(work_dir)
+            for _ in range(3):
+                citations = get_citations("1 U.S. 1 (22 U.S. 33)")
+                edge_list.add_groups(identify_parallel_citations(citations))
+                # Nodes aren't written again once their keys are merged.
+                edge_list.merge_new_keys()
+            edge_list.close()
+
+            self.assertEqual(edge_list.node_count, 2)
+            with open(edge_list.node_path) as f:
+                self.assertEqual(len(f.readlines()), 2)
+            self.assertEqual(edge_list.edge_count, 3)
+
+            edges, weights = edge_list.get_weighted_edges()
+            self.assertEqual(len(edges), 1)
+            self.assertEqual(weights.tolist(), [3])
+            # Reading the edges a chunk at a time gives the same counts.
+            chunked_edges, chunked_weights = edge_list.get_weighted_edges(
+                chunk_size=2)
+            self.assertEqual(chunked_edges.tolist(), edges.tolist())
+            self.assertEqual(chunked_weights.tolist(), [3])
+            citations = edge_list.get_citations(set(edges[0].tolist()))
+            self.assertEqual(
+                sorted(c.base_citation() for c in citations.values()),
+                [u'1 U.S. 1', u'22 U.S. 33'],
+            )
+        finally:
+            shutil.rmtree(work_dir)
+
     def test_hash(self):
         """Do two citation objects hash to the same?"""
         Citation.__hash__ = Citation.fuzzy_hash
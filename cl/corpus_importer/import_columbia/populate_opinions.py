@@ -9,16 +9,12 @@ from datetime import date
 from django.conf import settings
 
 from cl.citations.find_citations import get_citations
-from cl.lib import sunburnt
 from cl.lib.import_lib import find_person
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.solr_core_admin import get_term_frequency
 from cl.search.models import Docket, Opinion, OpinionCluster
 from convert_columbia_html import convert_columbia_html
 
-# only make a solr connection onece
-SOLR_CONN = sunburnt.SolrInterface(settings.SOLR_OPINION_URL, mode='r')
-
-
 # used to identify dates
 # the order of these dates matters, as if there are multiple matches in an opinion for one type of date tag,
 # the date associated to the --last-- matched tag will be the ones used for that type of date
@@ -317,7 +313,9 @@ def find_dups(docket, cluster):
         'rows': 100,
         'caller': 'corpus_importer.import_columbia.populate_opinions'
     }
-    results = SOLR_CONN.raw_query(**params).execute()
+    conn = get_solr_interface(settings.SOLR_OPINION_URL, mode='r',
+                              client='sunburnt')
+    results = conn.raw_query(**params).execute()
     if len(results) == 1:
         # found the duplicate
         return results
@@ -7,7 +7,7 @@ from juriscraper.pacer.http import PacerSession
 from cl.corpus_importer.tasks import get_docket_by_pacer_case_id
 from cl.lib.celery_utils import CeleryThrottle
 from cl.lib.command_utils import VerboseCommand, logger
-from cl.lib.scorched_utils import ExtraSolrInterface
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.search_utils import build_main_query_from_query_string
 from cl.search.models import Docket
 from cl.search.tasks import add_or_update_recap_docket
@@ -27,7 +27,7 @@ def get_docket_ids(main_query):
 
     :returns: a set() of docket IDs
     """
-    si = ExtraSolrInterface(settings.SOLR_RECAP_URL, mode='r')
+    si = get_solr_interface(settings.SOLR_RECAP_URL, mode='r')
     results = si.query().add_extra(**main_query).execute()
     docket_ids = set()
 
@@ -10,7 +10,7 @@ from cl.corpus_importer.tasks import make_attachment_pq_object, \
     get_attachment_page_by_rd, get_pacer_doc_by_rd, add_tags
 from cl.lib.celery_utils import CeleryThrottle
 from cl.lib.command_utils import VerboseCommand, logger
-from cl.lib.scorched_utils import ExtraSolrInterface
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.search_utils import build_main_query_from_query_string
 from cl.recap.tasks import process_recap_attachment
 from cl.scrapers.tasks import extract_recap_pdf
@@ -45,7 +45,7 @@ def get_attachment_pages(options):
         {'rows': page_size, 'fl': ['id', 'docket_id']},
         {'group': False, 'facet': False, 'highlight': False},
     )
-    si = ExtraSolrInterface(settings.SOLR_RECAP_URL, mode='r')
+    si = get_solr_interface(settings.SOLR_RECAP_URL, mode='r')
     results = si.query().add_extra(**main_query)
 
     q = options['queue']
@@ -101,7 +101,7 @@ def get_documents(options):
         {'rows': page_size, 'fl': ['id', 'docket_id']},
         {'group': False, 'facet': False, 'highlight': False},
     )
-    si = ExtraSolrInterface(settings.SOLR_RECAP_URL, mode='r')
+    si = get_solr_interface(settings.SOLR_RECAP_URL, mode='r')
     results = si.query().add_extra(**main_query).execute()
     logger.info("Got %s search results.", results.result.numFound)
 
@@ -7,7 +7,7 @@ from juriscraper.pacer import PacerSession
 from cl.corpus_importer.tasks import get_pacer_doc_by_rd, add_tags
 from cl.lib.celery_utils import CeleryThrottle
 from cl.lib.command_utils import VerboseCommand, logger
-from cl.lib.scorched_utils import ExtraSolrInterface
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.search_utils import build_main_query_from_query_string
 from cl.scrapers.tasks import extract_recap_pdf
 from cl.search.models import RECAPDocument
@@ -38,7 +38,7 @@ def get_documents(options):
         {'rows': page_size, 'fl': ['id', 'docket_id']},
         {'group': False, 'facet': False, 'highlight': False},
     )
-    si = ExtraSolrInterface(settings.SOLR_RECAP_URL, mode='r')
+    si = get_solr_interface(settings.SOLR_RECAP_URL, mode='r')
     results = si.query().add_extra(**main_query).execute()
     logger.info("Got %s search results.", results.result.numFound)
 
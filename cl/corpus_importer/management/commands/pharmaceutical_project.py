@@ -7,7 +7,7 @@ from django.core.paginator import Paginator
 from cl.corpus_importer.tasks import save_ia_docket_to_disk
 from cl.lib.celery_utils import CeleryThrottle
 from cl.lib.command_utils import VerboseCommand, logger
-from cl.lib.scorched_utils import ExtraSolrInterface
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.search_utils import build_main_query_from_query_string
 
 BULK_OUTPUT_DIRECTORY = '/sata/sample-data/pharma-dockets'
@@ -27,7 +27,7 @@ def query_dockets(query_string):
     )
     main_query['group.limit'] = 0
     main_query['sort'] = 'dateFiled asc'
-    si = ExtraSolrInterface(settings.SOLR_RECAP_URL, mode='r')
+    si = get_solr_interface(settings.SOLR_RECAP_URL, mode='r')
     search = si.query().add_extra(**main_query)
     page_size = 1000
     paginator = Paginator(search, page_size)
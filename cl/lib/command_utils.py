@@ -27,3 +27,23 @@ class CommandUtils(object):
             raise CommandError("Unable to find file at %s" % file_path)
         if not os.access(file_path, os.R_OK):
             raise CommandError("Unable to read file at %s" % file_path)
+
+
+def read_checkpoint(path):
+    """Get the value kept in a checkpoint file, or None if there is no
+    checkpoint.
+
+    Checkpoints hold a single integer, such as the last ID that was processed.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return int(f.read().strip())
+
+
+def write_checkpoint(path, value):
+    """Replace the value in a checkpoint file, atomically."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write('%s\n' % value)
+    os.rename(temp_path, path)
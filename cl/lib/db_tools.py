@@ -1,5 +1,9 @@
 from datetime import timedelta
 
+from django.db import connections
+from django.db.models import Case, Value, When
+from django.db.models.functions import Cast
+
 
 def queryset_generator(queryset, chunksize=1000):
     """
@@ -73,3 +77,35 @@ def queryset_generator_by_date(queryset, date_field, start_date, end_date,
         top_date = top_date + chunksize
         for row in queryset.filter(**keywords):
             yield row
+
+
+def bulk_update(objs, fields, batch_size=500):
+    """Save some fields of many objects, with one UPDATE per batch.
+
+    This is like the bulk_update method that querysets get in Django 2.2. Each
+    field is set with a CASE expression on the primary key. As with update(),
+    no signals are sent and auto_now fields aren't touched.
+
+    :param objs: A list of saved objects of one model.
+    :param fields: The names of the fields to save.
+    :param batch_size: The largest number of objects to save per query.
+    """
+    if not objs:
+        return
+    model = type(objs[0])
+    fields = [model._meta.get_field(name) for name in fields]
+    for i in range(0, len(objs), batch_size):
+        batch = objs[i:i + batch_size]
+        updates = {}
+        for field in fields:
+            case = Case(*[
+                When(pk=obj.pk, then=Value(getattr(obj, field.attname),
+                                           output_field=field))
+                for obj in batch
+            ], output_field=field)
+            if connections[model.objects.db].vendor == 'postgresql':
+                # Postgres needs to be told the type of the parameters.
+                case = Cast(case, output_field=field)
+            updates[field.attname] = case
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(
+            **updates)
@@ -1,5 +1,6 @@
 import logging
 import time
+from collections import OrderedDict
 from functools import wraps
 
 import requests
@@ -55,6 +56,36 @@ def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
     return deco_retry
 
 
+def lru_cache(maxsize=1024):
+    """Memoize a function of hashable positional arguments, keeping the
+    maxsize most recently used results.
+
+    This is a bare-bones stand-in for functools.lru_cache, which isn't
+    available in Python 2. The wrapped function gets a cache_clear method.
+
+    :param maxsize: The number of results to keep.
+    """
+    def deco_lru(f):
+        cache = OrderedDict()
+
+        @wraps(f)
+        def f_lru(*args):
+            try:
+                result = cache.pop(args)
+            except KeyError:
+                result = f(*args)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            # (Re-)insert it as the most recently used item.
+            cache[args] = result
+            return result
+
+        f_lru.cache_clear = cache.clear
+        return f_lru
+
+    return deco_lru
+
+
 def track_in_matomo(func, timeout=0.5, check_bots=True):
     """A decorator to track a request in Matomo.
 
@@ -1,6 +1,15 @@
+import os
+import socket
+import threading
+import time
+
+import requests
+from django.conf import settings
 from scorched import SolrInterface
 from scorched.search import Options, SolrSearch
 
+from cl.lib import sunburnt
+
 
 class ExtraSolrInterface(SolrInterface):
     """Extends the SolrInterface class so that it uses the ExtraSolrSearch
@@ -72,3 +81,182 @@ class ExtraOptions(Options):
 
     def options(self):
         return self.option_dict
+
+
+# The registry of Solr clients. Making a client fetches the schema of its core
+# over HTTP, so clients are made once per process and shared, along with a
+# single pool of HTTP connections. Use get_solr_interface to get a client.
+_registry_lock = threading.RLock()
+_registry = {
+    'pid': None,
+    'session': None,
+    # (client, url, mode) --> client
+    'clients': {},
+    # (client, url) --> (time fetched, schema)
+    'schemas': {},
+}
+
+
+def _check_registry():
+    """Empty the registry if this process was forked from the one that filled
+    it, so that processes never share connections.
+    """
+    if _registry['pid'] != os.getpid():
+        _registry['pid'] = os.getpid()
+        _registry['session'] = None
+        _registry['clients'] = {}
+        _registry['schemas'] = {}
+
+
+def get_solr_session():
+    """Get the requests.Session that every Solr client in this process uses
+    for its connections.
+    """
+    with _registry_lock:
+        _check_registry()
+        if _registry['session'] is None:
+            _registry['session'] = requests.Session()
+        return _registry['session']
+
+
+def get_solr_timeout(url):
+    """Get how long to wait for a Solr core to answer a query.
+
+    :param url: The URL of the core.
+    :return: A (connect, read) tuple of seconds.
+    """
+    return settings.SOLR_TIMEOUTS.get(url.rstrip('/'),
+                                      settings.SOLR_DEFAULT_TIMEOUT)
+
+
+def get_cached_schema(client, url, fetch_schema):
+    """Get the schema of a Solr core, fetching it only if the cached one is
+    older than settings.SOLR_SCHEMA_TTL.
+
+    :param client: The kind of client the schema is for. The two libraries
+    parse schemas differently.
+    :param url: The URL of the core.
+    :param fetch_schema: A function that fetches and returns the schema.
+    :return: A tuple of the time the schema was fetched, and the schema.
+    """
+    key = (client, url.rstrip('/'))
+    with _registry_lock:
+        _check_registry()
+        fetched, schema = _registry['schemas'].get(key, (None, None))
+        if fetched is None or time.time() - fetched > settings.SOLR_SCHEMA_TTL:
+            fetched, schema = time.time(), fetch_schema()
+            _registry['schemas'][key] = (fetched, schema)
+        return fetched, schema
+
+
+class PooledSolrInterface(ExtraSolrInterface):
+    """An ExtraSolrInterface that uses the shared connection pool and the
+    schema cache. Don't make these directly; use get_solr_interface.
+    """
+    client = 'scorched'
+
+    def __init__(self, url, mode='', timeout=()):
+        self.timeout = timeout
+        self.schema_fetched = None
+        super(PooledSolrInterface, self).__init__(url, mode=mode)
+
+    def init_schema(self):
+        # scorched ignores the http_connection it's given and doesn't pass
+        # search_timeout to its connection, so set them up here, before the
+        # schema is fetched.
+        self.conn.http_connection = get_solr_session()
+        self.conn.search_timeout = self.timeout
+        self.schema_fetched, schema = get_cached_schema(
+            self.client, self.conn.url,
+            super(PooledSolrInterface, self).init_schema,
+        )
+        return schema
+
+
+class SessionHttp(object):
+    """Make a requests.Session look like an httplib2.Http, which is what
+    sunburnt uses for its connections.
+    """
+    class Response(object):
+        def __init__(self, status):
+            self.status = status
+
+    def __init__(self, session, timeout=None):
+        self.session = session
+        self.timeout = timeout
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        # httplib2 raises socket errors when it can't reach the server or it
+        # times out, and sunburnt's retries only catch those, so raise the
+        # same.
+        try:
+            r = self.session.request(method, uri, data=body, headers=headers,
+                                     timeout=self.timeout)
+        except requests.Timeout as e:
+            raise socket.timeout(str(e))
+        except requests.ConnectionError as e:
+            raise socket.error(str(e))
+        return self.Response(r.status_code), r.content
+
+
+class PooledSunburntInterface(sunburnt.SolrInterface):
+    """A sunburnt SolrInterface that uses the shared connection pool and the
+    schema cache. Don't make these directly; use get_solr_interface.
+    """
+    client = 'sunburnt'
+
+    def __init__(self, url, mode='', timeout=None):
+        self.schema_fetched = None
+        # Like scorched, only time out queries, not updates, which can be
+        # slow.
+        http = SessionHttp(get_solr_session(),
+                           timeout=timeout if mode == 'r' else None)
+        super(PooledSunburntInterface, self).__init__(
+            url, http_connection=http, mode=mode)
+
+    def init_schema(self):
+        self.schema_fetched, self.schema = get_cached_schema(
+            self.client, self.conn.url, self._fetch_schema)
+
+    def _fetch_schema(self):
+        super(PooledSunburntInterface, self).init_schema()
+        return self.schema
+
+
+SOLR_CLIENTS = {
+    'scorched': PooledSolrInterface,
+    'sunburnt': PooledSunburntInterface,
+}
+
+
+def get_solr_interface(url, mode='r', client='scorched'):
+    """Get a Solr client for a core.
+
+    Clients are shared by everything in the process, so only the first call
+    for a core fetches its schema, and connections to Solr are reused. A
+    client is remade once its schema is older than settings.SOLR_SCHEMA_TTL.
+
+    :param url: The URL of the core, such as settings.SOLR_OPINION_URL.
+    :param mode: 'r' for a read-only client, 'w' for a write-only one, or
+    'rw' for both.
+    :param client: Which library to use, 'scorched' or 'sunburnt'. The
+    scorched client is an ExtraSolrInterface.
+    :return: The client.
+    """
+    key = (client, url.rstrip('/'), mode)
+    with _registry_lock:
+        _check_registry()
+        si = _registry['clients'].get(key)
+        if si is None or time.time() - si.schema_fetched > \
+                settings.SOLR_SCHEMA_TTL:
+            si = SOLR_CLIENTS[client](url, mode=mode,
+                                      timeout=get_solr_timeout(url))
+            _registry['clients'][key] = si
+        return si
+
+
+def clear_solr_interfaces():
+    """Forget every client, schema and connection in the registry."""
+    with _registry_lock:
+        _registry['pid'] = None
+        _check_registry()
@@ -1,5 +1,10 @@
+import re
 from datetime import date
 
+from django.utils import dateformat
+from django.utils.encoding import force_text
+from django.utils.html import escape, strip_tags
+
 from cl.lib.date_time import midnight_pst
 
 
@@ -49,3 +54,231 @@ def normalize_search_dicts(d):
         else:
             new_dict[k] = v
     return new_dict
+
+
+# The search index's text fields used to be made by rendering the templates in
+# cl/search/templates/indexes. The functions below make the same text without
+# the template engine, which was one of the biggest costs of indexing. The
+# templates are kept so that the text made here can be checked against them.
+#
+# The text is the same as the templates', token for token, but the whitespace
+# between the values differs. The search index ignores it.
+
+# Well-formed tags that the HTML parser used by Django's strip_tags would drop.
+# Anything else it might treat differently (bare "<", quotes outside of
+# attribute values, CDATA sections, script and style elements) makes
+# fast_strip_tags fall back to strip_tags.
+HTML_TAG_RE = re.compile(
+    r'<!--.*?--\s*>|'  # Comments
+    r'<[a-zA-Z][^<>"\']*(?:=\s*(?:"[^<>"]*"|\'[^<>\']*\')[^<>"\']*)*>|'
+    r'</[^<>]*>|'  # End tags
+    r'<![a-zA-Z][^<>]*>|'  # Declarations
+    r'<\?[^<>]*>',  # Processing instructions
+    re.DOTALL,
+)
+CDATA_ELEMENT_RE = re.compile(r'<(?:script|style)\b|<!\[', re.IGNORECASE)
+# The parser rewrites character and entity references that don't end with a
+# semicolon, so those have to go through strip_tags too.
+REFERENCE_START_RE = re.compile(r'&[a-zA-Z#]')
+REFERENCE_RE = re.compile(
+    r'&(?:[a-zA-Z][-.a-zA-Z0-9]*|#[0-9]+|#[xX][0-9a-fA-F]+);')
+
+
+def fast_strip_tags(value):
+    """Remove the HTML tags from a string, like django.utils.html.strip_tags.
+
+    The result is the same as strip_tags', but well-formed HTML is stripped
+    with a regular expression instead of an HTML parser, which is many times
+    faster.
+    """
+    value = force_text(value)
+    if '<' not in value or '>' not in value:
+        # strip_tags doesn't touch these.
+        return value
+    if CDATA_ELEMENT_RE.search(value) is not None or \
+            len(REFERENCE_START_RE.findall(value)) != \
+            len(REFERENCE_RE.findall(value)):
+        return strip_tags(value)
+    stripped = HTML_TAG_RE.sub(u'', value)
+    if '<' in stripped:
+        # Something that isn't a well-formed tag.
+        return strip_tags(value)
+    return stripped
+
+
+def render_text_value(value):
+    """Make a value into text the way {{ value }} did in the templates."""
+    return escape(value)
+
+
+def render_text_date(d):
+    """Make a date into text the way {{ d|date:"j F Y" }} did in the
+    templates.
+    """
+    if d is None:
+        return u''
+    return dateformat.format(d, 'j F Y')
+
+
+def render_case_name(item):
+    """The full case name of an item, or the best one it has."""
+    return render_text_value(item.case_name_full or item.case_name or
+                             item.case_name_short)
+
+
+def join_text(parts):
+    """Join the parts of a text field, and remove null and control
+    characters.
+    """
+    return u'\n'.join(parts).translate(null_map)
+
+
+def get_opinion_text(opinion, citation_string):
+    """Make the text field for an Opinion.
+
+    :param opinion: The search.Opinion.
+    :param citation_string: The citation string of its cluster.
+    """
+    # The body of the item (columbia > lawbox > html > plaintext)
+    html = opinion.html_columbia or opinion.html_lawbox or opinion.html
+    if html:
+        parts = [render_text_value(fast_strip_tags(html))]
+    else:
+        parts = [render_text_value(opinion.plain_text)]
+
+    cluster = opinion.cluster
+    docket = cluster.docket
+    court = docket.court
+    parts.extend([
+        # Docket. Dates are needed so queries for the date are sure to be
+        # returned (see #271)
+        render_text_date(docket.date_argued),
+        render_text_date(docket.date_reargued),
+        render_text_date(docket.date_reargument_denied),
+        render_text_value(docket.docket_number),
+        # Court
+        render_text_value(court.full_name),
+        render_text_value(court.pk),
+        render_text_value(court.citation_string),
+        # Cluster
+        render_case_name(cluster),
+    ])
+    parts.extend(render_text_value(judge.name_full) for judge in
+                 cluster.panel.all())
+    parts.extend([
+        render_text_value(cluster.judges),
+        render_text_date(cluster.date_filed),
+        render_text_value(citation_string),
+        render_text_value(cluster.procedural_history),
+        render_text_value(cluster.attorneys),
+        render_text_value(cluster.nature_of_suit),
+        render_text_value(cluster.posture),
+        render_text_value(cluster.syllabus),
+        render_text_value(cluster.precedential_status),
+        # Opinion
+        render_text_value(opinion.sha1),
+    ])
+    return join_text(parts)
+
+
+def get_recap_document_text(rd):
+    """Make the text field for a RECAPDocument."""
+    entry = rd.docket_entry
+    docket = entry.docket
+    court = docket.court
+    parts = [
+        # DocketEntry. The description is not escaped.
+        force_text(entry.description),
+        render_text_date(entry.date_filed),
+        # RECAPDocument
+        render_text_value(rd.get_document_type_display()),
+        render_text_value(rd.plain_text),
+        # Docket
+        render_case_name(docket),
+        render_text_date(docket.date_argued),
+        render_text_date(docket.date_filed),
+        render_text_date(docket.date_terminated),
+        render_text_value(docket.docket_number),
+        render_text_value(docket.nature_of_suit),
+        render_text_value(docket.jury_demand),
+        # Court
+        render_text_value(court.full_name),
+        render_text_value(court.citation_string),
+        render_text_value(court.pk),
+    ]
+    # Judges
+    if docket.assigned_to:
+        parts.append(render_text_value(docket.assigned_to.name_full))
+    if docket.referred_to:
+        parts.append(render_text_value(docket.referred_to.name_full))
+    return join_text(parts)
+
+
+def get_audio_text(audio):
+    """Make the text field for an Audio file."""
+    docket = audio.docket
+    court = docket.court
+    parts = [
+        render_case_name(audio),
+        # Docket. Dates are needed so queries for the date are sure to be
+        # returned (see #271)
+        render_text_date(docket.date_argued),
+        render_text_date(docket.date_reargued),
+        render_text_date(docket.date_reargument_denied),
+        render_text_value(docket.docket_number),
+    ]
+    # Transcript, if speech to text is complete
+    if audio.stt_status == 1:
+        parts.append(render_text_value(audio.transcript))
+    parts.extend([
+        # Court
+        render_text_value(court.full_name),
+        render_text_value(court.citation_string),
+        render_text_value(court.pk),
+        # Remainder of Audio File
+        render_text_value(audio.sha1),
+        render_text_value(audio.judges),
+    ])
+    return join_text(parts)
+
+
+def get_person_text(person):
+    """Make the text field for a Person."""
+    parts = [render_text_value(person.name_full)]
+    parts.extend(render_text_value(alias.name_full) for alias in
+                 person.aliases.all())
+    parts.extend([
+        render_text_value(person.dob_city),
+        render_text_value(person.get_dob_state_display()),
+    ])
+    for p in person.positions.all():
+        parts.extend([
+            render_text_value(p.get_position_type_display()),
+            render_text_value(p.get_nomination_process_display()),
+            render_text_value(p.get_judicial_committee_action_display()),
+            render_text_value(p.get_how_selected_display()),
+            render_text_value(p.get_termination_reason_display()),
+        ])
+        if p.court is not None:
+            parts.extend([
+                render_text_value(p.court.full_name),
+                render_text_value(p.court.citation_string),
+                render_text_value(p.court.pk),
+            ])
+        parts.extend([
+            render_text_value(p.organization_name),
+            render_text_value(p.job_title),
+        ])
+    parts.extend(render_text_value(pa.get_political_party_display()) for
+                 pa in person.political_affiliations.all())
+    parts.extend(render_text_value(e.school.name) for e in
+                 person.educations.all())
+    parts.extend(render_text_value(aba.get_rating_display()) for aba in
+                 person.aba_ratings.all())
+    parts.extend([
+        render_text_value(person.fjc_id),
+        render_text_value(person.cl_id),
+        render_text_value(person.get_gender_display()),
+        render_text_value(person.religion),
+    ])
+    return join_text(parts)
@@ -3,7 +3,7 @@ import os
 import scorched
 from django.conf import settings
 from django.core.management import call_command
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test.utils import override_settings
 from lxml import etree
 
@@ -11,18 +11,12 @@ from cl.lib import sunburnt
 from cl.search.models import Court
 
 
-@override_settings(
-    SOLR_OPINION_URL=settings.SOLR_OPINION_TEST_URL,
-    SOLR_AUDIO_URL=settings.SOLR_AUDIO_TEST_URL,
-    SOLR_PEOPLE_URL=settings.SOLR_PEOPLE_TEST_URL,
-    SOLR_RECAP_URL=settings.SOLR_RECAP_TEST_URL,
-    SOLR_URLS=settings.SOLR_TEST_URLS,
-)
-class EmptySolrTestCase(TestCase):
+class EmptySolrMixin(object):
     """Sets up an empty Solr index for tests that need to set up data manually.
 
-    Other Solr test classes subclass this one, adding additional content or
-    features.
+    Use it through EmptySolrTestCase, or EmptySolrTransactionTestCase for
+    tests that need their data committed, such as tests that use more than
+    one process.
     """
 
     def setUp(self):
@@ -52,6 +46,34 @@ class EmptySolrTestCase(TestCase):
             si.commit()
 
 
+@override_settings(
+    SOLR_OPINION_URL=settings.SOLR_OPINION_TEST_URL,
+    SOLR_AUDIO_URL=settings.SOLR_AUDIO_TEST_URL,
+    SOLR_PEOPLE_URL=settings.SOLR_PEOPLE_TEST_URL,
+    SOLR_RECAP_URL=settings.SOLR_RECAP_TEST_URL,
+    SOLR_URLS=settings.SOLR_TEST_URLS,
+)
+class EmptySolrTestCase(EmptySolrMixin, TestCase):
+    """Sets up an empty Solr index for tests that need to set up data manually.
+
+    Other Solr test classes subclass this one, adding additional content or
+    features.
+    """
+
+
+@override_settings(
+    SOLR_OPINION_URL=settings.SOLR_OPINION_TEST_URL,
+    SOLR_AUDIO_URL=settings.SOLR_AUDIO_TEST_URL,
+    SOLR_PEOPLE_URL=settings.SOLR_PEOPLE_TEST_URL,
+    SOLR_RECAP_URL=settings.SOLR_RECAP_TEST_URL,
+    SOLR_URLS=settings.SOLR_TEST_URLS,
+)
+class EmptySolrTransactionTestCase(EmptySolrMixin, TransactionTestCase):
+    """Like EmptySolrTestCase, but the data is committed, so that other
+    processes can see it.
+    """
+
+
 class SolrTestCase(EmptySolrTestCase):
     """A standard Solr test case with content included in the database,  but not
     yet indexed into the database.
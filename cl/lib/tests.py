@@ -4,12 +4,16 @@ from __future__ import print_function
 import datetime
 import os
 import re
+import socket
 import tempfile
 
+import mock
+import requests
 from django.core.files.base import ContentFile
 from django.urls import reverse
 from django.test import TestCase, SimpleTestCase
 from django.test import override_settings
+from django.utils.html import strip_tags
 from rest_framework.status import HTTP_503_SERVICE_UNAVAILABLE, HTTP_200_OK
 
 from cl.lib.db_tools import queryset_generator
@@ -18,6 +22,10 @@ from cl.lib.mime_types import lookup_mime_type
 from cl.lib.model_helpers import make_upload_path, make_docket_number_core
 from cl.lib.pacer import normalize_attorney_role, normalize_attorney_contact, \
     normalize_us_state, make_address_lookup_key, get_blocked_status
+from cl.lib.scorched_utils import SessionHttp, clear_solr_interfaces, \
+    get_solr_interface, get_solr_session
+from cl.lib.sunburnt.sunburnt import SolrConnection
+from cl.lib.search_index_utils import fast_strip_tags
 from cl.lib.search_utils import make_fq
 from cl.lib.storage import UUIDFileSystemStorage
 from cl.lib.string_utils import trunc, anonymize
@@ -262,6 +270,102 @@ class UUIDFileSystemStorageTest(SimpleTestCase):
         self.assertTrue(re.match('[a-f0-9]{32}', file_root_created))
 
 
+class TestFastStripTags(SimpleTestCase):
+    def test_same_as_strip_tags(self):
+        """Does fast_strip_tags give the same results as strip_tags?"""
+        tests = [
+            'No tags at all',
+            'a < b, but b > c',
+            '<p class="x" id=\'y\'>Some <i>italic</i> text.</p>',
+            '<a title="1 > 0">Quoted brackets</a>',
+            '<!-- A comment > with a bracket -->After',
+            '<!DOCTYPE html><?xml version="1.0"?><br/>Declarations',
+            'Fish &amp; chips, caf&#233; &#xE9;<br>',
+            '<p>AT&T</p>',
+            '<p>x < y</p>',
+            '<p a"b>Stray quote</p>',
+            '<script>if (a<b) {}</script>Script',
+            '<![CDATA[x>y]]>CDATA',
+            '<<b>b>Nested</b>',
+            u'<p>Caf\xe9</p>',
+        ]
+        for test in tests:
+            self.assertEqual(fast_strip_tags(test), strip_tags(test),
+                             msg="Different results for: %s" % test)
+
+
+FAKE_SCHEMA = {'fields': [], 'dynamicFields': [], 'uniqueKey': 'id'}
+
+
+@override_settings(SOLR_TIMEOUTS={'http://solr/a': (1, 2)},
+                   SOLR_DEFAULT_TIMEOUT=(3, 4))
+@mock.patch('scorched.SolrInterface.init_schema', return_value=FAKE_SCHEMA)
+class TestSolrInterfaceRegistry(SimpleTestCase):
+    def setUp(self):
+        clear_solr_interfaces()
+
+    def tearDown(self):
+        clear_solr_interfaces()
+
+    def test_clients_are_shared(self, init_schema):
+        """Do we make a client and fetch its schema only once?"""
+        si = get_solr_interface('http://solr/a', mode='r')
+        self.assertIs(si, get_solr_interface('http://solr/a/', mode='r'))
+        self.assertEqual(init_schema.call_count, 1)
+
+        # Other modes get their own client, but not their own schema.
+        si_rw = get_solr_interface('http://solr/a', mode='rw')
+        self.assertIsNot(si, si_rw)
+        self.assertFalse(si.conn.writeable)
+        self.assertTrue(si_rw.conn.writeable)
+        self.assertEqual(init_schema.call_count, 1)
+
+        get_solr_interface('http://solr/b', mode='r')
+        self.assertEqual(init_schema.call_count, 2)
+
+    def test_connections_and_timeouts(self, init_schema):
+        """Do clients share one session, with a timeout for their core?"""
+        si_a = get_solr_interface('http://solr/a', mode='r')
+        si_b = get_solr_interface('http://solr/b', mode='r')
+        self.assertIs(si_a.conn.http_connection, get_solr_session())
+        self.assertIs(si_b.conn.http_connection, get_solr_session())
+        self.assertEqual(si_a.conn.search_timeout, (1, 2))
+        self.assertEqual(si_b.conn.search_timeout, (3, 4))
+
+    def test_schema_expires(self, init_schema):
+        """Do we fetch the schema again once it's too old?"""
+        with self.settings(SOLR_SCHEMA_TTL=-1):
+            si = get_solr_interface('http://solr/a', mode='r')
+            self.assertIsNot(si, get_solr_interface('http://solr/a', mode='r'))
+        self.assertEqual(init_schema.call_count, 2)
+
+
+class TestSessionHttp(SimpleTestCase):
+    def test_errors_are_socket_errors(self):
+        """Do failed requests raise the socket errors httplib2 would?"""
+        session = mock.Mock()
+        http = SessionHttp(session)
+        session.request.side_effect = requests.ConnectTimeout()
+        with self.assertRaises(socket.timeout):
+            http.request('http://solr/a/select/')
+        session.request.side_effect = requests.ConnectionError()
+        with self.assertRaises(socket.error):
+            http.request('http://solr/a/select/')
+
+    def test_sunburnt_retries(self):
+        """Does sunburnt retry a request that couldn't connect?"""
+        session = mock.Mock()
+        session.request.side_effect = [
+            requests.ConnectionError(),
+            mock.Mock(status_code=200, content='ok'),
+        ]
+        conn = SolrConnection('http://solr/a', SessionHttp(session),
+                              retry_timeout=0, max_length_get_url=2048)
+        r, c = conn.request('http://solr/a/select/')
+        self.assertEqual((r.status, c), (200, 'ok'))
+        self.assertEqual(session.request.call_count, 2)
+
+
 class TestMimeLookup(TestCase):
     """ Test the Mime type lookup function(s)"""
 
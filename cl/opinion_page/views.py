@@ -22,10 +22,11 @@ from cl.alerts.models import DocketAlert
 from cl.custom_filters.templatetags.text_filters import best_case_name
 from cl.favorites.forms import FavoriteForm
 from cl.favorites.models import Favorite
-from cl.lib import search_utils, sunburnt
+from cl.lib import search_utils
 from cl.lib.bot_detector import is_bot, is_og_bot
 from cl.lib.model_helpers import suppress_autotime, choices_to_csv
 from cl.lib.ratelimiter import ratelimit_if_not_whitelisted
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.string_utils import trunc
 from cl.opinion_page.forms import CitationRedirectorForm, DocketEntryFilterForm
 from cl.people_db.models import AttorneyOrganization, Role, CriminalCount
@@ -280,7 +281,8 @@ def view_opinion(request, pk, _):
     if not is_bot(request):
         # Get the citing results from Solr for speed. Only do this for humans
         # to save on disk usage.
-        conn = sunburnt.SolrInterface(settings.SOLR_OPINION_URL, mode='r')
+        conn = get_solr_interface(settings.SOLR_OPINION_URL, mode='r',
+                                  client='sunburnt')
         q = {
             'q': 'cites:({ids})'.format(
                 ids=' OR '.join([str(pk) for pk in
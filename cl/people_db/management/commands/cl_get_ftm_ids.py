@@ -6,7 +6,7 @@ import requests
 from django.conf import settings
 
 from cl.lib.command_utils import VerboseCommand, logger
-from cl.lib.sunburnt import SolrInterface
+from cl.lib.scorched_utils import get_solr_interface
 from cl.people_db.import_judges.courtid_levels import courtid2statelevel
 from cl.people_db.models import Person
 
@@ -114,7 +114,8 @@ def print_stats(match_stats, candidate_eid_lists):
 
 def update_judges_by_solr(candidate_id_map, debug):
     """Update judges by looking up each entity from FTM in Solr."""
-    conn = SolrInterface(settings.SOLR_PEOPLE_URL, mode='r')
+    conn = get_solr_interface(settings.SOLR_PEOPLE_URL, mode='r',
+                              client='sunburnt')
     match_stats = defaultdict(int)
     # These IDs are ones that cannot be updated due to being identified as
     # problematic in FTM's data.
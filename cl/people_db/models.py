@@ -3,7 +3,6 @@ from datetime import datetime, time
 
 from django.urls import reverse
 from django.db import models
-from django.template import loader
 from django.utils.text import slugify
 from localflavor.us import models as local_models
 
@@ -21,7 +20,7 @@ from cl.lib.model_helpers import (
     validate_at_most_n,
     validate_supervisor,
 )
-from cl.lib.search_index_utils import solr_list, null_map, \
+from cl.lib.search_index_utils import get_person_text, solr_list, \
     normalize_search_dicts
 from cl.lib.storage import IncrementingFileSystemStorage
 from cl.lib.models import THUMBNAIL_STATUSES
@@ -348,8 +347,7 @@ class Person(models.Model):
             }
             out.update(p_out)
 
-        text_template = loader.get_template('indexes/person_text.txt')
-        out['text'] = text_template.render({'item': self}).translate(null_map)
+        out['text'] = get_person_text(self)
 
         return normalize_search_dicts(out)
 
@@ -1,23 +1,86 @@
 import io
+import json
+import os
 import re
-import sys
-from datetime import date
+import time
+from datetime import date, datetime
+from itertools import islice
 
 from dateutil import parser
 from django.core.management import CommandError
+from django.db import connection, models, transaction
+from django.db.models import Max
+from django.utils.timezone import now
 
-from cl.lib.command_utils import VerboseCommand, CommandUtils, logger
+from cl.lib.command_utils import VerboseCommand, CommandUtils, logger, \
+    write_checkpoint
 from cl.recap.constants import (
-    DATASET_SOURCES, CV_OLD, CV_2017, CR_OLD, CR_2017, APP_2017, APP_OLD,
-    BANKR_2017, IDB_FIELD_DATA
+    DATASET_SOURCES, CV_2017, CR_2017, BANKR_2017, IDB_FIELD_DATA
 )
 from cl.recap.models import FjcIntegratedDatabase
 from cl.search.models import Court
 
+# How to escape text for COPY's text format.
+COPY_ESCAPES = {
+    ord(u'\\'): u'\\\\',
+    ord(u'\t'): u'\\t',
+    ord(u'\n'): u'\\n',
+    ord(u'\r'): u'\\r',
+}
+
+
+def parse_idb_date(value):
+    """Parse a date from the IDB.
+
+    The IDB uses MM/DD/YYYY, which is much faster to split up by hand than to
+    give to dateutil. Anything else still goes to dateutil.
+    """
+    try:
+        month, day, year = value.split('/')
+        return date(int(year), int(month), int(day))
+    except ValueError:
+        return parser.parse(value).date()
+
+
+def get_max_idb_pk():
+    return FjcIntegratedDatabase.objects.aggregate(Max('pk'))['pk__max'] or 0
+
+
+def read_load_checkpoint(path):
+    """Get the number of the last chunk that was loaded and the highest IDB
+    row ID after it was, from a checkpoint file, or None if there is no
+    checkpoint.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_load_checkpoint(path, chunk_number):
+    write_checkpoint(path, json.dumps({
+        'chunk': chunk_number,
+        'max_pk': get_max_idb_pk(),
+    }))
+
+
+def to_copy_value(value):
+    """Convert a value to a cell of COPY's text format."""
+    if value is None:
+        return u'\\N'
+    if isinstance(value, bool):
+        return u't' if value else u'f'
+    if isinstance(value, models.Model):
+        value = value.pk
+    elif isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return unicode(value).translate(COPY_ESCAPES)
+
 
 class Command(VerboseCommand, CommandUtils):
     help = 'Import a tab-separated file as produced by FJC for their IDB. ' \
-           'Do not check for duplicates.'
+           'Do not check for duplicates. The file is loaded in chunks, each ' \
+           'with a single COPY.'
     BAD_CHARS = re.compile(u'[\u0000\u001E]')
 
     def add_arguments(self, parser):
@@ -34,11 +97,20 @@ class Command(VerboseCommand, CommandUtils):
             type=int,
         )
         parser.add_argument(
-            '--start-line',
-            help="The line to start on. Useful for crashed scripts.",
-            default=-1,
+            '--chunk-size',
+            help="The number of lines to load with each COPY. Each chunk is "
+                 "committed on its own.",
+            default=50000,
             type=int,
         )
+        parser.add_argument(
+            '--checkpoint',
+            help="A file where the progress of the load is kept. If the file "
+                 "exists, loading resumes after the last chunk that was "
+                 "loaded, first removing any rows that were added after it. "
+                 "Useful for crashed scripts, but nothing else may add IDB "
+                 "rows while a load with a checkpoint is running.",
+        )
 
     def __init__(self, *args, **kwargs):
         super(Command, self).__init__(*args, **kwargs)
@@ -49,6 +121,8 @@ class Command(VerboseCommand, CommandUtils):
         self.date_fields = []
         self.court_fields = []
         self.nullable_fields = None
+        self.court_maps = {}
+        self.copy_columns = []
 
     @staticmethod
     def ensure_filetype_ok(filetype):
@@ -134,47 +208,117 @@ class Command(VerboseCommand, CommandUtils):
         self.ensure_file_ok(options['input_file'])
         self.ensure_filetype_ok(options['filetype'])
         self.filetype = options['filetype']
+        if self.filetype not in [CV_2017, CR_2017]:
+            raise NotImplementedError("This file type not yet implemented.")
         self.build_field_data()
+        self.build_court_maps()
+        self.build_copy_columns()
+
+        checkpoint = options['checkpoint']
+        last_chunk = None
+        if checkpoint is not None:
+            state = read_load_checkpoint(checkpoint)
+            if state is None:
+                write_load_checkpoint(checkpoint, None)
+            else:
+                last_chunk = state['chunk']
+                # A chunk can be committed before the crash and without its
+                # checkpoint. Remove its rows, so that it's loaded only once.
+                deleted, _ = FjcIntegratedDatabase.objects.filter(
+                    pk__gt=state['max_pk']).delete()
+                logger.info("Resuming after chunk %s. Removed %s rows that "
+                            "were added after it.", last_chunk, deleted)
 
         logger.info("Importing IDB file at: %s" % options['input_file'])
         f = io.open(options['input_file'], mode='r', encoding='cp1252',
                     newline="\r\n")
         col_headers = f.next().strip().split('\t')
-        batch_size = 1000
-        batch = []
-        for i, line in enumerate(f):
-            sys.stdout.write('\rDoing line: %s' % i)
-            sys.stdout.flush()
-            if i < options['start_line']:
+        missing_headers = set(self.field_mappings) - set(col_headers)
+        if missing_headers:
+            logger.warn("The file lacks these columns, which will be left "
+                        "empty: %s", ', '.join(sorted(missing_headers)))
+        chunks = iter(lambda: list(islice(f, options['chunk_size'])), [])
+        total = 0
+        t1 = time.time()
+        for chunk_number, lines in enumerate(chunks):
+            if last_chunk is not None and chunk_number <= last_chunk:
+                # Skip the chunk without parsing it.
                 continue
 
+            t2 = time.time()
+            count = self.copy_rows(self.make_rows(lines, col_headers))
+            if checkpoint is not None:
+                write_load_checkpoint(checkpoint, chunk_number)
+            total += count
+            t3 = time.time()
+            logger.info("Loaded chunk %s with %s rows at %.0f rows/s. %s rows "
+                        "at %.0f rows/s so far.", chunk_number, count,
+                        count / max(t3 - t2, 0.001), total,
+                        total / max(t3 - t1, 0.001))
+
+        f.close()
+
+    def make_rows(self, lines, col_headers):
+        """Parse and normalize lines from the file.
+
+        Columns that are missing from the file or from a line are left
+        empty.
+
+        :return: A generator of row dicts with the columns of the file as
+        keys.
+        """
+        for line in lines:
             row = self.make_csv_row_dict(line, col_headers)
-            if options['filetype'] == CR_2017 and row['SOURCE'] != 'CMECF':
+            if self.filetype == CR_2017 and row.get('SOURCE') != 'CMECF':
                 continue
 
+            for col_header in self.field_mappings:
+                row.setdefault(col_header, '')
+
             self.normalize_nulls(row)
             self.normalize_court_fields(row)
             self.normalize_booleans(row)
             self.normalize_dates(row)
             self.normalize_ints(row)
-            if options['filetype'] in [CV_OLD, CR_OLD, APP_OLD, BANKR_2017,
-                                       APP_2017]:
-                raise NotImplementedError(
-                    "This file type not yet implemented.")
-            elif options['filetype'] == CV_2017:
-                batch.append(self.create_row_obj(row, CV_2017))
-            elif options['filetype'] == CR_2017:
-                batch.append(self.create_row_obj(row, CR_2017))
-
-            if len(batch) == batch_size:
-                logger.info("Saving %s items to the DB.", batch_size)
-                FjcIntegratedDatabase.objects.bulk_create(batch)
-                batch = []
-
-        # Do any trailing items as well.
-        FjcIntegratedDatabase.objects.bulk_create(batch)
+            yield row
 
-        f.close()
+    def copy_rows(self, rows):
+        """Insert rows into the DB with a single COPY, in a transaction of
+        its own.
+
+        :param rows: An iterable of normalized row dicts.
+        :return: The number of rows that were inserted.
+        """
+        created = now()
+        defaults = {
+            'dataset_source': self.filetype,
+            'date_created': created,
+            'date_modified': created,
+        }
+        buf = io.BytesIO()
+        count = 0
+        for row in rows:
+            values = []
+            for column, field_name, col_header, default in self.copy_columns:
+                if col_header is not None:
+                    value = row[col_header]
+                else:
+                    value = defaults.get(field_name, default)
+                values.append(to_copy_value(value))
+            buf.write(u'\t'.join(values).encode('utf-8'))
+            buf.write(b'\n')
+            count += 1
+        if not count:
+            return 0
+
+        buf.seek(0)
+        sql = "COPY %s (%s) FROM STDIN" % (
+            FjcIntegratedDatabase._meta.db_table,
+            ', '.join(column for column, _, _, _ in self.copy_columns),
+        )
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.copy_expert(sql, buf)
+        return count
 
     def normalize_nulls(self, row):
         """The IDB uses the value -8 to indicate a null value. Fix this
@@ -199,7 +343,7 @@ class Command(VerboseCommand, CommandUtils):
         for col in self.date_fields:
             if row[col] is None:
                 continue
-            row[col] = parser.parse(row[col]).date()
+            row[col] = parse_idb_date(row[col])
 
     def normalize_booleans(self, row):
         """Normalize boolean fields"""
@@ -224,40 +368,43 @@ class Command(VerboseCommand, CommandUtils):
             row['CIRCUIT'] = row['CIRCUIT'][1]
 
         if row['CIRCUIT']:
-            matches = Court.objects.filter(jurisdiction=Court.FEDERAL_APPELLATE,
-                                           fjc_court_id=row['CIRCUIT'])
-            if matches.count() == 1:
+            matches = self.court_maps[Court.FEDERAL_APPELLATE].get(
+                row['CIRCUIT'], [])
+            if len(matches) == 1:
                 row['CIRCUIT'] = matches[0]
             else:
                 raise Exception("Unable to match CIRCUIT column value %s to "
                                 "Court object" % row['CIRCUIT'])
+        else:
+            row['CIRCUIT'] = None
 
         if row['DISTRICT']:
             if self.filetype == BANKR_2017:
-                matches = Court.objects.filter(
-                    jurisdiction=Court.FEDERAL_BANKRUPTCY,
-                    fjc_court_id=row['DISTRICT'],
-                )
+                court_map = self.court_maps[Court.FEDERAL_BANKRUPTCY]
             else:
-                matches = Court.objects.filter(
-                    jurisdiction=Court.FEDERAL_DISTRICT,
-                    fjc_court_id=row['DISTRICT'],
-                )
-
-            if matches.count() == 1:
+                court_map = self.court_maps[Court.FEDERAL_DISTRICT]
+            matches = court_map.get(row['DISTRICT'], [])
+            if len(matches) == 1:
                 row['DISTRICT'] = matches[0]
             else:
                 raise Exception("Unable to match DISTRICT column value %s to "
                                 "Court object" % row['DISTRICT'])
+        else:
+            row['DISTRICT'] = None
 
-    def create_row_obj(self, row, source):
-        # Just create an obj, so we can do a bulk_update. This is much faster
-        # than doing an insert for every item.
-        values = {}
-        for k, v in row.items():
-            if k in self.field_mappings:
-                values[self.field_mappings[k]] = v
-        return FjcIntegratedDatabase(dataset_source=source, **values)
+    def build_court_maps(self):
+        """Load the federal courts once, keyed by jurisdiction and then by FJC
+        court ID, so that rows can be matched to them without any queries.
+        """
+        jurisdictions = [Court.FEDERAL_APPELLATE, Court.FEDERAL_DISTRICT,
+                         Court.FEDERAL_BANKRUPTCY]
+        self.court_maps = {jurisdiction: {} for jurisdiction in jurisdictions}
+        courts = Court.objects.filter(
+            jurisdiction__in=jurisdictions,
+        ).exclude(fjc_court_id='').only('pk', 'jurisdiction', 'fjc_court_id')
+        for court in courts:
+            self.court_maps[court.jurisdiction].setdefault(
+                court.fjc_court_id, []).append(court)
 
     def build_field_data(self):
         """Build up fields for the selected filetype."""
@@ -276,3 +423,23 @@ class Command(VerboseCommand, CommandUtils):
                     self.court_fields.append(k)
         self.nullable_fields = self.int_fields + self.date_fields + \
                                self.bool_fields
+
+    def build_copy_columns(self):
+        """Work out the columns that COPY fills in.
+
+        Every column but the ID is filled in, since COPY doesn't use the
+        defaults of the model. Each column is a tuple of the column name, the
+        field name, the column of the file that it comes from, or None, and
+        the default of the field.
+        """
+        headers_by_field = {v: k for k, v in self.field_mappings.items()}
+        self.copy_columns = []
+        for field in FjcIntegratedDatabase._meta.concrete_fields:
+            if field.primary_key:
+                continue
+            self.copy_columns.append((
+                field.column,
+                field.name,
+                headers_by_field.get(field.name),
+                field.get_default(),
+            ))
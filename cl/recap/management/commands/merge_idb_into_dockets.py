@@ -2,6 +2,7 @@ import os
 
 from celery.canvas import chain
 from django.conf import settings
+from django.db import connection
 from juriscraper.lib.string_utils import CaseNameTweaker, harmonize
 from juriscraper.pacer import PacerSession
 
@@ -14,7 +15,8 @@ from cl.lib.string_diff import find_best_match
 from cl.recap.constants import CV_2017
 from cl.recap.models import FjcIntegratedDatabase
 from cl.recap.tasks import merge_docket_with_idb, create_new_docket_from_idb, \
-    update_docket_from_hidden_api
+    update_docket_from_hidden_api, create_new_dockets_from_idb, \
+    merge_dockets_with_idb
 from cl.search.models import Docket
 
 cnt = CaseNameTweaker()
@@ -23,6 +25,55 @@ PACER_USERNAME = os.environ.get('PACER_USERNAME', settings.PACER_USERNAME)
 PACER_PASSWORD = os.environ.get('PACER_PASSWORD', settings.PACER_PASSWORD)
 
 
+def match_idb_rows(dataset_source, offset=0, limit=0):
+    """Match the rows of the IDB to dockets, with a single query.
+
+    Each row is matched to the dockets in its district that have its docket
+    number, which is the same as filtering the dockets by docket_number_core
+    and court for each row, but without a query per row.
+
+    :param dataset_source: The dataset of the IDB rows to match, such as
+    CV_2017.
+    :param offset: The number of rows to skip.
+    :param limit: The largest number of rows to match, or 0 for all of them.
+    :return: A generator of (IDB row pk, docket pk, count) tuples in the order
+    of the IDB rows, where count is the number of dockets that matched, and
+    docket pk is the lowest pk among them, or None if none did.
+    """
+    idb_meta = FjcIntegratedDatabase._meta
+    d_meta = Docket._meta
+    sql = (
+        "SELECT idb.{idb_pk}, MIN(d.{d_pk}), COUNT(d.{d_pk}) "
+        "FROM {idb_table} idb "
+        "LEFT JOIN {d_table} d "
+        "ON d.{docket_number_core} = idb.{docket_number} "
+        "AND d.{court} = idb.{district} "
+        "WHERE idb.{dataset_source} = %s "
+        "GROUP BY idb.{idb_pk} "
+        "ORDER BY idb.{idb_pk} "
+        "OFFSET %s"
+    ).format(
+        idb_pk=idb_meta.pk.column,
+        d_pk=d_meta.pk.column,
+        idb_table=idb_meta.db_table,
+        d_table=d_meta.db_table,
+        docket_number_core=d_meta.get_field('docket_number_core').column,
+        docket_number=idb_meta.get_field('docket_number').column,
+        court=d_meta.get_field('court').column,
+        district=idb_meta.get_field('district').column,
+        dataset_source=idb_meta.get_field('dataset_source').column,
+    )
+    params = [dataset_source, offset]
+    if limit > 0:
+        sql += " LIMIT %s"
+        params.append(limit)
+    # A server-side cursor, so the results aren't all loaded at once.
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield row
+
+
 class Command(VerboseCommand, CommandUtils):
     help = 'Iterate over the IDB data and merge it into our existing ' \
            'datasets. Where we lack a Docket object for an item in the IDB, ' \
@@ -54,6 +105,13 @@ class Command(VerboseCommand, CommandUtils):
             required=True,
             help="What task are we doing at this point?",
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help="For the first pass, the number of IDB rows to create or "
+                 "merge dockets for in each task.",
+        )
 
     def handle(self, *args, **options):
         logger.info("Using PACER username: %s"% PACER_USERNAME)
@@ -66,46 +124,63 @@ class Command(VerboseCommand, CommandUtils):
 
     @staticmethod
     def do_first_pass(options):
-        idb_rows = FjcIntegratedDatabase.objects.filter(
-            dataset_source=CV_2017,
-        ).order_by('pk')
+        """Match every IDB row to the dockets at once, then create or merge
+        dockets in batches.
+
+        Rows that match more than one docket are left for the second pass.
+        """
         q = options['queue']
+        batch_size = options['batch_size']
         throttle = CeleryThrottle(queue_name=q)
-        for i, idb_row in enumerate(queryset_generator(idb_rows)):
-            # Iterate over all items in the IDB and find them in the Docket
-            # table. If they're not there, create a new item.
-            if i < options['offset']:
-                continue
-            if i >= options['limit'] > 0:
-                break
+        new_idb_pks = []
+        merge_pairs = []
+        counts = {'new': 0, 'unique': 0, 'ambiguous': 0}
 
+        def create_batch():
             throttle.maybe_wait()
-            # TODO: See conversation in #courtlistener channel from 2019-07-11,
-            # In which it appears we matched a criminal case with a civil one.
-            # The code below doesn't protect against that, but it should (and I
-            # think it does in the `do_second_pass` code, below.
-            ds = Docket.objects.filter(
-                docket_number_core=idb_row.docket_number,
-                court=idb_row.district,
-            )
-            count = ds.count()
-            if count == 0:
-                logger.info("%s: Creating new docket for IDB row: %s",
-                            i, idb_row)
-                create_new_docket_from_idb.apply_async(
-                    args=(idb_row.pk,),
-                    queue=q,
-                )
+            logger.info("Creating %s new dockets for IDB rows.",
+                        len(new_idb_pks))
+            create_new_dockets_from_idb.apply_async(args=(new_idb_pks,),
+                                                    queue=q)
 
+        def merge_batch():
+            throttle.maybe_wait()
+            logger.info("Merging %s IDB rows into their dockets.",
+                        len(merge_pairs))
+            merge_dockets_with_idb.apply_async(args=(merge_pairs,), queue=q)
+
+        # TODO: See conversation in #courtlistener channel from 2019-07-11,
+        # In which it appears we matched a criminal case with a civil one.
+        # The matching doesn't protect against that, but it should (and I
+        # think it does in the `do_second_pass` code, below.
+        matches = match_idb_rows(CV_2017, offset=options['offset'],
+                                 limit=options['limit'])
+        for idb_pk, d_pk, count in matches:
+            if count == 0:
+                counts['new'] += 1
+                new_idb_pks.append(idb_pk)
+                if len(new_idb_pks) >= batch_size:
+                    create_batch()
+                    new_idb_pks = []
             elif count == 1:
-                d = ds[0]
-                logger.info("%s: Merging Docket %s with IDB row: %s",
-                            i, d, idb_row)
-                merge_docket_with_idb.apply_async(args=(d.pk, idb_row.pk),
-                                                  queue=q)
-            elif count > 1:
-                logger.warn("%s: Unable to merge. Got %s dockets for row: %s",
-                            i, count, idb_row)
+                counts['unique'] += 1
+                merge_pairs.append((d_pk, idb_pk))
+                if len(merge_pairs) >= batch_size:
+                    merge_batch()
+                    merge_pairs = []
+            else:
+                counts['ambiguous'] += 1
+                logger.warn("Unable to merge. Got %s dockets for IDB row: %s",
+                            count, idb_pk)
+
+        # Do any trailing items as well.
+        if new_idb_pks:
+            create_batch()
+        if merge_pairs:
+            merge_batch()
+        logger.info("Matched IDB rows to dockets. New: %s, unique matches: "
+                    "%s, ambiguous: %s.", counts['new'], counts['unique'],
+                    counts['ambiguous'])
 
     @staticmethod
     def do_second_pass(options):
@@ -1,15 +1,16 @@
 # Code for merging PACER content into the DB
 import logging
 import re
+from collections import OrderedDict, defaultdict
 from datetime import timedelta
 
-from django.core.exceptions import ValidationError
 from django.db import IntegrityError, OperationalError, transaction
 from django.db.models import Prefetch, Q
 from django.utils.timezone import now
 from juriscraper.lib.string_utils import CaseNameTweaker
 
 from cl.corpus_importer.utils import mark_ia_upload_needed
+from cl.lib.db_tools import bulk_update
 from cl.lib.decorators import retry
 from cl.lib.import_lib import get_candidate_judges
 from cl.lib.model_helpers import make_docket_number_core
@@ -72,86 +73,6 @@ def find_docket_object(court_id, pacer_case_id, docket_number):
     return d, 1
 
 
-def add_attorney(atty, p, d):
-    """Add/update an attorney.
-
-    Given an attorney node, and a party and a docket object, add the attorney
-    to the database or link the attorney to the new docket. Also add/update the
-    attorney organization, and the attorney's role in the case.
-
-    :param atty: A dict representing an attorney, as provided by Juriscraper.
-    :param p: A Party object
-    :param d: A Docket object
-    :return: None if there's an error, or an Attorney ID if not.
-    """
-    atty_org_info, atty_info = normalize_attorney_contact(
-        atty['contact'],
-        fallback_name=atty['name'],
-    )
-
-    # Try lookup by atty name in the docket.
-    attys = Attorney.objects.filter(name=atty['name'],
-                                    roles__docket=d).distinct()
-    count = attys.count()
-    if count == 0:
-        # Couldn't find the attorney. Make one.
-        a = Attorney.objects.create(
-            name=atty['name'],
-            contact_raw=atty['contact'],
-        )
-    elif count == 1:
-        # Nailed it.
-        a = attys[0]
-    elif count >= 2:
-        # Too many found, choose the most recent attorney.
-        logger.info("Got too many results for atty: '%s'. Picking earliest." %
-                    atty)
-        a = attys.earliest('date_created')
-
-    # Associate the attorney with an org and update their contact info.
-    if atty['contact']:
-        if atty_org_info:
-            try:
-                org = AttorneyOrganization.objects.get(
-                    lookup_key=atty_org_info['lookup_key'],
-                )
-            except AttorneyOrganization.DoesNotExist:
-                try:
-                    org = AttorneyOrganization.objects.create(**atty_org_info)
-                except IntegrityError:
-                    # Race condition. Item was created after get. Try again.
-                    org = AttorneyOrganization.objects.get(
-                        lookup_key=atty_org_info['lookup_key'],
-                    )
-
-            # Add the attorney to the organization
-            AttorneyOrganizationAssociation.objects.get_or_create(
-                attorney=a,
-                attorney_organization=org,
-                docket=d,
-            )
-
-        if atty_info:
-            a.contact_raw = atty['contact']
-            a.email = atty_info['email']
-            a.phone = atty_info['phone']
-            a.fax = atty_info['fax']
-            a.save()
-
-    # Do roles
-    roles = atty['roles']
-    if len(roles) == 0:
-        roles = [{'role': Role.UNKNOWN, 'date_action': None}]
-
-    # Delete the old roles, replace with new.
-    Role.objects.filter(attorney=a, party=p, docket=d).delete()
-    Role.objects.bulk_create([
-        Role(attorney=a, party=p, docket=d, **atty_role) for
-        atty_role in roles
-    ])
-    return a.pk
-
-
 def update_case_names(d, new_case_name):
     """Update the case name fields if applicable.
 
@@ -422,84 +343,316 @@ def normalize_long_description(docket_entry):
     docket_entry['description'] = desc
 
 
-def merge_unnumbered_docket_entries(des):
-    """Unnumbered docket entries come from many sources, with different data.
-    This sometimes results in two docket entries when there should be one. The
-    docket history report is the one source that sometimes has the long and
-    the short descriptions. When this happens, we have an opportunity to put
-    them back together again, deleting the duplicate items.
-
-    :param des: A QuerySet of DocketEntries that we believe are the same.
-    :return The winning DocketEntry
-    """
-    # Choose the earliest as the winner; delete the rest
-    winner = des.earliest('date_created')
-    des.exclude(pk=winner.pk).delete()
-    return winner
-
+class DocketEntryMerger(object):
+    """Merge docket entries and their documents into a docket, in a fixed
+    number of queries.
 
-def get_or_make_docket_entry(d, docket_entry):
-    """Lookup or create a docket entry to match the one that was scraped.
+    The docket entries and documents of the docket are loaded once. Entries
+    are matched and updated in memory, and then the changes are written all
+    at once: new items with bulk inserts, and changed items with narrow
+    updates of just the fields that changed. Items that didn't change aren't
+    written at all.
 
-    :param d: The docket we expect to find it in.
-    :param docket_entry: The scraped dict from Juriscraper for the docket
-    entry.
-    :return Tuple of (de, de_created) or None, where:
-     - de is the DocketEntry object
-     - de_created is a boolean stating whether de was created or not
-     - None is returned when things fail.
+    Matching works like it always has. Numbered entries are matched by their
+    number. Unnumbered entries are matched by date and by their long
+    description or the short description of one of their documents. If an
+    unnumbered entry matches more than one docket entry, the docket entries
+    are merged. Documents are matched by their number, type, and attachment
+    number.
     """
-    if docket_entry['document_number']:
-        try:
-            de, de_created = DocketEntry.objects.get_or_create(
-                docket=d,
-                entry_number=docket_entry['document_number'],
+    de_fields = ('entry_number', 'date_filed', 'description',
+                 'pacer_sequence_number', 'recap_sequence_number',
+                 'date_created')
+    rd_fields = ('docket_entry', 'document_number', 'attachment_number',
+                 'document_type', 'pacer_doc_id', 'description')
+
+    def __init__(self, d):
+        self.d = d
+        self.des_by_number = defaultdict(list)
+        # Documents are kept by the id() of their docket entry, since new
+        # docket entries don't have a pk until they're saved.
+        self.rds_by_de = defaultdict(list)
+        self.new_des = []
+        self.new_rds = []
+        self.changed_des = OrderedDict()
+        self.changed_rds = OrderedDict()
+        self.deleted_des = []
+        self.deleted_rds = []
+        self.merged_des = OrderedDict()
+        self.merged_rds = OrderedDict()
+
+        des = list(DocketEntry.objects.filter(docket=d).only(*self.de_fields))
+        des_by_pk = {}
+        for de in des:
+            self.des_by_number[de.entry_number].append(de)
+            des_by_pk[de.pk] = de
+        rds = RECAPDocument.objects.filter(
+            docket_entry__docket=d,
+        ).only(*self.rd_fields)
+        for rd in rds:
+            self.rds_by_de[id(des_by_pk[rd.docket_entry_id])].append(rd)
+
+    def get_docket_entry(self, docket_entry):
+        """Look up or make a docket entry to match the one that was scraped.
+
+        :param docket_entry: The scraped dict from Juriscraper for the docket
+        entry.
+        :return Tuple of (de, de_created) or None, where:
+         - de is the DocketEntry object
+         - de_created is a boolean stating whether de was created or not
+         - None is returned when things fail.
+        """
+        number = docket_entry['document_number']
+        if number not in (None, ''):
+            number = int(number)
+        if docket_entry['document_number']:
+            des = self.des_by_number[number]
+            if len(des) > 1:
+                logger.error("Multiple docket entries found for document "
+                             "entry number '%s' while processing '%s'",
+                             number, self.d)
+                return None
+            elif des:
+                return des[0], False
+        else:
+            # Unnumbered entry. The only thing we can be sure we have is a
+            # date. Try to find it by date and description (short or long)
+            normalize_long_description(docket_entry)
+            description = docket_entry.get('description')
+            short_description = docket_entry.get('short_description')
+            des = []
+            # Entries with the same number, which is usually None.
+            for de in self.des_by_number[number]:
+                if de.date_filed != docket_entry['date_filed']:
+                    continue
+                if (description or short_description) and not any([
+                    description and de.description == description,
+                    short_description and any(
+                        rd.description == short_description for rd in
+                        self.rds_by_de[id(de)]),
+                ]):
+                    continue
+                des.append(de)
+            if len(des) == 1:
+                return des[0], False
+            elif len(des) > 1:
+                logger.warning(
+                    "Multiple docket entries returned for unnumbered docket "
+                    "entry on date: %s while processing %s. Attempting merge",
+                    docket_entry['date_filed'], self.d,
+                )
+                return self.merge_unnumbered_docket_entries(des), False
+
+        de = DocketEntry(docket=self.d, entry_number=number)
+        self.des_by_number[number].append(de)
+        self.new_des.append(de)
+        return de, True
+
+    def merge_unnumbered_docket_entries(self, des):
+        """Unnumbered docket entries come from many sources, with different
+        data. This sometimes results in two docket entries when there should
+        be one. The docket history report is the one source that sometimes has
+        the long and the short descriptions. When this happens, we have an
+        opportunity to put them back together again, deleting the duplicate
+        items.
+
+        :param des: A list of DocketEntries that we believe are the same.
+        :return The winning DocketEntry
+        """
+        # Choose the earliest as the winner; delete the rest. Entries that
+        # are new in this upload are later than any that were saved before.
+        saved = sorted([de for de in des if de.pk is not None],
+                       key=lambda de: de.date_created)
+        winner = (saved + [de for de in des if de.pk is None])[0]
+        for de in des:
+            if de is not winner:
+                self.delete_docket_entry(de)
+        return winner
+
+    def delete_docket_entry(self, de):
+        self.des_by_number[de.entry_number].remove(de)
+        self.changed_des.pop(id(de), None)
+        self.merged_des.pop(id(de), None)
+        if de.pk is None:
+            self.new_des.remove(de)
+        else:
+            self.deleted_des.append(de)
+        # Its documents go with it, like they would with a cascading delete.
+        for rd in self.rds_by_de.pop(id(de), []):
+            self.forget_recap_document(rd)
+
+    def forget_recap_document(self, rd):
+        self.changed_rds.pop(id(rd), None)
+        self.merged_rds.pop(id(rd), None)
+        if rd.pk is None:
+            self.new_rds.remove(rd)
+
+    def update_docket_entry(self, de, docket_entry):
+        changed = update_fields(
+            de,
+            description=docket_entry['description'] or de.description,
+            date_filed=docket_entry['date_filed'] or de.date_filed,
+            pacer_sequence_number=docket_entry.get('pacer_seq_no') or
+            de.pacer_sequence_number,
+            recap_sequence_number=docket_entry['recap_sequence_number'],
+        )
+        if de.pk is not None and changed:
+            self.changed_des.setdefault(id(de), (de, set()))[1].update(
+                changed)
+        self.merged_des[id(de)] = de
+
+    def get_recap_document(self, de, docket_entry):
+        """Find the RECAPDocument of a docket entry, or make it.
+
+        :return: A tuple of the RECAPDocument and whether it was created, or
+        None if that can't be done.
+        """
+        # Normalize to "" here. Unsure why, but RECAPDocuments have a char
+        # field for this field while DocketEntries have a integer field.
+        document_number = unicode(docket_entry['document_number'] or '')
+        description = None
+        if not docket_entry['document_number'] and \
+                docket_entry.get('short_description'):
+            description = docket_entry['short_description']
+        attachment_number = None
+        if docket_entry.get('attachment_number'):
+            document_type = RECAPDocument.ATTACHMENT
+            attachment_number = int(docket_entry['attachment_number'])
+        else:
+            document_type = RECAPDocument.PACER_DOCUMENT
+
+        rds = [rd for rd in self.rds_by_de[id(de)] if all([
+            rd.document_number == document_number,
+            rd.document_type == document_type,
+            document_type == RECAPDocument.PACER_DOCUMENT or
+            rd.attachment_number == attachment_number,
+            description is None or rd.description == description,
+        ])]
+        if len(rds) > 1:
+            logger.error(
+                "Multiple recap documents found for document entry number'%s' "
+                "while processing '%s'" % (docket_entry['document_number'],
+                                           self.d)
             )
-        except DocketEntry.MultipleObjectsReturned:
-            logger.error("Multiple docket entries found for document "
-                         "entry number '%s' while processing '%s'",
-                         docket_entry['document_number'], d)
             return None
-    else:
-        # Unnumbered entry. The only thing we can be sure we have is a
-        # date. Try to find it by date and description (short or long)
-        normalize_long_description(docket_entry)
-        query = Q()
-        if docket_entry.get('description'):
-            query |= Q(description=docket_entry['description'])
-        if docket_entry.get('short_description'):
-            query |= Q(recap_documents__description=
-                       docket_entry['short_description'])
-
-        des = DocketEntry.objects.filter(
-            query,
-            docket=d,
-            date_filed=docket_entry['date_filed'],
-            entry_number=docket_entry['document_number'],
+        elif rds:
+            return rds[0], False
+
+        rd = RECAPDocument(
+            docket_entry=de,
+            document_number=document_number,
+            document_type=document_type,
+            attachment_number=attachment_number,
+            description=description or '',
+            pacer_doc_id=docket_entry['pacer_doc_id'] or '',
+            is_available=False,
         )
-        count = des.count()
-        if count == 0:
-            de = DocketEntry(
-                docket=d,
-                entry_number=docket_entry['document_number'],
-            )
-            de_created = True
-        elif count == 1:
-            de = des[0]
-            de_created = False
+        if not self.resolve_duplicates(de, rd, rd.pacer_doc_id):
+            return None
+        self.rds_by_de[id(de)].append(rd)
+        self.new_rds.append(rd)
+        return rd, True
+
+    def resolve_duplicates(self, de, rd, pacer_doc_id):
+        """Check that a document without an attachment number is the only one
+        of its number in its docket entry, the way RECAPDocument.save does.
+
+        None values in SQL are all considered different, so the database
+        can't do this check. If there is one duplicate with the same
+        pacer_doc_id, it's deleted.
+
+        :param pacer_doc_id: The pacer_doc_id the document will be saved with,
+        which can be new.
+        :return: True if the document can be saved, else False.
+        """
+        if rd.attachment_number is not None:
+            return True
+        others = [other for other in self.rds_by_de[id(de)] if all([
+            other is not rd,
+            other.document_number == rd.document_number,
+            other.attachment_number is None,
+        ])]
+        if not others:
+            return True
+        elif len(others) == 1 and others[0].pacer_doc_id == pacer_doc_id:
+            other = others[0]
+            self.rds_by_de[id(de)].remove(other)
+            self.forget_recap_document(other)
+            if other.pk is not None:
+                self.deleted_rds.append(other)
+            return True
+        return False
+
+    def update_recap_document(self, de, rd, docket_entry):
+        values = {
+            'pacer_doc_id': rd.pacer_doc_id or docket_entry['pacer_doc_id'] or
+            '',
+            'description': docket_entry.get('short_description') or
+            rd.description,
+        }
+        if rd.pk is not None:
+            if any(getattr(rd, k) != v for k, v in values.items()) and not \
+                    self.resolve_duplicates(de, rd, values['pacer_doc_id']):
+                return
+            changed = update_fields(rd, **values)
+            if changed:
+                self.changed_rds.setdefault(id(rd), (rd, set()))[1].update(
+                    changed)
         else:
-            logger.warning(
-                "Multiple docket entries returned for unnumbered docket "
-                "entry on date: %s while processing %s. Attempting merge",
-                docket_entry['date_filed'], d,
+            update_fields(rd, **values)
+        self.merged_rds[id(rd)] = rd
+
+    def save(self):
+        """Write the changes to the database.
+
+        :return: A list of the RECAPDocuments that were created.
+        """
+        if self.deleted_des:
+            DocketEntry.objects.filter(
+                pk__in=[de.pk for de in self.deleted_des]).delete()
+        for rd in self.deleted_rds:
+            rd.delete()
+
+        DocketEntry.objects.bulk_create(self.new_des)
+        for de, fields in self.changed_des.values():
+            DocketEntry.objects.filter(pk=de.pk).update(
+                date_modified=now(),
+                **{field: getattr(de, field) for field in fields}
             )
-            # There's so little metadata with unnumbered des that if there's
-            # more than one match, we can just select the oldest as canonical.
-            de = merge_unnumbered_docket_entries(des)
-            de_created = False
-    return de, de_created
 
+        for rd in self.new_rds:
+            # Set the ID of docket entries that were created above.
+            rd.docket_entry_id = rd.docket_entry.pk
+        RECAPDocument.objects.bulk_create(self.new_rds)
+        for rd, fields in self.changed_rds.values():
+            RECAPDocument.objects.filter(pk=rd.pk).update(
+                date_modified=now(),
+                **{field: getattr(rd, field) for field in fields}
+            )
+        return self.new_rds
 
+    def tag(self, tags):
+        """Tag the docket entries and documents that were merged."""
+        things = self.merged_des.values() + self.merged_rds.values()
+        for tag in tags:
+            tag.tag_objects(things)
+
+
+def update_fields(obj, **values):
+    """Set the fields of an object, and return the names of the fields whose
+    values changed.
+    """
+    changed = []
+    for name, value in values.items():
+        value = obj._meta.get_field(name).to_python(value)
+        if getattr(obj, name) != value:
+            setattr(obj, name, value)
+            changed.append(name)
+    return changed
+
+
+# Retry if another process adds the same items while the merge is underway.
+@retry(IntegrityError, tries=2, delay=1, backoff=1, logger=logger)
 def add_docket_entries(d, docket_entries, tags=None):
     """Update or create the docket entries and documents.
 
@@ -513,81 +666,32 @@ def add_docket_entries(d, docket_entries, tags=None):
     # Remove items without a date filed value.
     docket_entries = [de for de in docket_entries if de.get('date_filed')]
 
-    rds_created = []
     content_updated = False
     calculate_recap_sequence_numbers(docket_entries)
+    merger = DocketEntryMerger(d)
     for docket_entry in docket_entries:
-        response = get_or_make_docket_entry(d, docket_entry)
+        response = merger.get_docket_entry(docket_entry)
         if response is None:
             continue
         else:
             de, de_created = response[0], response[1]
 
-        de.description = docket_entry['description'] or de.description
-        de.date_filed = docket_entry['date_filed'] or de.date_filed
-        de.pacer_sequence_number = docket_entry.get('pacer_seq_no') or \
-            de.pacer_sequence_number
-        de.recap_sequence_number = docket_entry['recap_sequence_number']
-        de.save()
-        if tags:
-            for tag in tags:
-                tag.tag_object(de)
-
+        merger.update_docket_entry(de, docket_entry)
         if de_created:
             content_updated = True
 
         # Then make the RECAPDocument object. Try to find it. If we do, update
         # the pacer_doc_id field if it's blank. If we can't find it, create it
         # or throw an error.
-        params = {
-            'docket_entry': de,
-            # Normalize to "" here. Unsure why, but RECAPDocuments have a
-            # char field for this field while DocketEntries have a integer
-            # field.
-            'document_number': docket_entry['document_number'] or '',
-        }
-        if not docket_entry['document_number'] and \
-                docket_entry.get('short_description'):
-            params['description'] = docket_entry['short_description']
-
-        if docket_entry.get('attachment_number'):
-            params['document_type'] = RECAPDocument.ATTACHMENT
-            params['attachment_number'] = docket_entry['attachment_number']
-        else:
-            params['document_type'] = RECAPDocument.PACER_DOCUMENT
-
-        try:
-            rd = RECAPDocument.objects.get(**params)
-        except RECAPDocument.DoesNotExist:
-            try:
-                rd = RECAPDocument.objects.create(
-                    pacer_doc_id=docket_entry['pacer_doc_id'],
-                    is_available=False,
-                    **params
-                )
-            except ValidationError:
-                # Happens from race conditions.
-                continue
-            rds_created.append(rd)
-        except RECAPDocument.MultipleObjectsReturned:
-            logger.error(
-                "Multiple recap documents found for document entry number'%s' "
-                "while processing '%s'" % (docket_entry['document_number'], d)
-            )
-            continue
-
-        rd.pacer_doc_id = rd.pacer_doc_id or docket_entry['pacer_doc_id']
-        rd.description = docket_entry.get(
-            'short_description') or rd.description
-        try:
-            rd.save()
-        except ValidationError:
-            # Happens from race conditions.
+        response = merger.get_recap_document(de, docket_entry)
+        if response is None:
             continue
-        if tags:
-            for tag in tags:
-                tag.tag_object(rd)
+        merger.update_recap_document(de, response[0], docket_entry)
 
+    with transaction.atomic():
+        rds_created = merger.save()
+    if tags:
+        merger.tag(tags)
     return rds_created, content_updated
 
 
@@ -766,44 +870,75 @@ def disassociate_extraneous_entities(d, parties, parties_to_preserve,
     ).delete()
 
 
-@transaction.atomic
-# Retry on transaction deadlocks; see #814.
-@retry(OperationalError, tries=2, delay=1, backoff=1, logger=logger)
-def add_parties_and_attorneys(d, parties):
-    """Add parties and attorneys from the docket data to the docket.
-
-    :param d: The docket to update
-    :param parties: The parties to update the docket with, with their
-    associated attorney objects. This is typically the
-    docket_data['parties'] field.
-    :return: None
+class PartyReconciler(object):
+    """Reconcile the parties and attorneys of a docket with the ones that
+    were scraped, in a fixed number of queries.
 
+    Everything the docket already has is loaded up front: its parties, party
+    types, attorneys, attorney roles and organization associations. The
+    scraped parties and attorneys are matched against it in memory by name,
+    and the result is written with bulk inserts, updates and deletes. Roles
+    that didn't change aren't rewritten.
     """
-    normalize_attorney_roles(parties)
 
-    updated_parties = set()
-    updated_attorneys = set()
-    for party in parties:
-        ps = Party.objects.filter(name=party['name'],
-                                  party_types__docket=d).distinct()
-        count = ps.count()
-        if count == 0:
-            try:
-                p = Party.objects.create(name=party['name'])
-            except IntegrityError:
-                # Race condition. Object was created after our get and before
-                # our create. Try to get it again.
-                ps = Party.objects.filter(name=party['name'],
-                                          party_types__docket=d).distinct()
-                count = ps.count()
-        if count == 1:
+    def __init__(self, d):
+        self.d = d
+        self.parties_by_name = defaultdict(list)
+        parties_by_pk = {}
+        for p in Party.objects.filter(
+                party_types__docket=d).distinct().only('name',
+                                                       'date_created'):
+            self.parties_by_name[p.name].append(p)
+            parties_by_pk[p.pk] = p
+        # Party types are kept by the id() of their party, since new parties
+        # don't have a pk until they're saved.
+        self.party_types = {
+            (id(parties_by_pk[pt.party_id]), pt.name): pt for pt in
+            PartyType.objects.filter(docket=d)
+        }
+        self.attys_by_name = defaultdict(list)
+        for a in Attorney.objects.filter(roles__docket=d).distinct():
+            self.attys_by_name[a.name].append(a)
+        self.roles = defaultdict(dict)
+        for pk, attorney_id, party_id, role, date_action, role_raw in \
+                Role.objects.filter(docket=d).values_list(
+                    'pk', 'attorney_id', 'party_id', 'role', 'date_action',
+                    'role_raw'):
+            self.roles[(attorney_id, party_id)][
+                (role, date_action, role_raw)] = pk
+        self.associations = set(
+            AttorneyOrganizationAssociation.objects.filter(
+                docket=d,
+            ).values_list('attorney_id', 'attorney_organization_id'))
+
+        self.new_parties = []
+        self.new_attys = []
+        self.new_party_types = []
+        self.changed_attys = OrderedDict()
+        self.changed_party_types = OrderedDict()
+        self.changed_party_type_fields = set()
+        self.criminal_counts = OrderedDict()
+        self.criminal_complaints = OrderedDict()
+        self.org_infos = OrderedDict()
+        self.atty_orgs = OrderedDict()
+        self.atty_roles = OrderedDict()
+        self.updated_parties = OrderedDict()
+        self.updated_attys = OrderedDict()
+
+    def add_party(self, party):
+        """Match a scraped party, with its attorneys, to the docket."""
+        ps = self.parties_by_name[party['name']]
+        if len(ps) == 0:
+            p = Party(name=party['name'])
+            ps.append(p)
+            self.new_parties.append(p)
+        elif len(ps) == 1:
             p = ps[0]
-        elif count >= 2:
-            p = ps.earliest('date_created')
-        updated_parties.add(p.pk)
+        else:
+            p = min(ps, key=lambda p: p.date_created)
+        self.updated_parties[id(p)] = p
 
         # If the party type doesn't exist, make a new one.
-        pts = p.party_types.filter(docket=d, name=party['type'])
         criminal_data = party.get('criminal_data')
         update_dict = {
             'extra_info': party.get('extra_info', ''),
@@ -814,37 +949,221 @@ def add_parties_and_attorneys(d, parties):
                 'highest_offense_level_opening']
             update_dict['highest_offense_level_terminated'] = criminal_data[
                 'highest_offense_level_terminated']
-        if pts.exists():
-            pts.update(**update_dict)
-            pt = pts[0]
+        pt = self.party_types.get((id(p), party['type']))
+        if pt is None:
+            pt = PartyType(docket=self.d, party=p, name=party['type'],
+                           **update_dict)
+            self.party_types[(id(p), party['type'])] = pt
+            self.new_party_types.append(pt)
         else:
-            pt = PartyType.objects.create(docket=d, party=p,
-                                          name=party['type'], **update_dict)
+            changed = update_fields(pt, **update_dict)
+            if changed:
+                self.changed_party_types[id(pt)] = pt
+                self.changed_party_type_fields.update(changed)
 
         # Criminal counts and complaints
         if criminal_data and criminal_data['counts']:
-            CriminalCount.objects.filter(party_type=pt).delete()
-            CriminalCount.objects.bulk_create([
+            self.criminal_counts[id(pt)] = (pt, [
                 CriminalCount(
-                    party_type=pt, name=criminal_count['name'],
+                    name=criminal_count['name'],
                     disposition=criminal_count['disposition'],
                     status=CriminalCount.normalize_status(
                         criminal_count['status'])
                 ) for criminal_count in criminal_data['counts']
             ])
-
         if criminal_data and criminal_data['complaints']:
-            CriminalComplaint.objects.filter(party_type=pt).delete()
-            CriminalComplaint.objects.bulk_create([
+            self.criminal_complaints[id(pt)] = (pt, [
                 CriminalComplaint(
-                    party_type=pt, name=complaint['name'],
+                    name=complaint['name'],
                     disposition=complaint['disposition'],
                 ) for complaint in criminal_data['complaints']
             ])
 
         # Attorneys
         for atty in party.get('attorneys', []):
-            updated_attorneys.add(add_attorney(atty, p, d))
+            self.add_attorney(atty, p)
+
+    def add_attorney(self, atty, p):
+        """Match a scraped attorney of a party to the docket."""
+        atty_org_info, atty_info = normalize_attorney_contact(
+            atty['contact'],
+            fallback_name=atty['name'],
+        )
+
+        # Try lookup by atty name in the docket.
+        attys = self.attys_by_name[atty['name']]
+        if len(attys) == 0:
+            # Couldn't find the attorney. Make one.
+            a = Attorney(name=atty['name'], contact_raw=atty['contact'])
+            attys.append(a)
+            self.new_attys.append(a)
+        elif len(attys) == 1:
+            # Nailed it.
+            a = attys[0]
+        else:
+            # Too many found, choose the most recent attorney.
+            logger.info("Got too many results for atty: '%s'. Picking "
+                        "earliest." % atty)
+            a = min(attys, key=lambda a: a.date_created)
+        self.updated_attys[id(a)] = a
+
+        # Associate the attorney with an org and update their contact info.
+        if atty['contact']:
+            if atty_org_info:
+                lookup_key = atty_org_info['lookup_key']
+                self.org_infos.setdefault(lookup_key, atty_org_info)
+                self.atty_orgs[(id(a), lookup_key)] = (a, lookup_key)
+
+            if atty_info:
+                changed = update_fields(
+                    a,
+                    contact_raw=atty['contact'],
+                    email=atty_info['email'],
+                    phone=atty_info['phone'],
+                    fax=atty_info['fax'],
+                )
+                if a.pk is not None and changed:
+                    self.changed_attys[id(a)] = a
+
+        # Do roles. These replace the old roles of the attorney for the party.
+        roles = atty['roles']
+        if len(roles) == 0:
+            roles = [{'role': Role.UNKNOWN, 'date_action': None}]
+        self.atty_roles[(id(a), id(p))] = (a, p, roles)
+
+    def get_organizations(self):
+        """Get or make the organizations of the scraped attorneys.
+
+        :return: A dict of the organizations, keyed by their lookup keys.
+        """
+        orgs = {org.lookup_key: org for org in
+                AttorneyOrganization.objects.filter(
+                    lookup_key__in=self.org_infos.keys())}
+        new_orgs = [AttorneyOrganization(**org_info) for lookup_key, org_info
+                    in self.org_infos.items() if lookup_key not in orgs]
+        try:
+            with transaction.atomic():
+                AttorneyOrganization.objects.bulk_create(new_orgs)
+        except IntegrityError:
+            # Race condition. Items were created after our get. Make them
+            # one at a time, and get the ones that already exist.
+            for org in new_orgs:
+                try:
+                    with transaction.atomic():
+                        org.save()
+                except IntegrityError:
+                    org = AttorneyOrganization.objects.get(
+                        lookup_key=org.lookup_key,
+                    )
+                orgs[org.lookup_key] = org
+        else:
+            orgs.update((org.lookup_key, org) for org in new_orgs)
+        return orgs
+
+    def save(self):
+        """Write the changes to the database.
+
+        :return: A tuple of the IDs of the parties and of the attorneys that
+        were created or updated.
+        """
+        orgs = self.get_organizations()
+
+        Party.objects.bulk_create(self.new_parties)
+        Attorney.objects.bulk_create(self.new_attys)
+        changed_attys = self.changed_attys.values()
+        for a in changed_attys:
+            a.date_modified = now()
+        bulk_update(changed_attys, ['contact_raw', 'email', 'phone', 'fax',
+                                    'date_modified'])
+
+        for pt in self.new_party_types:
+            # Set the ID of parties that were created above.
+            pt.party_id = pt.party.pk
+        PartyType.objects.bulk_create(self.new_party_types)
+        bulk_update(self.changed_party_types.values(),
+                    self.changed_party_type_fields)
+
+        for model, by_party_type in (
+                (CriminalCount, self.criminal_counts),
+                (CriminalComplaint, self.criminal_complaints)):
+            model.objects.filter(party_type_id__in=[
+                pt.pk for pt, _ in by_party_type.values()
+            ]).delete()
+            new_items = []
+            for pt, items in by_party_type.values():
+                for item in items:
+                    item.party_type_id = pt.pk
+                    new_items.append(item)
+            model.objects.bulk_create(new_items)
+
+        new_associations = set()
+        for a, lookup_key in self.atty_orgs.values():
+            pair = (a.pk, orgs[lookup_key].pk)
+            if pair not in self.associations:
+                new_associations.add(pair)
+        AttorneyOrganizationAssociation.objects.bulk_create([
+            AttorneyOrganizationAssociation(
+                attorney_id=attorney_id,
+                attorney_organization_id=org_id,
+                docket=self.d,
+            ) for attorney_id, org_id in new_associations
+        ])
+
+        # Delete the old roles that aren't in the new ones, and add the rest.
+        old_role_pks = []
+        new_roles = []
+        for a, p, roles in self.atty_roles.values():
+            old_roles = self.roles.get((a.pk, p.pk), {})
+            roles = OrderedDict(((r['role'], r['date_action'],
+                                  r.get('role_raw', '')), r) for r in roles)
+            old_role_pks.extend(pk for key, pk in old_roles.items() if
+                                key not in roles)
+            new_roles.extend(
+                Role(attorney=a, party=p, docket=self.d, **atty_role) for
+                key, atty_role in roles.items() if key not in old_roles
+            )
+        Role.objects.filter(pk__in=old_role_pks).delete()
+        Role.objects.bulk_create(new_roles)
+
+        return ({p.pk for p in self.updated_parties.values()},
+                {a.pk for a in self.updated_attys.values()})
+
+
+@transaction.atomic
+def add_parties_and_attorneys(d, parties):
+    """Add parties and attorneys from the docket data to the docket.
+
+    :param d: The docket to update
+    :param parties: The parties to update the docket with, with their
+    associated attorney objects. This is typically the
+    docket_data['parties'] field.
+    :return: None
+
+    """
+    # Normalize only once, since the roles can't be normalized again if the
+    # reconciliation is retried.
+    normalize_attorney_roles(parties)
+    reconcile_parties_and_attorneys(d, parties)
+
+
+# Retry on transaction deadlocks (see #814), and on races with other processes
+# adding the same parties or attorneys.
+@retry((OperationalError, IntegrityError), tries=2, delay=1, backoff=1,
+       logger=logger)
+def reconcile_parties_and_attorneys(d, parties):
+    """Reconcile the parties and attorneys of a docket with the parties from
+    the docket data, once their attorney roles have been normalized.
+
+    :param d: The docket to update
+    :param parties: The parties from the docket data, after
+    normalize_attorney_roles.
+    :return: None
+    """
+    reconciler = PartyReconciler(d)
+    for party in parties:
+        reconciler.add_party(party)
+    with transaction.atomic():
+        updated_parties, updated_attorneys = reconciler.save()
 
     disassociate_extraneous_entities(d, parties, updated_parties,
                                      updated_attorneys)
@@ -31,6 +31,7 @@ from cl.recap.models import PacerHtmlFiles, ProcessingQueue, UPLOAD_TYPE, \
     FjcIntegratedDatabase, REQUEST_TYPE, PacerFetchQueue, PROCESSING_STATUS
 from cl.scrapers.tasks import extract_recap_pdf, get_page_count
 from cl.search.models import Docket, DocketEntry, RECAPDocument, Tag
+from cl.search.outbox import index_items
 from cl.search.tasks import add_or_update_recap_docket, add_items_to_solr
 
 
@@ -309,7 +310,7 @@ def process_recap_pdf(self, pk):
 
     if not existing_document and not pq.debug:
         extract_recap_pdf(rd.pk)
-        add_items_to_solr([rd.pk], 'search.RECAPDocument')
+        index_items([rd.pk], 'search.RECAPDocument', reason='recap_upload')
 
     mark_pq_successful(pq, d_id=rd.docket_entry.docket_id,
                        de_id=rd.docket_entry_id, rd_id=rd.pk)
@@ -723,20 +724,17 @@ def process_recap_appellate_attachment(self, pk):
     return None
 
 
-@app.task
-def create_new_docket_from_idb(idb_pk):
-    """Create a new docket for the IDB item found. Populate it with all
-    applicable fields.
+def make_docket_from_idb_row(idb_row):
+    """Create a new docket for an IDB row. Populate it with all applicable
+    fields.
 
-    :param idb_pk: An FjcIntegratedDatabase object pk with which to create a
-    Docket.
+    :param idb_row: An FjcIntegratedDatabase object.
     :return Docket: The created Docket object.
     """
-    idb_row = FjcIntegratedDatabase.objects.get(pk=idb_pk)
     case_name = idb_row.plaintiff + ' v. ' + idb_row.defendant
     d = Docket.objects.create(
         source=Docket.IDB,
-        court=idb_row.district,
+        court_id=idb_row.district_id,
         idb_data=idb_row,
         date_filed=idb_row.date_filed,
         date_terminated=idb_row.date_terminated,
@@ -746,22 +744,18 @@ def create_new_docket_from_idb(idb_pk):
         nature_of_suit=idb_row.get_nature_of_suit_display(),
         jurisdiction_type=idb_row.get_jurisdiction_display() or '',
     )
-    d.save()
     logger.info("Created docket %s for IDB row: %s", d.pk, idb_row)
-    return d.pk
+    return d
 
 
-@app.task
-def merge_docket_with_idb(d_pk, idb_pk):
-    """Merge an existing docket with an idb_row.
+def merge_idb_row_into_docket(d, idb_row):
+    """Merge an IDB row into an existing docket and save it.
 
-    :param d_pk: A Docket object pk to update.
-    :param idb_pk: A FjcIntegratedDatabase object pk to use as a source for
+    :param d: A Docket object to update.
+    :param idb_row: A FjcIntegratedDatabase object to use as a source for
     updates.
     :return None
     """
-    d = Docket.objects.get(pk=d_pk)
-    idb_row = FjcIntegratedDatabase.objects.get(pk=idb_pk)
     d.add_idb_source()
     d.idb_data = idb_row
     d.date_filed = d.date_filed or idb_row.date_filed
@@ -772,6 +766,64 @@ def merge_docket_with_idb(d_pk, idb_pk):
     d.save()
 
 
+@app.task
+def create_new_docket_from_idb(idb_pk):
+    """Create a new docket for the IDB item found. Populate it with all
+    applicable fields.
+
+    :param idb_pk: An FjcIntegratedDatabase object pk with which to create a
+    Docket.
+    :return Docket: The created Docket object.
+    """
+    idb_row = FjcIntegratedDatabase.objects.get(pk=idb_pk)
+    return make_docket_from_idb_row(idb_row).pk
+
+
+@app.task
+def create_new_dockets_from_idb(idb_pks):
+    """Create a new docket for each of a batch of IDB rows.
+
+    :param idb_pks: A list of FjcIntegratedDatabase object pks.
+    :return: A list of the pks of the created Docket objects.
+    """
+    idb_rows = FjcIntegratedDatabase.objects.filter(
+        pk__in=idb_pks).order_by('pk')
+    d_pks = []
+    with transaction.atomic():
+        for idb_row in idb_rows:
+            d_pks.append(make_docket_from_idb_row(idb_row).pk)
+    return d_pks
+
+
+@app.task
+def merge_docket_with_idb(d_pk, idb_pk):
+    """Merge an existing docket with an idb_row.
+
+    :param d_pk: A Docket object pk to update.
+    :param idb_pk: A FjcIntegratedDatabase object pk to use as a source for
+    updates.
+    :return None
+    """
+    d = Docket.objects.get(pk=d_pk)
+    idb_row = FjcIntegratedDatabase.objects.get(pk=idb_pk)
+    merge_idb_row_into_docket(d, idb_row)
+
+
+@app.task
+def merge_dockets_with_idb(pairs):
+    """Merge a batch of IDB rows into their existing dockets.
+
+    :param pairs: A list of (Docket pk, FjcIntegratedDatabase pk) tuples.
+    :return None
+    """
+    d_pks, idb_pks = zip(*pairs) if pairs else ((), ())
+    dockets = Docket.objects.in_bulk(d_pks)
+    idb_rows = FjcIntegratedDatabase.objects.in_bulk(idb_pks)
+    with transaction.atomic():
+        for d_pk, idb_pk in pairs:
+            merge_idb_row_into_docket(dockets[d_pk], idb_rows[idb_pk])
+
+
 @app.task
 def update_docket_from_hidden_api(data):
     """Update the docket based on the result of a lookup in the hidden API.
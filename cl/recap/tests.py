@@ -1,6 +1,8 @@
 # coding=utf-8
 import json
 import os
+import shutil
+import tempfile
 from datetime import date
 
 import mock
@@ -8,7 +10,10 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from juriscraper.pacer import PacerRssFeed
 from rest_framework.status import (
@@ -21,16 +26,21 @@ from rest_framework.test import APIClient
 
 from cl.people_db.models import Attorney, AttorneyOrganizationAssociation, \
     CriminalComplaint, CriminalCount, Party, PartyType, Role
+from cl.recap.constants import CV_2017, IDB_FIELD_DATA
 from cl.recap.management.commands.import_idb import Command
-from cl.recap.mergers import add_attorney, add_docket_entries, \
+from cl.recap.management.commands.merge_idb_into_dockets import \
+    match_idb_rows
+from cl.recap.mergers import PartyReconciler, add_docket_entries, \
     add_parties_and_attorneys, normalize_long_description, \
     update_case_names, update_docket_metadata
-from cl.recap.models import PROCESSING_STATUS, ProcessingQueue, UPLOAD_TYPE
+from cl.recap.models import FjcIntegratedDatabase, PROCESSING_STATUS, \
+    ProcessingQueue, UPLOAD_TYPE
 from cl.recap.mergers import find_docket_object
-from cl.recap.tasks import process_recap_appellate_docket, \
+from cl.recap.tasks import create_new_dockets_from_idb, \
+    merge_dockets_with_idb, process_recap_appellate_docket, \
     process_recap_attachment, process_recap_docket, process_recap_pdf
-from cl.search.models import Docket, DocketEntry, \
-    OriginatingCourtInformation, RECAPDocument
+from cl.search.models import Court, Docket, DocketEntry, \
+    OriginatingCourtInformation, RECAPDocument, Tag
 
 
 @mock.patch('cl.recap.views.process_recap_upload')
@@ -290,8 +300,7 @@ class DebugRecapUploadtest(TestCase):
         self.assertEqual(RECAPDocument.objects.count(), 0)
         mock.assert_not_called()
 
-    @mock.patch('cl.recap.mergers.add_attorney')
-    def test_debug_does_not_create_docket(self, add_atty_mock):
+    def test_debug_does_not_create_docket(self):
         """If debug is passed, do we avoid creating a docket?"""
         pq = ProcessingQueue.objects.create(
             court_id='scotus',
@@ -476,9 +485,18 @@ class RecapAddAttorneyTest(TestCase):
                                        date_filed=date(2017, 1, 1))
         self.p = Party.objects.create(name="John Wesley Powell")
 
+    def add_attorney(self):
+        """Add the attorney to the party in the docket, and return the ID of
+        the attorney.
+        """
+        reconciler = PartyReconciler(self.d)
+        reconciler.add_attorney(self.atty, self.p)
+        _, attorney_pks = reconciler.save()
+        return attorney_pks.pop()
+
     def test_new_atty_to_db(self):
         """Can we add a new atty to the DB when none exist?"""
-        a_pk = add_attorney(self.atty, self.p, self.d)
+        a_pk = self.add_attorney()
         a = Attorney.objects.get(pk=a_pk)
         self.assertEqual(a.contact_raw, self.atty['contact'])
         self.assertEqual(a.name, self.atty['name'])
@@ -496,7 +514,7 @@ class RecapAddAttorneyTest(TestCase):
     def test_no_contact_info(self):
         """Do things work properly when we lack contact information?"""
         self.atty['contact'] = ""
-        a_pk = add_attorney(self.atty, self.p, self.d)
+        a_pk = self.add_attorney()
         a = Attorney.objects.get(pk=a_pk)
         # No org info added because none provided:
         self.assertEqual(a.organizations.all().count(), 0)
@@ -509,7 +527,7 @@ class RecapAddAttorneyTest(TestCase):
         """
         new_a = Attorney.objects.create(name=self.atty_name)
         self.atty['contact'] = ''
-        a_pk = add_attorney(self.atty, self.p, self.d)
+        a_pk = self.add_attorney()
         a = Attorney.objects.get(pk=a_pk)
         self.assertNotEqual(a.pk, new_a.pk)
 
@@ -519,7 +537,7 @@ class RecapAddAttorneyTest(TestCase):
                                         email=self.atty_email)
         r = Role.objects.create(attorney=new_a, party=self.p, docket=self.d,
                                 role=Role.DISBARRED)
-        a_pk = add_attorney(self.atty, self.p, self.d)
+        a_pk = self.add_attorney()
         a = Attorney.objects.get(pk=a_pk)
         self.assertEqual(new_a.pk, a.pk)
         roles = a.roles.all()
@@ -527,6 +545,100 @@ class RecapAddAttorneyTest(TestCase):
         self.assertNotIn(r, roles)
 
 
+class PartyReconciliationQueryCountTest(TestCase):
+    """Does reconciling the parties of a big multi-defendant docket take the
+    same number of queries as a small one?"""
+
+    @staticmethod
+    def make_parties(count, firm):
+        """Make the parties of a criminal docket, with a few attorneys per
+        defendant, drawn from a handful of firms.
+        """
+        parties = []
+        for i in range(count):
+            parties.append({
+                'name': 'Defendant %s' % i,
+                'type': 'Defendant',
+                'extra_info': '',
+                'date_terminated': None,
+                'criminal_data': {
+                    'highest_offense_level_opening': 'Felony',
+                    'highest_offense_level_terminated': '',
+                    'counts': [{
+                        'name': 'Conspiracy',
+                        'disposition': '',
+                        'status': 'pending',
+                    }],
+                    'complaints': [],
+                },
+                'attorneys': [{
+                    'name': 'Attorney %s' % (i * 3 + j),
+                    'contact': '%s %s LLP\n'
+                               '701 West Eighth Avenue, Suite 1200\n'
+                               'Anchorage, AK 99501\n'
+                               '907-276-5152\n'
+                               'Email: atty%s@example.com' % (firm, j,
+                                                              i * 3 + j),
+                    'roles': ['LEAD ATTORNEY', 'ATTORNEY TO BE NOTICED'],
+                } for j in range(3)],
+            })
+        return parties
+
+    def count_queries(self, d, parties):
+        with CaptureQueriesContext(connection) as context:
+            add_parties_and_attorneys(d, parties)
+        return len(context.captured_queries)
+
+    def test_query_count_does_not_grow_with_parties(self):
+        small_d = Docket.objects.create(source=0, court_id='scotus')
+        big_d = Docket.objects.create(source=0, court_id='scotus')
+        small_count = self.count_queries(small_d,
+                                         self.make_parties(5, 'Lewis'))
+        big_count = self.count_queries(big_d, self.make_parties(100, 'Clark'))
+        self.assertEqual(small_count, big_count)
+        self.assertEqual(PartyType.objects.filter(docket=big_d).count(), 100)
+        self.assertEqual(Role.objects.filter(docket=big_d).count(), 600)
+        self.assertEqual(
+            CriminalCount.objects.filter(party_type__docket=big_d).count(),
+            100,
+        )
+
+        # Again, when everything is already there.
+        big_count = self.count_queries(big_d, self.make_parties(100, 'Clark'))
+        self.assertLessEqual(big_count, small_count)
+        self.assertEqual(Party.objects.filter(
+            party_types__docket=big_d).count(), 100)
+        self.assertEqual(Role.objects.filter(docket=big_d).count(), 600)
+        self.assertEqual(
+            AttorneyOrganizationAssociation.objects.filter(
+                docket=big_d).count(),
+            300,
+        )
+
+    @mock.patch('cl.lib.decorators.time.sleep')
+    def test_retry_after_integrity_error(self, mock_sleep):
+        """If another process adds the same parties first, is the merge
+        retried with the parties as they were given?
+        """
+        d = Docket.objects.create(source=0, court_id='scotus')
+        save = PartyReconciler.save
+        calls = []
+
+        def save_once_with_error(reconciler):
+            calls.append(reconciler)
+            if len(calls) == 1:
+                raise IntegrityError("Duplicate key")
+            return save(reconciler)
+
+        with mock.patch.object(PartyReconciler, 'save', autospec=True,
+                               side_effect=save_once_with_error):
+            add_parties_and_attorneys(d, self.make_parties(2, 'Lewis'))
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(PartyType.objects.filter(docket=d).count(), 2)
+        self.assertEqual(Role.objects.filter(docket=d).count(), 12)
+
+
 class DocketCaseNameUpdateTest(TestCase):
     """Do we properly handle the nine cases of incoming case name
     information?
@@ -854,6 +966,88 @@ class RecapMinuteEntriesTest(TestCase):
         expected_item_count = 1
         self.assertEqual(d.docket_entries.count(), expected_item_count)
 
+    def test_merging_entries_again_only_writes_changes(self):
+        """Are entries with attachments merged once, updated in place, and
+        tagged?"""
+        d = Docket.objects.create(source=0, court_id='scotus')
+        tag = Tag.objects.create(name='test-merge')
+        docket_entries = [{
+            'date_filed': date(2014, 11, 16),
+            'description': 'Complaint',
+            'document_number': 1,
+            'pacer_doc_id': '123',
+            'pacer_seq_no': None,
+        }, {
+            'date_filed': date(2014, 11, 16),
+            'description': 'Complaint',
+            'document_number': 1,
+            'attachment_number': 1,
+            'pacer_doc_id': '124',
+            'pacer_seq_no': None,
+        }, {
+            'date_filed': date(2014, 11, 17),
+            'description': 'Minute entry',
+            'document_number': None,
+            'pacer_doc_id': None,
+            'pacer_seq_no': None,
+        }]
+        rds_created, content_updated = add_docket_entries(
+            d, docket_entries, tags=[tag])
+        self.assertEqual(len(rds_created), 3)
+        self.assertTrue(content_updated)
+        self.assertEqual(d.docket_entries.count(), 2)
+        self.assertEqual(tag.docket_entries.count(), 2)
+        self.assertEqual(tag.recap_documents.count(), 3)
+
+        for docket_entry in docket_entries[:2]:
+            docket_entry['description'] = 'Amended complaint'
+        # Two loads, an update of the changed entry, and checking the tags of
+        # the entries and the documents, with savepoints around the writes.
+        with self.assertNumQueries(11):
+            rds_created, content_updated = add_docket_entries(
+                d, docket_entries, tags=[tag])
+        self.assertEqual(rds_created, [])
+        self.assertFalse(content_updated)
+        self.assertEqual(d.docket_entries.count(), 2)
+        self.assertEqual(
+            d.docket_entries.get(entry_number=1).description,
+            'Amended complaint',
+        )
+        self.assertEqual(tag.recap_documents.count(), 3)
+
+
+    def test_duplicate_with_the_new_pacer_doc_id_is_deleted(self):
+        """If a document gets a pacer_doc_id that a duplicate of it already
+        has, is the duplicate deleted, the way RECAPDocument.save does it?
+        """
+        d = Docket.objects.create(source=0, court_id='scotus')
+        de = DocketEntry.objects.create(docket=d, entry_number=1,
+                                        date_filed=date(2014, 11, 16))
+        rd = RECAPDocument.objects.create(
+            docket_entry=de,
+            document_number='1',
+            pacer_doc_id='',
+            document_type=RECAPDocument.PACER_DOCUMENT,
+        )
+        # save() won't make a duplicate, so go around it.
+        RECAPDocument.objects.bulk_create([RECAPDocument(
+            docket_entry=de,
+            document_number='1',
+            pacer_doc_id='123',
+            document_type=RECAPDocument.ATTACHMENT,
+        )])
+        add_docket_entries(d, [{
+            'date_filed': date(2014, 11, 16),
+            'description': 'Complaint',
+            'document_number': 1,
+            'pacer_doc_id': '123',
+            'pacer_seq_no': None,
+        }])
+        self.assertEqual(
+            list(de.recap_documents.values_list('pk', 'pacer_doc_id')),
+            [(rd.pk, '123')],
+        )
+
 
 class DescriptionCleanupTest(TestCase):
 
@@ -1184,3 +1378,131 @@ class IdbImportTest(TestCase):
                 self.cmd.make_csv_row_dict(qa[0], ['1', '2', '3']),
                 qa[1],
             )
+
+
+class IdbCopyLoaderTest(TestCase):
+    """Does the IDB importer load files with COPY, and resume from its
+    checkpoint?
+    """
+    fixtures = ['court_data.json']
+
+    def setUp(self):
+        Court.objects.filter(pk='ca9').update(fjc_court_id='9')
+        Court.objects.filter(pk='hid').update(fjc_court_id='75')
+        self.tmp_dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tmp_dir, 'checkpoint')
+        self.path = os.path.join(self.tmp_dir, 'cv2017.txt')
+        self.write_file()
+
+    def write_file(self, skip_headers=()):
+        headers = sorted(k for k, v in IDB_FIELD_DATA.items() if
+                         CV_2017 in v['sources'] and k not in skip_headers)
+        lines = ['\t'.join(headers)]
+        for i in range(3):
+            row = dict.fromkeys(headers, '-8')
+            row.update({
+                'CIRCUIT': '09',
+                'DISTRICT': '75',
+                'DOCKET': '170000%s' % i,
+                'FILEDATE': '10/0%s/2017' % (i + 1),
+                'PLT': '"WOLF\tEXCHANGE ""LLC"""',
+                'DEF': 'BACKSLASH \\ CO',
+            })
+            lines.append('\t'.join(row[header] for header in headers))
+        with open(self.path, 'wb') as f:
+            f.write('\r\n'.join(lines) + '\r\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def import_idb(self):
+        call_command('import_idb', input_file=self.path, filetype=CV_2017,
+                     chunk_size=2, checkpoint=self.checkpoint)
+
+    def test_copy_and_resume(self):
+        self.import_idb()
+        rows = FjcIntegratedDatabase.objects.order_by('docket_number')
+        self.assertEqual(rows.count(), 3)
+        row = rows[0]
+        self.assertEqual(row.dataset_source, CV_2017)
+        self.assertEqual(row.circuit_id, 'ca9')
+        self.assertEqual(row.district_id, 'hid')
+        self.assertEqual(row.date_filed, date(2017, 10, 1))
+        self.assertIsNone(row.date_terminated)
+        self.assertEqual(row.plaintiff, 'WOLFEXCHANGE "LLC"')
+        self.assertEqual(row.defendant, 'BACKSLASH \\ CO')
+        self.assertIsNotNone(row.date_created)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f), {'chunk': 1,
+                                            'max_pk': rows.last().pk})
+
+        # Everything was loaded, so running it again loads nothing.
+        self.import_idb()
+        self.assertEqual(rows.count(), 3)
+
+    def test_chunk_committed_without_checkpoint(self):
+        """If the last chunk was committed but its checkpoint wasn't written,
+        is it loaded only once?
+        """
+        self.import_idb()
+        rows = FjcIntegratedDatabase.objects.order_by('pk')
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'chunk': 0, 'max_pk': rows[1].pk}, f)
+
+        self.import_idb()
+        self.assertEqual(sorted(rows.values_list('docket_number', flat=True)),
+                         ['1700000', '1700001', '1700002'])
+
+    def test_missing_columns(self):
+        """Are columns that the file lacks left empty?"""
+        self.write_file(skip_headers=('TERMDATE', 'TITL'))
+        self.import_idb()
+        rows = FjcIntegratedDatabase.objects.all()
+        self.assertEqual(rows.count(), 3)
+        self.assertIsNone(rows[0].date_terminated)
+        self.assertEqual(rows[0].title, '')
+
+
+class IdbMergeTest(TestCase):
+    """Are IDB rows matched to dockets all at once, and merged in batches?"""
+    fixtures = ['hawaii_court.json']
+
+    def setUp(self):
+        self.new_row, self.unique_row, self.ambiguous_row = [
+            FjcIntegratedDatabase.objects.create(
+                dataset_source=CV_2017,
+                district_id='hid',
+                docket_number=docket_number,
+                plaintiff='WOLF',
+                defendant='SHEEP',
+            ) for docket_number in ['1700001', '1700002', '1700003']
+        ]
+        self.unique_docket = Docket.objects.create(
+            source=Docket.RECAP, court_id='hid', pacer_case_id='2',
+            docket_number='1:17-cv-00002')
+        for i, office in enumerate(['1', '2']):
+            Docket.objects.create(
+                source=Docket.RECAP, court_id='hid', pacer_case_id='3%s' % i,
+                docket_number='%s:17-cv-00003' % office)
+
+    def test_match_idb_rows(self):
+        self.assertEqual(list(match_idb_rows(CV_2017)), [
+            (self.new_row.pk, None, 0),
+            (self.unique_row.pk, self.unique_docket.pk, 1),
+            (self.ambiguous_row.pk, mock.ANY, 2),
+        ])
+        self.assertEqual(list(match_idb_rows(CV_2017, offset=1, limit=1)),
+                         [(self.unique_row.pk, self.unique_docket.pk, 1)])
+
+    def test_batches(self):
+        d_pks = create_new_dockets_from_idb([self.new_row.pk])
+        merge_dockets_with_idb([(self.unique_docket.pk, self.unique_row.pk)])
+
+        d = Docket.objects.get(pk=d_pks[0])
+        self.assertEqual(d.idb_data_id, self.new_row.pk)
+        self.assertEqual(d.source, Docket.IDB)
+        self.assertEqual(d.docket_number_core, '1700001')
+        self.unique_docket.refresh_from_db()
+        self.assertEqual(self.unique_docket.idb_data_id, self.unique_row.pk)
+        self.assertEqual(self.unique_docket.source,
+                         Docket.RECAP + Docket.IDB)
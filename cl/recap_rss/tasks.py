@@ -14,12 +14,18 @@ from cl.alerts.tasks import enqueue_docket_alert
 from cl.celery import app
 from cl.lib.crypto import sha256
 from cl.lib.pacer import map_cl_to_pacer_id
+from cl.lib.redis_utils import make_redis_interface
 from cl.recap.mergers import add_docket_entries, find_docket_object, \
     update_docket_metadata
 from cl.recap_rss.models import RssFeedStatus, RssItemCache
 
 logger = logging.getLogger(__name__)
 
+# Hashes of RSS items are kept in Redis for as long as they're kept in the
+# RssItemCache table, which is trimmed by trim_rss_cache.
+RSS_ITEM_CACHE_KEY = 'rss_item_cache:%s'
+RSS_ITEM_CACHE_DAYS = 2
+
 
 def get_last_build_date(s):
     """Get the last build date for an RSS feed
@@ -147,9 +153,46 @@ def hash_item(item):
     return item_hash
 
 
-def is_cached(item_hash):
-    """Check if a hash is in the RSS Item Cache"""
-    return RssItemCache.objects.filter(hash=item_hash).exists()
+def get_new_hashes(item_hashes):
+    """Find the hashes of RSS items that haven't been merged.
+
+    The hashes are checked in Redis with a single pipeline. Hashes that Redis
+    doesn't have, for example because it was flushed, are then checked
+    against the RssItemCache table with a single query, and the ones found
+    there are put back in Redis.
+
+    :param item_hashes: A list of hashes from hash_item.
+    :returns A set of the hashes that haven't been merged.
+    """
+    if not item_hashes:
+        return set()
+    r = make_redis_interface('CACHE')
+    pipe = r.pipeline()
+    for item_hash in item_hashes:
+        pipe.exists(RSS_ITEM_CACHE_KEY % item_hash)
+    unseen = {item_hash for item_hash, seen in
+              zip(item_hashes, pipe.execute()) if not seen}
+    if not unseen:
+        return unseen
+    cached = set(RssItemCache.objects.filter(
+        hash__in=unseen).values_list('hash', flat=True))
+    remember_hashes(cached)
+    return unseen - cached
+
+
+def remember_hashes(item_hashes):
+    """Record in Redis that RSS items were merged, for RSS_ITEM_CACHE_DAYS.
+
+    Only call this once the items are in the RssItemCache table.
+    """
+    if not item_hashes:
+        return
+    r = make_redis_interface('CACHE')
+    pipe = r.pipeline()
+    for item_hash in item_hashes:
+        pipe.set(RSS_ITEM_CACHE_KEY % item_hash, 1,
+                 ex=RSS_ITEM_CACHE_DAYS * 24 * 60 * 60)
+    pipe.execute()
 
 
 def cache_hash(item_hash):
@@ -185,10 +228,12 @@ def merge_rss_feed_contents(feed_data, court_pk, feed_status_pk):
     # RSS feeds are a list of normal Juriscraper docket objects.
     all_rds_created = []
     d_pks_to_alert = []
-    for docket in feed_data:
-        item_hash = hash_item(docket)
-        if is_cached(item_hash):
+    item_hashes = [hash_item(docket) for docket in feed_data]
+    new_hashes = get_new_hashes(item_hashes)
+    for docket, item_hash in zip(feed_data, item_hashes):
+        if item_hash not in new_hashes:
             continue
+        new_hashes.remove(item_hash)
 
         with transaction.atomic():
             cached_ok = cache_hash(item_hash)
@@ -210,6 +255,7 @@ def merge_rss_feed_contents(feed_data, court_pk, feed_status_pk):
             d.save()
             rds_created, content_updated = add_docket_entries(
                 d, docket['docket_entries'])
+        remember_hashes([item_hash])
 
         if content_updated and docket_count > 0:
             newly_enqueued = enqueue_docket_alert(d.pk)
@@ -232,9 +278,12 @@ def mark_status_successful(feed_status_pk):
 
 
 @app.task
-def trim_rss_cache(days=2):
+def trim_rss_cache(days=RSS_ITEM_CACHE_DAYS):
     """Remove any entries in the RSS cache older than `days` days.
 
+    The hashes in Redis expire by themselves, so this only trims the
+    RssItemCache table.
+
     :returns The number removed.
     """
     logger.info("Trimming RSS item cache.")
@@ -0,0 +1,72 @@
+from datetime import date
+
+import mock
+from django.test import TestCase
+
+from cl.lib.redis_utils import make_redis_interface
+from cl.recap.mergers import add_docket_entries
+from cl.recap_rss.models import RssFeedStatus, RssItemCache
+from cl.recap_rss.tasks import RSS_ITEM_CACHE_KEY, get_new_hashes, \
+    hash_item, merge_rss_feed_contents, remember_hashes
+from cl.search.models import Docket
+
+
+class RssItemCacheTest(TestCase):
+    fixtures = ['hawaii_court.json']
+    hashes = ['a' * 64, 'b' * 64, 'c' * 64]
+
+    def setUp(self):
+        self.feed_data = [{
+            'case_name': 'Lissner v. Saad %s' % i,
+            'docket_number': '1:18-cv-0000%s' % i,
+            'pacer_case_id': '1000%s' % i,
+            'date_filed': date(2018, 1, 1),
+            'docket_entries': [],
+        } for i in range(3)]
+        self.clear_redis()
+
+    def tearDown(self):
+        self.clear_redis()
+
+    def clear_redis(self):
+        item_hashes = self.hashes + [hash_item(item) for item in
+                                     self.feed_data]
+        r = make_redis_interface('CACHE')
+        r.delete(*[RSS_ITEM_CACHE_KEY % item_hash for item_hash in
+                   item_hashes])
+
+    def test_new_hashes(self):
+        """Are hashes new until they're remembered, and is the table a
+        fallback for Redis?
+        """
+        a, b, c = self.hashes
+        RssItemCache.objects.create(hash=c)
+        self.assertEqual(get_new_hashes([a, b, c]), {a, b})
+
+        remember_hashes([a])
+        self.assertEqual(get_new_hashes([a, b, c]), {b})
+
+    def test_failed_items_are_merged_next_time(self):
+        """If an item fails, are it and the items after it merged on the next
+        poll?
+        """
+        status = RssFeedStatus.objects.create(
+            court_id='hid', status=RssFeedStatus.PROCESSING_IN_PROGRESS)
+        calls = []
+
+        def fail_on_second_item(d, docket_entries):
+            calls.append(d)
+            if len(calls) == 2:
+                raise Exception("Worker died")
+            return add_docket_entries(d, docket_entries)
+
+        with mock.patch('cl.recap_rss.tasks.add_docket_entries',
+                        side_effect=fail_on_second_item):
+            with self.assertRaises(Exception):
+                merge_rss_feed_contents(self.feed_data, 'hid', status.pk)
+        self.assertEqual(Docket.objects.count(), 1)
+        self.assertEqual(RssItemCache.objects.count(), 1)
+
+        merge_rss_feed_contents(self.feed_data, 'hid', status.pk)
+        self.assertEqual(Docket.objects.count(), 3)
+        self.assertEqual(RssItemCache.objects.count(), 3)
@@ -1,11 +1,13 @@
 from django.conf import settings
 
 from cl.lib import search_utils
-from cl.lib.scorched_utils import ExtraSolrInterface
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.search_utils import map_to_docket_entry_sorting
+from cl.search.search_cache import cache_search, get_cached_search, \
+    make_search_cache_key
 
 
-def get_object_list(request, cd, paginator):
+def get_object_list(request, cd, paginator, search_form):
     """Perform the Solr work"""
     # Set the offset value
     page_number = int(request.GET.get(paginator.page_query_param, 1))
@@ -17,7 +19,12 @@ def get_object_list(request, cd, paginator):
     main_query['caller'] = 'api_search'
     if cd['type'] == 'r':
         main_query['sort'] = map_to_docket_entry_sorting(main_query['sort'])
-    sl = SolrList(main_query=main_query, offset=offset, type=cd['type'])
+    cache_key = None
+    if settings.SEARCH_CACHE_ENABLED:
+        cache_key = make_search_cache_key(cd, search_form.fields, 'api',
+                                          offset=offset, page_size=page_size)
+    sl = SolrList(main_query=main_query, offset=offset, type=cd['type'],
+                  cache_key=cache_key)
     return sl
 
 
@@ -26,33 +33,47 @@ class SolrList(object):
     queried.
     """
 
-    def __init__(self, main_query, offset, type, length=None):
+    def __init__(self, main_query, offset, type, length=None, cache_key=None):
+        """
+        :param cache_key: A key from make_search_cache_key. If given, the
+        results are loaded from the search cache if they're there, and are
+        put there once they're fetched otherwise.
+        """
         super(SolrList, self).__init__()
         self.main_query = main_query
         self.offset = offset
         self.type = type
+        self.cache_key = cache_key
         self._item_cache = []
+        self._fetched = False
         if self.type == 'o':
-            self.conn = ExtraSolrInterface(
+            self.conn = get_solr_interface(
                 settings.SOLR_OPINION_URL,
                 mode='r',
             )
         elif self.type == 'oa':
-            self.conn = ExtraSolrInterface(
+            self.conn = get_solr_interface(
                 settings.SOLR_AUDIO_URL,
                 mode='r',
             )
         elif self.type == 'r':
-            self.conn = ExtraSolrInterface(
+            self.conn = get_solr_interface(
                 settings.SOLR_RECAP_URL,
                 mode='r',
             )
         elif self.type == 'p':
-            self.conn = ExtraSolrInterface(
+            self.conn = get_solr_interface(
                 settings.SOLR_PEOPLE_URL,
                 mode='r',
             )
         self._length = length
+        if cache_key is not None:
+            cached = get_cached_search(cache_key, 'api')
+            if cached is not None:
+                self._length = cached['length']
+                self._item_cache = [SolrObject(initial=doc) for doc in
+                                    cached['docs']]
+                self._fetched = True
 
     def __len__(self):
         if self._length is None:
@@ -70,6 +91,25 @@ class SolrList(object):
                 yield self.__getitem__(item)
 
     def __getitem__(self, item):
+        if not self._fetched:
+            self._fetch()
+
+        # Now, assuming our _item_cache is all set, we just get the item.
+        if isinstance(item, slice):
+            s = slice(item.start - int(self.offset),
+                      item.stop - int(self.offset),
+                      item.step)
+            return self._item_cache[s]
+        else:
+            # Not slicing.
+            try:
+                return self._item_cache[item]
+            except IndexError:
+                # No results!
+                return []
+
+    def _fetch(self):
+        """Run the query and fill the item cache."""
         self.main_query['start'] = self.offset
         r = self.conn.query().add_extra(**self.main_query).execute()
 
@@ -86,20 +126,13 @@ class SolrList(object):
                     doc['snippet'] = '&hellip;'.join(
                         doc['solr_highlights']['text'])
                     self._item_cache.append(SolrObject(initial=doc))
+        self._fetched = True
 
-        # Now, assuming our _item_cache is all set, we just get the item.
-        if isinstance(item, slice):
-            s = slice(item.start - int(self.offset),
-                      item.stop - int(self.offset),
-                      item.step)
-            return self._item_cache[s]
-        else:
-            # Not slicing.
-            try:
-                return self._item_cache[item]
-            except IndexError:
-                # No results!
-                return []
+        if self.cache_key is not None:
+            cache_search(self.cache_key, {
+                'length': len(self),
+                'docs': [o.to_dict() for o in self._item_cache],
+            })
 
     def append(self, p_object):
         """Lightly override the append method so we get items duplicated in
@@ -141,7 +141,8 @@ class SearchViewSet(LoggingMixin, viewsets.ViewSet):
                 cd['q'] = '*'  # Get everything
 
             paginator = pagination.PageNumberPagination()
-            sl = api_utils.get_object_list(request, cd=cd, paginator=paginator)
+            sl = api_utils.get_object_list(request, cd=cd, paginator=paginator,
+                                          search_form=search_form)
 
             result_page = paginator.paginate_queryset(sl, request)
             serializer = SearchResultSerializer(
@@ -8,7 +8,7 @@ from django.utils.feedgenerator import Atom1Feed
 from cl.lib import search_utils
 from cl.lib.date_time import midnight_pst
 from cl.lib.mime_types import lookup_mime_type
-from cl.lib.scorched_utils import ExtraSolrInterface
+from cl.lib.scorched_utils import get_solr_interface
 from cl.search.forms import SearchForm
 from cl.search.models import Court
 
@@ -43,9 +43,9 @@ class SearchFeed(Feed):
             cd = search_form.cleaned_data
             order_by = 'dateFiled'
             if cd['type'] == 'o':
-                solr = ExtraSolrInterface(settings.SOLR_OPINION_URL, mode='r')
+                solr = get_solr_interface(settings.SOLR_OPINION_URL, mode='r')
             elif cd['type'] == 'r':
-                solr = ExtraSolrInterface(settings.SOLR_RECAP_URL, mode='r')
+                solr = get_solr_interface(settings.SOLR_RECAP_URL, mode='r')
             else:
                 return []
             main_params = search_utils.build_main_query(cd, highlight=False,
@@ -94,7 +94,7 @@ class JurisdictionFeed(Feed):
 
     def items(self, obj):
         """Do a Solr query here. Return the first 20 results"""
-        solr = ExtraSolrInterface(settings.SOLR_OPINION_URL, mode='r')
+        solr = get_solr_interface(settings.SOLR_OPINION_URL, mode='r')
         params = {
             'q': '*',
             'fq': 'court_exact:%s' % obj.pk,
@@ -158,7 +158,7 @@ class AllJurisdictionsFeed(JurisdictionFeed):
 
     def items(self, obj):
         """Do a Solr query here. Return the first 20 results"""
-        solr = ExtraSolrInterface(settings.SOLR_OPINION_URL, mode='r')
+        solr = get_solr_interface(settings.SOLR_OPINION_URL, mode='r')
         params = {
             'q': '*',
             'sort': 'dateFiled desc',
@@ -0,0 +1,97 @@
+import time
+
+from django.template import loader
+
+from cl.audio.models import Audio
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.lib.search_index_utils import get_audio_text, get_opinion_text, \
+    get_person_text, get_recap_document_text, null_map
+from cl.people_db.models import Person
+from cl.search.models import Opinion, RECAPDocument
+from cl.search.search_dicts import ITEM_LOADERS
+
+
+def render_template(template_name, context):
+    """Make a text field the way it was made before, with a template."""
+    template = loader.get_template('indexes/%s' % template_name)
+    return template.render(context).translate(null_map)
+
+
+# For each kind of item: the template that used to make its text field, a
+# function to make the template's context, and the function that makes the
+# text field now.
+DOCUMENT_TYPES = (
+    ('Opinion', Opinion, 'opinion_text.txt',
+     lambda o: {'item': o, 'citation_string': o.cluster.citation_string},
+     lambda o: get_opinion_text(o, o.cluster.citation_string)),
+    ('RECAPDocument', RECAPDocument, 'dockets_text.txt',
+     lambda rd: {'item': rd}, get_recap_document_text),
+    ('Audio', Audio, 'audio_text.txt',
+     lambda a: {'item': a}, get_audio_text),
+    ('Person', Person, 'person_text.txt',
+     lambda p: {'item': p}, get_person_text),
+)
+
+
+def time_function(f, items, iterations):
+    """Run f over every item, iterations times, and return the results of the
+    last run along with the best run time in seconds.
+    """
+    best = None
+    results = None
+    for _ in range(iterations):
+        t1 = time.time()
+        results = [f(item) for item in items]
+        elapsed = time.time() - t1
+        if best is None or elapsed < best:
+            best = elapsed
+    return results, best
+
+
+class Command(VerboseCommand):
+    help = ('Benchmark making the text fields of the search index with the '
+            'old templates and with the functions that replaced them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--count',
+            type=int,
+            default=500,
+            help="The number of items of each type to use as the sample. The "
+                 "sample is always the first items in the database, by ID, so "
+                 "that runs are comparable.",
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=3,
+            help="The number of times to run each benchmark. The best run is "
+                 "reported.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        for name, model, template_name, get_context, make_text in \
+                DOCUMENT_TYPES:
+            pks = list(model.objects.order_by('pk').values_list(
+                'pk', flat=True)[:options['count']])
+            # Load everything up front, so only the text is timed.
+            items = list(ITEM_LOADERS[model](pks))
+            contexts = [get_context(item) for item in items]
+            old_results, old_time = time_function(
+                lambda context: render_template(template_name, context),
+                contexts, options['iterations'])
+            new_results, new_time = time_function(make_text, items,
+                                                  options['iterations'])
+            if [t.split() for t in old_results] != \
+                    [t.split() for t in new_results]:
+                logger.warning("The templates and the new code made different "
+                               "text for this sample of %s items!", name)
+            logger.info(
+                "%s: templates took %.3fs (%.1f items/s), new code took "
+                "%.3fs (%.1f items/s). Speedup: %.1fx.",
+                name,
+                old_time, len(items) / (old_time or 1e-9),
+                new_time, len(items) / (new_time or 1e-9),
+                old_time / (new_time or 1e-9),
+            )
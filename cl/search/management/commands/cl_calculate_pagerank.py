@@ -1,12 +1,25 @@
 import os
+import resource
+import time
+from multiprocessing import Pool
 
 import igraph
+import numpy as np
 from django.conf import settings
+from django.db import connection, connections
 
-from cl.lib.command_utils import VerboseCommand
+from cl.lib.command_utils import VerboseCommand, logger
 from cl.lib.solr_core_admin import get_data_dir
 from cl.search.models import Opinion, OpinionsCited
 
+# The same damping factor igraph uses by default.
+DAMPING = 0.85
+
+# Stop iterating when the scores change by less than this (L1 norm).
+TOLERANCE = 1e-10
+
+MAX_ITERATIONS = 200
+
 
 def make_and_populate_nx_graph():
     """Create a new igraph object and populate it.
@@ -23,6 +36,141 @@ def make_and_populate_nx_graph():
     return g
 
 
+class ArrayCopyBuffer(object):
+    """A file-like object for COPY ... TO STDOUT that parses the rows into a
+    numpy array as they arrive, instead of keeping the text around.
+
+    Only works for rows of integers.
+    """
+    def __init__(self, buffer_size=2 ** 20):
+        self.buffer_size = buffer_size
+        self.pending = []
+        self.pending_size = 0
+        self.chunks = []
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        # Rows always end with a newline, so every chunk is whole rows.
+        text = ''.join(self.pending)
+        if text:
+            self.chunks.append(np.fromstring(text, dtype=np.int64, sep=' '))
+        self.pending = []
+        self.pending_size = 0
+
+    def get_array(self, column_count):
+        self.flush()
+        if not self.chunks:
+            return np.zeros((0, column_count), dtype=np.int64)
+        return np.concatenate(self.chunks).reshape(-1, column_count)
+
+
+def copy_to_array(sql, column_count):
+    """Run a query with COPY, and get the results as an int64 array with one
+    row per result.
+
+    The query must return only integer columns that are never NULL.
+    """
+    buf = ArrayCopyBuffer()
+    with connection.cursor() as cursor:
+        cursor.copy_expert('COPY (%s) TO STDOUT' % sql, buf)
+    return buf.get_array(column_count)
+
+
+def load_edges():
+    """Load the citation network.
+
+    :return: A tuple of two int64 arrays, the citing and the cited opinion of
+    each citation.
+    """
+    meta = OpinionsCited._meta
+    edges = copy_to_array('SELECT %s, %s FROM %s' % (
+        meta.get_field('citing_opinion').column,
+        meta.get_field('cited_opinion').column,
+        meta.db_table,
+    ), 2)
+    return edges[:, 0], edges[:, 1]
+
+
+def load_opinion_ids():
+    """Get the IDs of all the opinions, sorted."""
+    ids = copy_to_array('SELECT %s FROM %s' % (
+        Opinion._meta.pk.column,
+        Opinion._meta.db_table,
+    ), 1)[:, 0]
+    ids.sort()
+    return ids
+
+
+def load_pagerank_file(path, node_count):
+    """Load the scores from an earlier run, for use as a starting point.
+
+    Nodes that aren't in the file get the score of a node that isn't cited by
+    anything, since that's what most new opinions are. The result is
+    normalized so that it sums to one.
+
+    :param path: A file written by write_pagerank_file.
+    :param node_count: The number of nodes in the network now.
+    :return: An array of scores, or None if the file doesn't exist.
+    """
+    if not os.path.exists(path):
+        return None
+    rows = np.loadtxt(path, delimiter='=', ndmin=2)
+    if len(rows) == 0:
+        return None
+    ids = rows[:, 0].astype(np.int64)
+    scores = rows[:, 1]
+    start = np.full(node_count, (1 - DAMPING) / node_count)
+    in_range = ids < node_count
+    start[ids[in_range]] = scores[in_range]
+    return start / start.sum()
+
+
+def pagerank(citing, cited, node_count, start=None, damping=DAMPING,
+             tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+    """Calculate the pagerank of every node by power iteration.
+
+    This gives the same scores as igraph: the score of dangling nodes (ones
+    that cite nothing) is spread evenly across the network. Each iteration is
+    a sparse matrix-vector product, done with np.bincount on the edge arrays.
+
+    :param citing: An int array with the source of each edge.
+    :param cited: An int array with the target of each edge.
+    :param node_count: The number of nodes. Nodes are numbered from zero.
+    :param start: The scores to start from, such as the ones from an earlier
+    run. If None, every node starts with the same score.
+    :return: A tuple of the array of scores and the number of iterations it
+    took to converge.
+    """
+    if node_count == 0:
+        return np.zeros(0), 0
+    out_degree = np.bincount(citing, minlength=node_count).astype(np.float64)
+    dangling = out_degree == 0
+    # The share of a node's score that goes along each edge that leaves it.
+    edge_share = 1.0 / out_degree[citing]
+
+    if start is None:
+        scores = np.full(node_count, 1.0 / node_count)
+    else:
+        scores = start
+    iterations = 0
+    for iterations in range(1, max_iterations + 1):
+        new_scores = damping * np.bincount(
+            cited, weights=scores[citing] * edge_share, minlength=node_count,
+        )
+        new_scores += (damping * scores[dangling].sum() + 1 - damping) / \
+            node_count
+        delta = np.abs(new_scores - scores).sum()
+        scores = new_scores
+        if delta < tolerance:
+            break
+    return scores, iterations
+
+
 def make_sorted_pr_file(pr_results, result_file_path):
     """Convert the pagerank results list into something Solr can use.
 
@@ -61,21 +209,153 @@ def make_sorted_pr_file(pr_results, result_file_path):
     os.remove(result_file_path + temp_extension)
 
 
+def write_pagerank_file(scores, opinion_ids, result_file_path,
+                        chunk_size=100000):
+    """Write the file that Solr uses for pagerank (see make_sorted_pr_file),
+    without the ORM or an external sort.
+
+    :param scores: The array of scores, indexed by opinion ID.
+    :param opinion_ids: A sorted array of every opinion ID.
+    :param result_file_path: Where to write the file. It's written to a
+    temporary file first, then moved into place.
+    """
+    # Opinions that aren't in the network get the lowest score.
+    opinion_scores = np.full(len(opinion_ids),
+                             scores.min() if len(scores) else 0)
+    in_network = opinion_ids < len(scores)
+    opinion_scores[in_network] = scores[opinion_ids[in_network]]
+
+    temp_path = result_file_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        for i in range(0, len(opinion_ids), chunk_size):
+            rows = np.column_stack((opinion_ids[i:i + chunk_size],
+                                    opinion_scores[i:i + chunk_size]))
+            np.savetxt(f, rows, fmt='%d=%.12g')
+    os.rename(temp_path, result_file_path)
+
+
+def get_max_rss():
+    """Get the peak memory use of this process, in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def benchmark_igraph():
+    """Time the igraph path, from loading the network to having scores.
+
+    Run in a new process, so the memory numbers are its own.
+    """
+    rss_before = get_max_rss()
+    t1 = time.time()
+    make_and_populate_nx_graph().pagerank()
+    return time.time() - t1, get_max_rss() - rss_before
+
+
+def benchmark_numpy():
+    """Time the numpy path, from loading the network to having scores."""
+    rss_before = get_max_rss()
+    t1 = time.time()
+    citing, cited = load_edges()
+    node_count = max(citing.max(), cited.max()) + 1 if len(citing) else 0
+    pagerank(citing, cited, node_count)
+    return time.time() - t1, get_max_rss() - rss_before
+
+
 class Command(VerboseCommand):
     args = '<args>'
     help = 'Calculate pagerank value for every case'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--method',
+            choices=['numpy', 'igraph'],
+            default='numpy',
+            help="How to calculate pagerank. 'numpy' loads the network with "
+                 "COPY and uses sparse power iteration. 'igraph' is the "
+                 "original method, which loads the network through the ORM.",
+        )
+        parser.add_argument(
+            '--warm-start',
+            action='store_true',
+            default=False,
+            help="Start from the scores in the existing pagerank file, so "
+                 "that the calculation converges faster. Only works with the "
+                 "numpy method.",
+        )
+        parser.add_argument(
+            '--benchmark',
+            action='store_true',
+            default=False,
+            help="Compare the run time and memory use of the numpy and igraph "
+                 "methods, and exit without writing anything.",
+        )
+
+    def do_pagerank(self, method='numpy', warm_start_path=None):
+        """Calculate the pagerank of every opinion in the network.
+
+        :param method: Either 'numpy' or 'igraph'.
+        :param warm_start_path: A pagerank file from an earlier run to start
+        from, or None. Ignored by igraph.
+        :return: A sequence of scores, indexed by opinion ID.
+        """
+        if method == 'igraph':
+            g = make_and_populate_nx_graph()
+            pr_results = g.pagerank()
+            return pr_results
+
+        t1 = time.time()
+        citing, cited = load_edges()
+        # Like igraph, the network has a node for every ID up to the largest
+        # one that's cited or citing.
+        node_count = max(citing.max(), cited.max()) + 1 if len(citing) else 0
+        logger.info("Loaded %s citations in %.1fs.", len(citing),
+                    time.time() - t1)
+
+        start = None
+        if warm_start_path is not None:
+            start = load_pagerank_file(warm_start_path, node_count)
+            if start is None:
+                logger.info("No pagerank file at %s to start from.",
+                            warm_start_path)
+
+        t1 = time.time()
+        scores, iterations = pagerank(citing, cited, node_count, start=start)
+        logger.info("Pagerank converged in %s iterations (%.1fs).",
+                    iterations, time.time() - t1)
+        return scores
+
     @staticmethod
-    def do_pagerank():
-        g = make_and_populate_nx_graph()
-        pr_results = g.pagerank()
-        return pr_results
+    def do_benchmark():
+        results = {}
+        for name, f in (('igraph', benchmark_igraph),
+                        ('numpy', benchmark_numpy)):
+            # Each method gets a fresh process, so that memory can be
+            # compared. Don't share the database connection with it.
+            connections.close_all()
+            pool = Pool(1)
+            results[name] = pool.apply(f)
+            pool.close()
+            pool.join()
+            logger.info("%s: %.1fs, %.0f MB more peak memory.", name,
+                        results[name][0], results[name][1])
+        logger.info("The numpy method took %.1f%% of the time of the igraph "
+                    "method.", 100 * results['numpy'][0] /
+                    (results['igraph'][0] or 1e-9))
 
     def handle(self, *args, **options):
         super(Command, self).handle(*args, **options)
-        pr_results = self.do_pagerank()
+        if options['benchmark']:
+            self.do_benchmark()
+            return
+
         pr_dest_dir = settings.SOLR_PAGERANK_DEST_DIR
-        make_sorted_pr_file(pr_results, pr_dest_dir)
+        pr_results = self.do_pagerank(
+            method=options['method'],
+            warm_start_path=pr_dest_dir if options['warm_start'] else None,
+        )
+        if options['method'] == 'igraph':
+            make_sorted_pr_file(pr_results, pr_dest_dir)
+        else:
+            write_pagerank_file(pr_results, load_opinion_ids(), pr_dest_dir)
         normal_dest_dir = get_data_dir('collection1') + "external_pagerank"
         print("Pagerank file created at %s. Because of distributed servers, "
               "you may need to copy it to its final destination. Somewhere "
@@ -0,0 +1,50 @@
+from cl.lib.command_utils import VerboseCommand, logger
+from cl.search.outbox import flush_outbox, get_outbox_stats
+from cl.stats.utils import tally_stat
+
+
+class Command(VerboseCommand):
+    help = ('Send the items in the index outbox to be indexed. Run this '
+            'periodically, from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help="The number of items to index in each task.",
+        )
+        parser.add_argument(
+            '--queue',
+            default='celery',
+            help="The celery queue where the tasks should be processed.",
+        )
+        parser.add_argument(
+            '--stats',
+            action='store_true',
+            default=False,
+            help="Only show the depth of the outbox and how much it is "
+                 "coalescing, without flushing it.",
+        )
+
+    def handle(self, *args, **options):
+        super(Command, self).handle(*args, **options)
+        if not options['stats']:
+            flushed = flush_outbox(batch_size=options['batch_size'],
+                                   queue=options['queue'])
+            for app_label, count in sorted(flushed.items()):
+                logger.info("Sent %s items of type %s to be indexed.", count,
+                            app_label)
+            tally_stat('index_outbox.flushed', inc=sum(flushed.values()))
+
+        stats = get_outbox_stats()
+        for app_label, depth in sorted(stats['depth'].items()):
+            logger.info("%s items of type %s are waiting in the outbox.",
+                        depth, app_label)
+        logger.info("Items were added to the outbox %s times, of which %s "
+                    "were coalesced with an item that was already there. "
+                    "%s items have been flushed. Coalescing ratio: %.1f.",
+                    stats['added'], stats['coalesced'], stats['flushed'],
+                    stats['coalescing_ratio'])
+        for reason, count in sorted(stats['added_by_reason'].items()):
+            logger.info("%s items were added because of: %s.", count, reason)
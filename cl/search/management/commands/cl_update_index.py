@@ -1,18 +1,32 @@
 import ast
+import json
 import sys
+import time
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from multiprocessing import Pool
 
+import requests
 from django.apps import apps
 from django.conf import settings
+from django.db import connections
+from django.utils.timezone import now
+from scorched.dates import solr_date
 from six.moves import input
 
 from cl.lib.argparse_types import valid_date_time
 from cl.lib.celery_utils import CeleryThrottle
-from cl.lib.command_utils import VerboseCommand
-from cl.lib.scorched_utils import ExtraSolrInterface
+from cl.lib.command_utils import VerboseCommand, read_checkpoint, \
+    write_checkpoint
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.timer import print_timing
 from cl.people_db.models import Person
 from cl.search.models import Docket
-from cl.search.tasks import delete_items, add_items_to_solr
+from cl.search.search_cache import bump_index_generation
+from cl.search.search_dicts import make_search_dicts
+from cl.search.tasks import delete_items, add_items_to_solr, \
+    RECAP_UPDATE_MODES, update_recap_dockets
 
 VALID_OBJ_TYPES = ('audio.Audio', 'people_db.Person', 'search.Opinion',
                    'search.RECAPDocument', 'search.Docket')
@@ -45,6 +59,57 @@ def proceed_with_deletion(out, count, noinput):
     return proceed
 
 
+def solr_json_default(obj):
+    """Serialize the values in search dicts that json can't, the way
+    scorched does when it sends them to Solr.
+    """
+    if isinstance(obj, datetime):
+        return unicode(solr_date(obj))
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+def make_json_batch(args):
+    """Make the search dicts for a chunk of items, ready to send to Solr.
+
+    Run in the worker processes of the local indexer.
+
+    :param args: A tuple of the app label of the items and a sorted list of
+    their IDs.
+    :return: A tuple of the last ID in the chunk, the number of documents
+    made, and the documents as a JSON list.
+    """
+    app_label, item_pks = args
+    docs = make_search_dicts(apps.get_model(app_label), item_pks)
+    return item_pks[-1], len(docs), json.dumps(docs, default=solr_json_default)
+
+
+def update_recap_dockets_batch(args):
+    """Update a chunk of dockets in the RECAP index the way
+    update_recap_dockets does through Celery, which also marks them as
+    indexed.
+
+    Run in the worker processes of the local indexer.
+
+    :param args: A tuple of a (mode, solr_url) tuple, where mode is one of
+    RECAP_UPDATE_MODES and solr_url is the core to update, and a sorted list
+    of the IDs of the dockets.
+    :return: A tuple like make_json_batch's, but without any documents, since
+    they've already been sent.
+    """
+    (mode, solr_url), docket_pks = args
+    update_recap_dockets(docket_pks, mode, solr_url=solr_url)
+    return docket_pks[-1], len(docket_pks), None
+
+
+def chunk_iterable(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class Command(VerboseCommand):
     help = ('Adds, updates, deletes items in an index, committing changes and '
             'optimizing it, if requested.')
@@ -159,12 +224,47 @@ class Command(VerboseCommand):
                  'date and time (YYYY-MM-DD HH:MM:SS)'
         )
 
+        parser.add_argument(
+            '--recap-update-mode',
+            choices=RECAP_UPDATE_MODES,
+            default='full',
+            help="How to update dockets, when the type is search.Docket. "
+                 "'full' rebuilds every document on each docket. 'partial' "
+                 "only sends the docket fields that changed, as atomic "
+                 "updates, without rebuilding the text of the documents. "
+                 "'auto' does a partial update when the documents in the "
+                 "index are the ones in the database, and a full one if not.",
+        )
         parser.add_argument(
             '--start-at',
             type=int,
             default=0,
             help="For use with the --everything flag, skip this many items "
-                 "before starting the processing."
+                 "before starting the processing. Not used with "
+                 "--local-workers, which uses --checkpoint instead."
+        )
+        parser.add_argument(
+            '--local-workers',
+            type=int,
+            default=0,
+            help="For use with the --everything flag. Instead of sending the "
+                 "items through Celery, make the documents in this many local "
+                 "processes and send them straight to Solr's update handler. "
+                 "Useful for full rebuilds into a swap core.",
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=500,
+            help="With --local-workers, the number of items each process "
+                 "makes documents for at a time. Each chunk is sent to Solr "
+                 "as one request.",
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help="With --local-workers, a file where the last ID that was "
+                 "indexed is kept. If the file exists, indexing resumes after "
+                 "that ID.",
         )
 
     def handle(self, *args, **options):
@@ -174,7 +274,7 @@ class Command(VerboseCommand):
         self.noinput = options['noinput']
         if not self.options['optimize_everything']:
             self.solr_url = options['solr_url']
-            self.si = ExtraSolrInterface(self.solr_url, mode='rw')
+            self.si = get_solr_interface(self.solr_url, mode='rw')
             self.type = options['type']
 
         if options['update']:
@@ -205,6 +305,11 @@ class Command(VerboseCommand):
         if options.get('do_commit'):
             self.si.commit()
 
+        if options['update'] or options.get('delete') or \
+                options.get('do_commit'):
+            # Cached search results from this core may be out of date now.
+            bump_index_generation(self.solr_url)
+
         if options.get('optimize'):
             self.optimize()
 
@@ -244,8 +349,15 @@ class Command(VerboseCommand):
             chunk.append(item)
             if processed_count % chunk_size == 0 or last_item:
                 throttle.maybe_wait()
-                add_items_to_solr.apply_async(args=(chunk, self.type),
-                                              queue=queue)
+                if self.type == 'search.Docket' and \
+                        self.options['recap_update_mode'] != 'full':
+                    update_recap_dockets.apply_async(
+                        args=(chunk, self.options['recap_update_mode']),
+                        kwargs={'solr_url': self.solr_url},
+                        queue=queue)
+                else:
+                    add_items_to_solr.apply_async(args=(chunk, self.type),
+                                                  queue=queue)
                 chunk = []
                 sys.stdout.write("\rProcessed {}/{} ({:.0%})".format(
                     processed_count,
@@ -255,6 +367,88 @@ class Command(VerboseCommand):
                 self.stdout.flush()
         self.stdout.write('\n')
 
+    def process_locally(self, pks, count):
+        """Index items without Celery. Worker processes make the documents,
+        and this process sends them to Solr's update handler.
+
+        Chunks are sent in order, and at most a few chunks per worker are
+        kept waiting to be sent, so that the workers can't get too far ahead
+        of Solr.
+
+        Dockets are updated in the --recap-update-mode, like they are through
+        Celery. Unless it's 'full', the workers update them in Solr
+        themselves.
+
+        :param pks: A sorted iterable of the IDs of the items left to index.
+        :param count: The number of items left to index.
+        """
+        checkpoint = self.options['checkpoint']
+        update_url = '%s/update' % (self.solr_url or
+                                    settings.SOLR_URLS[self.type]).rstrip('/')
+        session = requests.Session()
+        worker_count = self.options['local_workers']
+        max_pending = worker_count * 2
+        is_docket = self.type == 'search.Docket'
+        recap_update_mode = self.options['recap_update_mode']
+        if is_docket and recap_update_mode != 'full':
+            make_batch = update_recap_dockets_batch
+            batch_type = (recap_update_mode, self.solr_url)
+        else:
+            make_batch = make_json_batch
+            batch_type = self.type
+
+        # Don't share database connections with the workers.
+        connections.close_all()
+        pool = Pool(worker_count)
+        pending = deque()
+        processed_count = doc_count = 0
+        t1 = time.time()
+
+        def send(chunk, result):
+            last_pk, chunk_doc_count, body = result.get()
+            if body is not None:
+                r = session.post(update_url, data=body,
+                                 params={'wt': 'json'},
+                                 headers={'Content-Type': 'application/json'})
+                r.raise_for_status()
+                if is_docket:
+                    Docket.objects.filter(pk__in=chunk).update(
+                        date_last_index=now())
+            if checkpoint is not None:
+                write_checkpoint(checkpoint, last_pk)
+            return chunk_doc_count
+
+        try:
+            for chunk in chunk_iterable(pks, self.options['chunk_size']):
+                pending.append((chunk, pool.apply_async(
+                    make_batch, ((batch_type, chunk),))))
+                while len(pending) >= max_pending or \
+                        (pending and pending[0][1].ready()):
+                    chunk, result = pending.popleft()
+                    doc_count += send(chunk, result)
+                    processed_count += len(chunk)
+                    self.write_throughput(processed_count, count, doc_count,
+                                          time.time() - t1)
+            while pending:
+                chunk, result = pending.popleft()
+                doc_count += send(chunk, result)
+                processed_count += len(chunk)
+                self.write_throughput(processed_count, count, doc_count,
+                                      time.time() - t1)
+        finally:
+            pool.terminate()
+            pool.join()
+        self.stdout.write('\n')
+
+    def write_throughput(self, processed_count, count, doc_count, elapsed):
+        sys.stdout.write("\rProcessed {}/{} ({:.0%}), {:.0f} docs/s".format(
+            processed_count,
+            count,
+            processed_count * 1.0 / (count or 1),
+            doc_count / (elapsed or 1e-9),
+        ))
+        self.stdout.flush()
+
     @print_timing
     def delete(self, items):
         """
@@ -315,7 +509,12 @@ class Command(VerboseCommand):
         in the index.
         """
         self.stdout.write("Adding or updating item(s): %s\n" % list(items))
-        add_items_to_solr(items, self.type)
+        if self.type == 'search.Docket' and \
+                self.options['recap_update_mode'] != 'full':
+            update_recap_dockets(items, self.options['recap_update_mode'],
+                                 solr_url=self.solr_url)
+        else:
+            add_items_to_solr(items, self.type)
 
     @print_timing
     def add_or_update_by_datetime(self, dt):
@@ -351,12 +550,28 @@ class Command(VerboseCommand):
             q = Docket.objects.filter(
                 source__in=Docket.RECAP_SOURCES).values_list('pk', flat=True)
             count = q.count()
-            q = q.iterator()
         else:
             q = model.objects.values_list('pk', flat=True)
             count = q.count()
-            q = q.iterator()
-        self.process_queryset(q, count)
+
+        if self.options['local_workers']:
+            last_pk = read_checkpoint(self.options['checkpoint'])
+            if last_pk is not None:
+                self.stdout.write("Resuming after item %s.\n" % last_pk)
+            # Sorted, so that there can be checkpoints.
+            if model == Person:
+                q = sorted(pk for pk in q if last_pk is None or pk > last_pk)
+                count = len(q)
+            else:
+                if last_pk is not None:
+                    q = q.filter(pk__gt=last_pk)
+                    count = q.count()
+                q = q.order_by('pk').iterator()
+            self.process_locally(q, count)
+        else:
+            if model != Person:
+                q = q.iterator()
+            self.process_queryset(q, count)
 
     @print_timing
     def optimize(self):
@@ -373,7 +588,7 @@ class Command(VerboseCommand):
         for url in urls:
             self.stdout.write(" - {url}\n".format(url=url))
             try:
-                si = ExtraSolrInterface(url)
+                si = get_solr_interface(url, mode='w')
             except EnvironmentError:
                 self.stderr.write("   Couldn't load schema!")
                 continue
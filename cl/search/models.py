@@ -6,9 +6,8 @@ from celery.canvas import chain
 from django.contrib.contenttypes.fields import GenericRelation
 from django.core.exceptions import ValidationError
 from django.urls import reverse, NoReverseMatch
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.db.models import Prefetch, Q
-from django.template import loader
 from django.utils.encoding import smart_unicode
 from django.utils.text import slugify
 
@@ -18,8 +17,8 @@ from cl.lib.date_time import midnight_pst
 from cl.lib.model_helpers import make_upload_path, make_recap_path, \
     make_docket_number_core
 from cl.lib.models import AbstractPDF
-from cl.lib.search_index_utils import InvalidDocumentError, null_map, \
-    normalize_search_dicts
+from cl.lib.search_index_utils import InvalidDocumentError, \
+    get_opinion_text, get_recap_document_text, normalize_search_dicts
 from cl.lib.storage import IncrementingFileSystemStorage
 from cl.lib.string_utils import trunc
 
@@ -635,21 +634,55 @@ class Docket(models.Model):
                      to_attr='firms_in_docket')
         )
 
-    def as_search_list(self):
-        """Create list of search dicts from a single docket. This should be
-        faster than creating a search dict per document on the docket.
+    def get_party_search_fields(self):
+        """Get the party, attorney and firm fields for the search index.
+
+        :return: A dict of sets, keyed by field name.
         """
-        search_list = []
+        out = {
+            'party_id': set(),
+            'party': set(),
+            'attorney_id': set(),
+            'attorney': set(),
+            'firm_id': set(),
+            'firm': set(),
+        }
+        for p in self.prefetched_parties:
+            out['party_id'].add(p.pk)
+            out['party'].add(p.name)
+            for a in p.attys_in_docket:
+                out['attorney_id'].add(a.pk)
+                out['attorney'].add(a.name)
+                for f in a.firms_in_docket:
+                    out['firm_id'].add(f.pk)
+                    out['firm'].add(f.name)
+        return out
 
-        # Docket
+    def get_search_metadata(self, party_fields=None):
+        """The fields of the RECAP search index that come from the docket.
+
+        Every document on the docket has a copy of these.
+
+        :param party_fields: The party fields for the docket, as returned by
+        get_party_search_fields. If None, they are queried.
+        """
+        # IDs
         out = {
+            'docket_id': self.pk,
+            'court_id': self.court.pk,
+            'assigned_to_id': getattr(self.assigned_to, 'pk', None),
+            'referred_to_id': getattr(self.referred_to, 'pk', None)
+        }
+
+        # Docket
+        out.update({
             'docketNumber': self.docket_number,
             'caseName': best_case_name(self),
             'suitNature': self.nature_of_suit,
             'cause': self.cause,
             'juryDemand': self.jury_demand,
             'jurisdictionType': self.jurisdiction_type,
-        }
+        })
         if self.date_argued is not None:
             out['dateArgued'] = midnight_pst(self.date_argued)
         if self.date_filed is not None:
@@ -680,23 +713,23 @@ class Docket(models.Model):
         })
 
         # Parties, attorneys, firms
-        out.update({
-            'party_id': set(),
-            'party': set(),
-            'attorney_id': set(),
-            'attorney': set(),
-            'firm_id': set(),
-            'firm': set(),
-        })
-        for p in self.prefetched_parties:
-            out['party_id'].add(p.pk)
-            out['party'].add(p.name)
-            for a in p.attys_in_docket:
-                out['attorney_id'].add(a.pk)
-                out['attorney'].add(a.name)
-                for f in a.firms_in_docket:
-                    out['firm_id'].add(f.pk)
-                    out['firm'].add(f.name)
+        if party_fields is None:
+            party_fields = self.get_party_search_fields()
+        out.update(party_fields)
+
+        return out
+
+    def as_search_list(self, party_fields=None):
+        """Create list of search dicts from a single docket. This should be
+        faster than creating a search dict per document on the docket.
+
+        :param party_fields: The party fields for the docket, as returned by
+        get_party_search_fields. If None, they are queried.
+        """
+        search_list = []
+
+        # Docket
+        out = self.get_search_metadata(party_fields)
 
         # Do RECAPDocument and Docket Entries in a nested loop
         for de in self.docket_entries.all():
@@ -721,10 +754,6 @@ class Docket(models.Model):
                 rd_out = {
                     'id': rd.pk,
                     'docket_entry_id': de.pk,
-                    'docket_id': self.pk,
-                    'court_id': self.court.pk,
-                    'assigned_to_id': getattr(self.assigned_to, 'pk', None),
-                    'referred_to_id': getattr(self.referred_to, 'pk', None),
                 }
 
                 # RECAPDocument
@@ -746,9 +775,7 @@ class Docket(models.Model):
                         "%s" % self.pk
                     )
 
-                text_template = loader.get_template('indexes/dockets_text.txt')
-                rd_out['text'] = text_template.render({'item': rd}).translate(
-                    null_map)
+                rd_out['text'] = get_recap_document_text(rd)
 
                 # Ensure that loops to bleed into each other
                 out_copy = out.copy()
@@ -1090,9 +1117,14 @@ class RECAPDocument(AbstractPacerDocument, AbstractPDF):
             from cl.scrapers.tasks import extract_recap_pdf
             tasks.append(extract_recap_pdf.si(self.pk))
         if index:
-            from cl.search.tasks import add_items_to_solr
-            tasks.append(add_items_to_solr.si([self.pk],
-                                              'search.RECAPDocument'))
+            if tasks:
+                # Index after the extraction is done.
+                from cl.search.tasks import add_items_to_solr
+                tasks.append(add_items_to_solr.si([self.pk],
+                                                  'search.RECAPDocument'))
+            else:
+                from cl.search.outbox import index_items
+                index_items([self.pk], 'search.RECAPDocument')
         if len(tasks) > 0:
             chain(*tasks)()
 
@@ -1106,79 +1138,15 @@ class RECAPDocument(AbstractPacerDocument, AbstractPDF):
         from cl.search.tasks import delete_items
         delete_items.delay([id_cache], 'search.RECAPDocument')
 
-    def get_docket_metadata(self):
-        """The metadata for the item that comes from the Docket."""
-        docket = self.docket_entry.docket
-        # IDs
-        out = {
-            'docket_id': docket.pk,
-            'court_id': docket.court.pk,
-            'assigned_to_id': getattr(docket.assigned_to, 'pk', None),
-            'referred_to_id': getattr(docket.referred_to, 'pk', None)
-        }
-
-        # Docket
-        out.update({
-            'docketNumber': docket.docket_number,
-            'caseName': best_case_name(docket),
-            'suitNature': docket.nature_of_suit,
-            'cause': docket.cause,
-            'juryDemand': docket.jury_demand,
-            'jurisdictionType': docket.jurisdiction_type,
-        })
-        if docket.date_argued is not None:
-            out['dateArgued'] = midnight_pst(docket.date_argued)
-        if docket.date_filed is not None:
-            out['dateFiled'] = midnight_pst(docket.date_filed)
-        if docket.date_terminated is not None:
-            out['dateTerminated'] = midnight_pst(docket.date_terminated)
-        try:
-            out['docket_absolute_url'] = docket.get_absolute_url()
-        except NoReverseMatch:
-            raise InvalidDocumentError(
-                "Unable to save to index due to missing absolute_url: %s"
-                % self.pk
-            )
-
-        # Judges
-        if docket.assigned_to is not None:
-            out['assignedTo'] = docket.assigned_to.name_full
-        elif docket.assigned_to_str:
-            out['assignedTo'] = docket.assigned_to_str
-        if docket.referred_to is not None:
-            out['referredTo'] = docket.referred_to.name_full
-        elif docket.referred_to_str:
-            out['referredTo'] = docket.referred_to_str
-
-        # Court
-        out.update({
-            'court': docket.court.full_name,
-            'court_exact': docket.court_id,  # For faceting
-            'court_citation_string': docket.court.citation_string
-        })
+    def get_docket_metadata(self, party_fields=None):
+        """The metadata for the item that comes from the Docket.
 
-        # Parties, Attorneys, Firms
-        out.update({
-            'party_id': set(),
-            'party': set(),
-            'attorney_id': set(),
-            'attorney': set(),
-            'firm_id': set(),
-            'firm': set(),
-        })
-        for p in docket.prefetched_parties:
-            out['party_id'].add(p.pk)
-            out['party'].add(p.name)
-            for a in p.attys_in_docket:
-                out['attorney_id'].add(a.pk)
-                out['attorney'].add(a.name)
-                for f in a.firms_in_docket:
-                    out['firm_id'].add(f.pk)
-                    out['firm'].add(f.name)
-
-        return out
+        :param party_fields: The party fields for the docket, as returned by
+        Docket.get_party_search_fields. If None, they are queried.
+        """
+        return self.docket_entry.docket.get_search_metadata(party_fields)
 
-    def as_search_dict(self, docket_metadata=None):
+    def as_search_dict(self, docket_metadata=None, party_fields=None):
         """Create a dict that can be ingested by Solr.
 
         Search results are presented as Dockets, but they're indexed as
@@ -1189,9 +1157,10 @@ class RECAPDocument(AbstractPacerDocument, AbstractPDF):
         get_docket_metadata that lets you query that information first and then
         pass it in as an argument so that it doesn't have to be queried for
         every RECAPDocument on the docket. This can provide big performance
-        boosts.
+        boosts. Similarly, party_fields can be provided so that they don't have
+        to be queried.
         """
-        out = docket_metadata or self.get_docket_metadata()
+        out = docket_metadata or self.get_docket_metadata(party_fields)
 
         # IDs
         out.update({
@@ -1227,8 +1196,7 @@ class RECAPDocument(AbstractPacerDocument, AbstractPDF):
             out['entry_date_filed'] = midnight_pst(
                 self.docket_entry.date_filed)
 
-        text_template = loader.get_template('indexes/dockets_text.txt')
-        out['text'] = text_template.render({'item': self}).translate(null_map)
+        out['text'] = get_recap_document_text(self)
 
         return normalize_search_dicts(out)
 
@@ -1978,9 +1946,8 @@ class OpinionCluster(models.Model):
         self.slug = slugify(trunc(best_case_name(self), 75))
         super(OpinionCluster, self).save(*args, **kwargs)
         if index:
-            from cl.search.tasks import add_items_to_solr
-            add_items_to_solr.delay([self.pk], 'search.OpinionCluster',
-                                    force_commit)
+            from cl.search.outbox import index_items
+            index_items([self.pk], 'search.OpinionCluster', force_commit)
 
     def delete(self, *args, **kwargs):
         """
@@ -2039,16 +2006,13 @@ class OpinionCluster(models.Model):
             'sibling_ids': [sibling.pk for sibling in
                             self.sub_opinions.all()],
         })
-        try:
-            out['lexisCite'] = str(self.citations.filter(
-                type=Citation.LEXIS)[0])
-        except IndexError:
-            pass
-        try:
-            out['neutralCite'] = str(self.citations.filter(
-                type=Citation.NEUTRAL)[0])
-        except IndexError:
-            pass
+        # Filter in Python, so prefetched citations can be used.
+        citations = self.citations.all()
+        for cite_type, field in ((Citation.LEXIS, 'lexisCite'),
+                                 (Citation.NEUTRAL, 'neutralCite')):
+            cites = [str(c) for c in citations if c.type == cite_type]
+            if cites:
+                out[field] = cites[0]
 
         if self.date_filed is not None:
             out['dateFiled'] = midnight_pst(self.date_filed)
@@ -2063,7 +2027,6 @@ class OpinionCluster(models.Model):
 
         # Opinion
         search_list = []
-        text_template = loader.get_template('indexes/opinion_text.txt')
         for opinion in self.sub_opinions.all():
             # Always make a copy to get a fresh version above metadata. Failure
             # to do this pushes metadata from previous iterations to objects
@@ -2072,15 +2035,12 @@ class OpinionCluster(models.Model):
             out_copy.update({
                 'id': opinion.pk,
                 'cites': [o.pk for o in opinion.opinions_cited.all()],
-                'author_id': getattr(opinion.author, 'pk', None),
+                'author_id': opinion.author_id,
                 'joined_by_ids': [j.pk for j in opinion.joined_by.all()],
                 'type': opinion.type,
                 'download_url': opinion.download_url or None,
                 'local_path': unicode(opinion.local_path),
-                'text': text_template.render({
-                    'item': opinion,
-                    'citation_string': self.citation_string,
-                }).translate(null_map)
+                'text': get_opinion_text(opinion, self.citation_string),
             })
 
             search_list.append(normalize_search_dicts(out_copy))
@@ -2349,8 +2309,8 @@ class Opinion(models.Model):
     def save(self, index=True, force_commit=False, *args, **kwargs):
         super(Opinion, self).save(*args, **kwargs)
         if index:
-            from cl.search.tasks import add_items_to_solr
-            add_items_to_solr.delay([self.pk], 'search.Opinion', force_commit)
+            from cl.search.outbox import index_items
+            index_items([self.pk], 'search.Opinion', force_commit)
 
     def as_search_dict(self):
         """Create a dict that can be ingested by Solr."""
@@ -2365,7 +2325,7 @@ class Opinion(models.Model):
         # Opinion
         out.update({
             'cites': [opinion.pk for opinion in self.opinions_cited.all()],
-            'author_id': getattr(self.author, 'pk', None),
+            'author_id': self.author_id,
             # 'per_curiam': self.per_curiam,
             'joined_by_ids': [judge.pk for judge in self.joined_by.all()],
             'type': self.type,
@@ -2393,17 +2353,13 @@ class Opinion(models.Model):
             'status': self.cluster.get_precedential_status_display(),
             'status_exact': self.cluster.get_precedential_status_display(),
         })
-        try:
-            out['lexisCite'] = str(self.cluster.citations.filter(
-                type=Citation.LEXIS)[0])
-        except IndexError:
-            pass
-
-        try:
-            out['neutralCite'] = str(self.cluster.citations.filter(
-                type=Citation.NEUTRAL)[0])
-        except IndexError:
-            pass
+        # Filter in Python, so prefetched citations can be used.
+        citations = self.cluster.citations.all()
+        for cite_type, field in ((Citation.LEXIS, 'lexisCite'),
+                                 (Citation.NEUTRAL, 'neutralCite')):
+            cites = [str(c) for c in citations if c.type == cite_type]
+            if cites:
+                out[field] = cites[0]
 
         if self.cluster.date_filed is not None:
             out['dateFiled'] = midnight_pst(self.cluster.date_filed)
@@ -2436,12 +2392,7 @@ class Opinion(models.Model):
         }
         out.update(court)
 
-        # Load the document text using a template for cleanup and concatenation
-        text_template = loader.get_template('indexes/opinion_text.txt')
-        out['text'] = text_template.render({
-            'item': self,
-            'citation_string': self.cluster.citation_string
-        }).translate(null_map)
+        out['text'] = get_opinion_text(self, self.cluster.citation_string)
 
         return normalize_search_dicts(out)
 
@@ -2538,6 +2489,48 @@ class Tag(models.Model):
         else:
             raise NotImplementedError("Object type not supported for tagging.")
 
+    def tag_objects(self, things):
+        """Add a tag to many items at once.
+
+        This does one query per type of item to find the ones that already
+        have the tag, and one insert per type to tag the rest. If another
+        process tags some of the items in between, the insert fails, and the
+        items are tagged one at a time with tag_object instead.
+
+        :param things: A list of Dockets, DocketEntries, RECAPDocuments, or
+        Claims that you wish to tag. Types can be mixed.
+        :return: None
+        """
+        through_tables = {
+            Docket: (self.dockets.through, 'docket_id'),
+            DocketEntry: (self.docket_entries.through, 'docketentry_id'),
+            RECAPDocument: (self.recap_documents.through, 'recapdocument_id'),
+            Claim: (self.claims.through, 'claim_id'),
+        }
+        things_by_type = {}
+        for thing in things:
+            if type(thing) not in through_tables:
+                raise NotImplementedError("Object type not supported for "
+                                          "tagging.")
+            things_by_type.setdefault(type(thing), {})[thing.pk] = thing
+
+        for thing_type, things_by_pk in things_by_type.items():
+            through, field_name = through_tables[thing_type]
+            tagged = set(through.objects.filter(**{
+                'tag_id': self.pk,
+                '%s__in' % field_name: things_by_pk.keys(),
+            }).values_list(field_name, flat=True))
+            untagged = [pk for pk in things_by_pk if pk not in tagged]
+            try:
+                with transaction.atomic():
+                    through.objects.bulk_create([
+                        through(tag_id=self.pk, **{field_name: pk}) for pk in
+                        untagged
+                    ])
+            except IntegrityError:
+                for pk in untagged:
+                    self.tag_object(things_by_pk[pk])
+
 
 # class AppellateReview(models.Model):
 #     REVIEW_STANDARDS = (
@@ -0,0 +1,154 @@
+"""An outbox for changes to the search index.
+
+Saving an item used to enqueue a Celery task to index it right away, so an
+item that was saved many times in a minute was indexed many times in a
+minute. Instead, items are now added to the outbox, which is a Redis sorted
+set per type of item, keyed by item ID. An item that's already in the outbox
+isn't added again. cl_flush_index_outbox drains the outbox periodically,
+indexing each batch of items with a single task.
+
+Counts of what was added, coalesced and flushed are kept in the STATS
+database, so the coalescing ratio can be monitored.
+"""
+import time
+
+from django.conf import settings
+
+from cl.lib.redis_utils import make_redis_interface
+
+# The types of items that go through the outbox.
+OUTBOX_APP_LABELS = ('audio.Audio', 'search.Opinion', 'search.OpinionCluster',
+                     'search.RECAPDocument')
+
+OUTBOX_KEY = 'index_outbox:%s'
+
+# Why items are added to the outbox. Saves are the default; the rest come in
+# bursts.
+OUTBOX_REASONS = ('save', 'citation', 'recap_upload')
+
+
+def get_outbox_key(app_label):
+    return OUTBOX_KEY % app_label
+
+
+def add_to_outbox(item_pks, app_label, reason='save'):
+    """Add items to the outbox, so that they're indexed at the next flush.
+
+    :param item_pks: The IDs of the items.
+    :param app_label: The type of the items, such as 'search.Opinion'.
+    :param reason: Why the items need to be indexed, one of OUTBOX_REASONS,
+    for the stats.
+    :return: The number of items that weren't already in the outbox.
+    """
+    item_pks = list(item_pks)
+    if not item_pks:
+        return 0
+    r = make_redis_interface('INDEX_OUTBOX')
+    # Keep the time an item was first added, so the oldest go first.
+    added = r.zadd(get_outbox_key(app_label),
+                   {pk: time.time() for pk in item_pks}, nx=True)
+
+    r = make_redis_interface('STATS')
+    pipe = r.pipeline()
+    pipe.incr('index_outbox.added', len(item_pks))
+    pipe.incr('index_outbox.added.%s' % reason, len(item_pks))
+    pipe.incr('index_outbox.coalesced', len(item_pks) - added)
+    pipe.execute()
+    return added
+
+
+def index_items(item_pks, app_label, force_commit=False, reason='save'):
+    """Index items, through the outbox if it's enabled.
+
+    Items that need a commit are always indexed right away.
+
+    :param item_pks: The IDs of the items.
+    :param app_label: The type of the items, such as 'search.Opinion'.
+    :param force_commit: Whether to send a commit to Solr after indexing.
+    :param reason: Why the items need to be indexed, for the stats.
+    """
+    if settings.INDEX_OUTBOX_ENABLED and not force_commit:
+        add_to_outbox(item_pks, app_label, reason=reason)
+    else:
+        from cl.search.tasks import add_items_to_solr
+        add_items_to_solr.delay(item_pks, app_label, force_commit)
+
+
+def pop_from_outbox(app_label, count):
+    """Take the oldest items out of the outbox.
+
+    :param app_label: The type of the items, such as 'search.Opinion'.
+    :param count: The largest number of items to take.
+    :return: A list of item IDs.
+    """
+    key = get_outbox_key(app_label)
+    r = make_redis_interface('INDEX_OUTBOX')
+    # A transaction, so items that are added in between aren't lost.
+    pipe = r.pipeline()
+    pipe.zrange(key, 0, count - 1)
+    pipe.zremrangebyrank(key, 0, count - 1)
+    item_pks = pipe.execute()[0]
+    return [int(pk) for pk in item_pks]
+
+
+def flush_outbox(batch_size=1000, queue='celery'):
+    """Send everything in the outbox to be indexed.
+
+    Each batch of items is indexed by a single add_items_to_solr task. Items
+    that are added while the outbox is being flushed are left for the next
+    flush.
+
+    :param batch_size: The number of items to index per task.
+    :param queue: The Celery queue for the tasks.
+    :return: A dict of the number of items flushed, by app label.
+    """
+    from cl.search.tasks import add_items_to_solr
+    r = make_redis_interface('INDEX_OUTBOX')
+    flushed = {}
+    for app_label in OUTBOX_APP_LABELS:
+        remaining = r.zcard(get_outbox_key(app_label))
+        flushed[app_label] = 0
+        while remaining > 0:
+            item_pks = pop_from_outbox(app_label, min(batch_size, remaining))
+            if not item_pks:
+                break
+            add_items_to_solr.apply_async(args=(item_pks, app_label),
+                                          queue=queue)
+            remaining -= len(item_pks)
+            flushed[app_label] += len(item_pks)
+
+    make_redis_interface('STATS').incr('index_outbox.flushed',
+                                       sum(flushed.values()))
+    return flushed
+
+
+def get_outbox_stats():
+    """Get the depth of the outbox and how much it's coalescing.
+
+    :return: A dict with the number of items waiting in the outbox, by app
+    label, the running counts of items added, coalesced and flushed, and the
+    number of items added for each reason. The coalescing ratio is the number
+    of times items were added for every item that was indexed.
+    """
+    r = make_redis_interface('INDEX_OUTBOX')
+    pipe = r.pipeline()
+    for app_label in OUTBOX_APP_LABELS:
+        pipe.zcard(get_outbox_key(app_label))
+    depths = dict(zip(OUTBOX_APP_LABELS, pipe.execute()))
+
+    r = make_redis_interface('STATS')
+    added, coalesced, flushed = [int(count or 0) for count in r.mget(
+        'index_outbox.added', 'index_outbox.coalesced',
+        'index_outbox.flushed')]
+    added_by_reason = dict(zip(OUTBOX_REASONS, [
+        int(count or 0) for count in
+        r.mget(['index_outbox.added.%s' % reason for reason in OUTBOX_REASONS])
+    ]))
+    return {
+        'depth': depths,
+        'added': added,
+        'added_by_reason': added_by_reason,
+        'coalesced': coalesced,
+        'flushed': flushed,
+        'coalescing_ratio': added / float(added - coalesced or 1),
+    }
@@ -0,0 +1,120 @@
+"""A short-lived cache of search results, for the front end and the API.
+
+Results are cached by a canonical form of the cleaned search form, so the
+same search made with its parameters in a different order, or with default
+values spelled out, hits the same entry. Each Solr core has an index
+generation, a counter in Redis that the indexing code bumps whenever it
+changes the core. The generation is part of the cache key, so bumping it
+orphans everything that was cached for that core. Whatever the indexing code
+misses, such as changes that take a while to become visible in Solr, is
+covered by the short TTL.
+
+Counts of hits and misses are kept in the STATS database.
+"""
+import datetime
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+from cl.lib.redis_utils import make_redis_interface
+
+GENERATION_KEY = 'search_cache.generation:%s'
+
+
+def get_search_type_url(search_type):
+    """Get the URL of the Solr core that a type of search uses."""
+    return {
+        'o': settings.SOLR_OPINION_URL,
+        'r': settings.SOLR_RECAP_URL,
+        'oa': settings.SOLR_AUDIO_URL,
+        'p': settings.SOLR_PEOPLE_URL,
+    }[search_type]
+
+
+def get_index_generation(url):
+    """Get the index generation of a Solr core."""
+    r = make_redis_interface('CACHE')
+    return int(r.get(GENERATION_KEY % url.rstrip('/')) or 0)
+
+
+def bump_index_generation(url):
+    """Mark the cached search results of a Solr core as out of date.
+
+    Call this whenever the core is changed.
+
+    :param url: The URL of the core.
+    """
+    r = make_redis_interface('CACHE')
+    r.incr(GENERATION_KEY % url.rstrip('/'))
+
+
+def canonicalize_cleaned_data(cd, fields):
+    """Make a canonical version of the cleaned data of a search form.
+
+    Values that are empty or that are the initial value of their field are
+    dropped, since the form gives the same search either way, and what's left
+    is sorted.
+
+    :param cd: The cleaned data of a SearchForm.
+    :param fields: The fields of that SearchForm.
+    :return: A list of (name, value) tuples, where every value can be
+    serialized to JSON.
+    """
+    canonical = []
+    for name, value in sorted(cd.items()):
+        if value in ('', None):
+            continue
+        field = fields.get(name)
+        if field is not None and field.initial is not None and \
+                value == field.initial:
+            continue
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        canonical.append((name, value))
+    return canonical
+
+
+def make_search_cache_key(cd, fields, surface, **kwargs):
+    """Make the cache key for the results of a search.
+
+    :param cd: The cleaned data of a SearchForm.
+    :param fields: The fields of that SearchForm.
+    :param surface: Where the results are shown, such as 'web' or 'api'.
+    Different surfaces cache different things, so they get different keys.
+    :param kwargs: Anything else that changes the results, such as the page
+    number.
+    :return: A cache key.
+    """
+    generation = get_index_generation(get_search_type_url(cd['type']))
+    data = json.dumps([canonicalize_cleaned_data(cd, fields),
+                       sorted(kwargs.items())])
+    return 'search_cache:%s:%s:%s:%s' % (
+        surface, cd['type'], generation, hashlib.sha1(data).hexdigest())
+
+
+def get_cached_search(cache_key, surface):
+    """Get the cached results of a search, if there are any.
+
+    :param cache_key: A key from make_search_cache_key.
+    :param surface: Where the results are shown, for the stats.
+    :return: The results, or None if they weren't cached.
+    """
+    results = cache.get(cache_key)
+    outcome = 'miss' if results is None else 'hit'
+    r = make_redis_interface('STATS')
+    pipe = r.pipeline()
+    pipe.incr('search_cache.%s' % outcome)
+    pipe.incr('search_cache.%s.%s' % (outcome, surface))
+    pipe.execute()
+    return results
+
+
+def cache_search(cache_key, results):
+    """Cache the results of a search for settings.SEARCH_CACHE_TTL seconds.
+
+    :param cache_key: A key from make_search_cache_key.
+    :param results: The results. They must be picklable.
+    """
+    cache.set(cache_key, results, settings.SEARCH_CACHE_TTL)
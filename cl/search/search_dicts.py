@@ -0,0 +1,232 @@
+from __future__ import print_function
+
+from collections import defaultdict
+
+from django.db.models import Prefetch
+
+from cl.audio.models import Audio
+from cl.lib.search_index_utils import InvalidDocumentError
+from cl.people_db.models import AttorneyOrganizationAssociation, Education, \
+    PartyType, Person, Position, Role
+from cl.search.models import Docket, Opinion, OpinionCluster, RECAPDocument
+
+# Only the IDs of these related items go into the search index.
+PK_ONLY_PREFETCHES = {
+    Opinion: ['opinions_cited', 'joined_by', 'cluster__sub_opinions',
+              'cluster__non_participating_judges'],
+    OpinionCluster: ['non_participating_judges', 'sub_opinions__joined_by',
+                     'sub_opinions__opinions_cited'],
+}
+
+
+def pk_only(lookup, model):
+    """Make a Prefetch that only loads the IDs of the related items."""
+    related_model = model
+    for part in lookup.split('__'):
+        related_model = related_model._meta.get_field(part).related_model
+    fields = ['pk']
+    if lookup.endswith('sub_opinions'):
+        # The reverse foreign key is needed to attach the items to their
+        # cluster.
+        fields.append('cluster')
+    return Prefetch(lookup,
+                    queryset=related_model.objects.only(*fields))
+
+
+def get_party_search_fields(docket_ids):
+    """Get the party, attorney and firm fields for many dockets at once.
+
+    This gives the same results as Docket.get_party_search_fields, in a fixed
+    number of queries. Like Docket.prefetched_parties, an attorney is listed
+    for a docket if they have a role in it and represent one of its parties,
+    and a firm is listed if it is associated with the docket and with one of
+    those attorneys.
+
+    :param docket_ids: An iterable of docket IDs.
+    :return: A dict mapping each docket ID to a dict of sets, keyed by field
+    name.
+    """
+    docket_ids = set(docket_ids)
+    parties = defaultdict(dict)
+    for docket_id, party_id, name in PartyType.objects.filter(
+            docket_id__in=docket_ids).values_list(
+            'docket_id', 'party_id', 'party__name'):
+        parties[docket_id][party_id] = name
+
+    attorneys = defaultdict(dict)
+    for docket_id, attorney_id, name in Role.objects.filter(
+            docket_id__in=docket_ids).values_list(
+            'docket_id', 'attorney_id', 'attorney__name').distinct():
+        attorneys[docket_id][attorney_id] = name
+    attorney_ids = {a for d in attorneys.values() for a in d}
+    party_ids = {p for d in parties.values() for p in d}
+    represented = set()
+    if attorney_ids and party_ids:
+        represented.update(Role.objects.filter(
+            attorney_id__in=attorney_ids,
+            party_id__in=party_ids,
+        ).values_list('attorney_id', 'party_id').distinct())
+
+    firms = defaultdict(dict)
+    for docket_id, firm_id, name in \
+            AttorneyOrganizationAssociation.objects.filter(
+                docket_id__in=docket_ids).values_list(
+                'docket_id', 'attorney_organization_id',
+                'attorney_organization__name').distinct():
+        firms[docket_id][firm_id] = name
+    firm_ids = {f for d in firms.values() for f in d}
+    employed = set()
+    if attorney_ids and firm_ids:
+        employed.update(AttorneyOrganizationAssociation.objects.filter(
+            attorney_id__in=attorney_ids,
+            attorney_organization_id__in=firm_ids,
+        ).values_list('attorney_id', 'attorney_organization_id').distinct())
+
+    out = {}
+    for docket_id in docket_ids:
+        fields = {
+            'party_id': set(parties[docket_id].keys()),
+            'party': set(parties[docket_id].values()),
+            'attorney_id': set(),
+            'attorney': set(),
+            'firm_id': set(),
+            'firm': set(),
+        }
+        for attorney_id, name in attorneys[docket_id].items():
+            if any((attorney_id, party_id) in represented for party_id in
+                   fields['party_id']):
+                fields['attorney_id'].add(attorney_id)
+                fields['attorney'].add(name)
+        for firm_id, name in firms[docket_id].items():
+            if any((attorney_id, firm_id) in employed for attorney_id in
+                   fields['attorney_id']):
+                fields['firm_id'].add(firm_id)
+                fields['firm'].add(name)
+        out[docket_id] = fields
+    return out
+
+
+def get_opinions(item_pks):
+    return Opinion.objects.filter(pk__in=item_pks).order_by().select_related(
+        'cluster__docket__court',
+    ).prefetch_related(
+        'cluster__panel',
+        'cluster__citations',
+        *[pk_only(lookup, Opinion) for lookup in PK_ONLY_PREFETCHES[Opinion]]
+    )
+
+
+def get_clusters(item_pks):
+    return OpinionCluster.objects.filter(
+        pk__in=item_pks,
+    ).order_by().select_related(
+        'docket__court',
+    ).prefetch_related(
+        'panel',
+        'citations',
+        'sub_opinions',
+        *[pk_only(lookup, OpinionCluster) for lookup in
+          PK_ONLY_PREFETCHES[OpinionCluster]]
+    )
+
+
+def get_recap_documents(item_pks):
+    return RECAPDocument.objects.filter(
+        pk__in=item_pks,
+    ).order_by().select_related(
+        'docket_entry__docket__court',
+        'docket_entry__docket__assigned_to',
+        'docket_entry__docket__referred_to',
+    )
+
+
+def get_dockets(item_pks):
+    return Docket.objects.filter(pk__in=item_pks).order_by().select_related(
+        'court',
+        'assigned_to',
+        'referred_to',
+    ).prefetch_related(
+        'docket_entries__recap_documents',
+    )
+
+
+def get_audio_files(item_pks):
+    return Audio.objects.filter(pk__in=item_pks).order_by().select_related(
+        'docket__court',
+    ).prefetch_related(
+        'panel',
+    )
+
+
+def get_people(item_pks):
+    return Person.objects.filter(pk__in=item_pks).order_by().prefetch_related(
+        'aliases',
+        'race',
+        'political_affiliations',
+        'aba_ratings',
+        Prefetch('educations',
+                 queryset=Education.objects.select_related('school')),
+        Prefetch('positions',
+                 queryset=Position.objects.select_related(
+                     'court', 'appointer__person', 'supervisor',
+                     'predecessor')),
+    )
+
+
+# How to load a chunk of each kind of item, with everything that's needed to
+# make its search dicts.
+ITEM_LOADERS = {
+    Opinion: get_opinions,
+    OpinionCluster: get_clusters,
+    RECAPDocument: get_recap_documents,
+    Docket: get_dockets,
+    Audio: get_audio_files,
+    Person: get_people,
+}
+
+
+def make_search_dicts(model, item_pks):
+    """Make the search dicts for a chunk of items.
+
+    The items and the related items that go into their search dicts are loaded
+    with a fixed number of queries, no matter how many items there are.
+
+    :param model: The model of the items.
+    :param item_pks: The IDs of the items.
+    :return: A list of search dicts, ready for Solr.
+    """
+    try:
+        items = ITEM_LOADERS[model](item_pks)
+    except KeyError:
+        items = model.objects.filter(pk__in=item_pks).order_by()
+
+    party_fields = {}
+    if model == Docket:
+        items = list(items)
+        party_fields = get_party_search_fields(d.pk for d in items)
+    elif model == RECAPDocument:
+        items = list(items)
+        party_fields = get_party_search_fields(
+            rd.docket_entry.docket_id for rd in items)
+
+    search_dicts = []
+    for item in items:
+        try:
+            if model == Docket:
+                search_dicts.extend(item.as_search_list(
+                    party_fields=party_fields[item.pk]))
+            elif model == RECAPDocument:
+                search_dicts.append(item.as_search_dict(
+                    party_fields=party_fields[item.docket_entry.docket_id]))
+            elif model == OpinionCluster:
+                # Clusters make a list of items; extend, don't append
+                search_dicts.extend(item.as_search_list())
+            else:
+                search_dicts.append(item.as_search_dict())
+        except AttributeError as e:
+            print("AttributeError trying to add: %s\n  %s" % (item, e))
+        except ValueError as e:
+            print("ValueError trying to add: %s\n  %s" % (item, e))
+        except InvalidDocumentError:
+            print("Unable to parse: %s" % item)
+    return search_dicts
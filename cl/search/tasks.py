@@ -1,17 +1,23 @@
 from __future__ import print_function
 
+import json
 import socket
-from datetime import timedelta
+from datetime import datetime, timedelta
 
-import scorched
 from django.apps import apps
 from django.conf import settings
 from django.utils.timezone import now
+from requests.exceptions import Timeout
+from scorched.dates import solr_date
 
+from cl.alerts.percolator import PERCOLATOR_ITEM_TYPES
+from cl.alerts.tasks import percolate_items
 from cl.celery import app
-from cl.lib.search_index_utils import InvalidDocumentError
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.sunburnt import SolrError
-from cl.search.models import OpinionCluster, RECAPDocument, Docket
+from cl.search.models import RECAPDocument, Docket
+from cl.search.search_cache import bump_index_generation
+from cl.search.search_dicts import make_search_dicts
 
 
 @app.task
@@ -23,24 +29,10 @@ def add_items_to_solr(item_pks, app_label, force_commit=False):
     :param force_commit: Whether to send a commit to Solr after your addition.
     This is generally not advised and is mostly used for testing.
     """
-    search_dicts = []
     model = apps.get_model(app_label)
-    items = model.objects.filter(pk__in=item_pks).order_by()
-    for item in items:
-        try:
-            if model in [OpinionCluster, Docket]:
-                # Dockets make a list of items; extend, don't append
-                search_dicts.extend(item.as_search_list())
-            else:
-                search_dicts.append(item.as_search_dict())
-        except AttributeError as e:
-            print("AttributeError trying to add: %s\n  %s" % (item, e))
-        except ValueError as e:
-            print("ValueError trying to add: %s\n  %s" % (item, e))
-        except InvalidDocumentError:
-            print("Unable to parse: %s" % item)
-
-    si = scorched.SolrInterface(settings.SOLR_URLS[app_label], mode='w')
+    search_dicts = make_search_dicts(model, item_pks)
+
+    si = get_solr_interface(settings.SOLR_URLS[app_label], mode='w')
     try:
         si.add(search_dicts)
         if force_commit:
@@ -48,9 +40,150 @@ def add_items_to_solr(item_pks, app_label, force_commit=False):
     except (socket.error, SolrError) as exc:
         add_items_to_solr.retry(exc=exc, countdown=30)
     else:
+        bump_index_generation(settings.SOLR_URLS[app_label])
         # Mark dockets as updated if needed
         if model == Docket:
-            items.update(date_last_index=now())
+            Docket.objects.filter(pk__in=item_pks).update(
+                date_last_index=now())
+        if settings.ALERT_PERCOLATION_ENABLED and \
+                app_label in PERCOLATOR_ITEM_TYPES:
+            percolate_items.delay(item_pks, app_label)
+
+
+# The fields of the RECAP index that every document gets a copy of from its
+# docket (see Docket.get_search_metadata). docket_id is left out, since it
+# never changes.
+RECAP_DOCKET_FIELDS = (
+    'court_id', 'assigned_to_id', 'referred_to_id', 'docketNumber',
+    'caseName', 'suitNature', 'cause', 'juryDemand', 'jurisdictionType',
+    'dateArgued', 'dateFiled', 'dateTerminated', 'docket_absolute_url',
+    'assignedTo', 'referredTo', 'court', 'court_exact',
+    'court_citation_string', 'party_id', 'party', 'attorney_id', 'attorney',
+    'firm_id', 'firm',
+)
+
+# Ways to update a RECAP docket in Solr. 'full' rebuilds and resends every
+# document on the docket. 'partial' only sends the docket fields that changed,
+# as atomic updates. 'auto' does a partial update if the documents in Solr are
+# the ones in the database, and a full one if not.
+RECAP_UPDATE_MODES = ('auto', 'full', 'partial')
+
+
+def normalize_solr_value(value):
+    """Normalize a value from Solr or from a search dict, so the two can be
+    compared.
+    """
+    if isinstance(value, (list, tuple, set)):
+        return sorted(normalize_solr_value(v) for v in value) or None
+    if isinstance(value, datetime):
+        return unicode(solr_date(value))
+    if value is None or value == '':
+        # Solr doesn't keep empty values.
+        return None
+    return unicode(value)
+
+
+def get_indexed_docket(si, docket_pk):
+    """Get what the RECAP index has for a docket.
+
+    :param si: A scorched.SolrInterface for the RECAP index.
+    :param docket_pk: The ID of the docket.
+    :return: A tuple of the docket fields of one of its documents, or None if
+    it has no documents in the index, and the set of the IDs of all of its
+    documents in the index.
+    """
+    q = si.query(docket_id=docket_pk)
+    r = q.field_limit(('id',) + RECAP_DOCKET_FIELDS).paginate(rows=1).execute()
+    count = r.result.numFound
+    if count == 0:
+        return None, set()
+    fields = r.result.docs[0]
+    r = q.field_limit(['id']).paginate(rows=count).execute()
+    return fields, {doc['id'] for doc in r.result.docs}
+
+
+def get_changed_docket_fields(indexed_fields, metadata):
+    """Compare the docket fields in the index with the current ones.
+
+    :param indexed_fields: The docket fields of a document in the index.
+    :param metadata: The current docket fields, from
+    Docket.get_search_metadata.
+    :return: A dict of the fields that changed and their new values. Fields
+    that should be removed have a value of None.
+    """
+    changes = {}
+    for field in RECAP_DOCKET_FIELDS:
+        value = metadata.get(field)
+        if normalize_solr_value(value) != \
+                normalize_solr_value(indexed_fields.get(field)):
+            if isinstance(value, set):
+                value = list(value)
+            changes[field] = value or None
+    return changes
+
+
+def send_atomic_updates(si, item_pks, changes, chunk_size=1000):
+    """Set fields of documents in Solr, without resending the documents.
+
+    This uses Solr's atomic updates, which require every field in the schema
+    to be stored, except copyField destinations.
+
+    :param si: A scorched.SolrInterface.
+    :param item_pks: The IDs of the documents to update.
+    :param changes: A dict of the fields to set and their values. A value of
+    None removes the field.
+    """
+    update = {}
+    for field, value in changes.items():
+        if isinstance(value, datetime):
+            # Scorched converts dates when adding documents, but not inside
+            # atomic updates.
+            value = unicode(solr_date(value))
+        update[field] = {'set': value}
+    item_pks = sorted(item_pks)
+    for i in range(0, len(item_pks), chunk_size):
+        docs = []
+        for pk in item_pks[i:i + chunk_size]:
+            doc = {'id': pk}
+            doc.update(update)
+            docs.append(doc)
+        si.conn.update(json.dumps(docs))
+
+
+def update_recap_docket(si, d, mode='auto'):
+    """Add or update the documents of a docket in the RECAP index.
+
+    A partial update only sets the docket fields that changed. The text field
+    of the documents isn't rebuilt, so it keeps the old values of the docket
+    fields until the next full update. They're still found through their own
+    fields.
+
+    A docket with documents that aren't in the index yet can't be updated
+    partially, so in 'partial' mode it's skipped, to be picked up by a later
+    update in another mode.
+
+    :param si: A scorched.SolrInterface for the RECAP index.
+    :param d: The Docket.
+    :param mode: One of RECAP_UPDATE_MODES.
+    :return: The kind of update that was done, 'full' or 'partial', or
+    'skipped' if nothing was done.
+    """
+    if mode != 'full':
+        indexed_fields, indexed_pks = get_indexed_docket(si, d.pk)
+        rd_pks = set(RECAPDocument.objects.filter(
+            docket_entry__docket=d,
+        ).values_list('pk', flat=True))
+        if mode == 'partial' and rd_pks - indexed_pks:
+            return 'skipped'
+        if mode == 'partial' or (indexed_pks and indexed_pks == rd_pks):
+            if indexed_fields is not None:
+                changes = get_changed_docket_fields(indexed_fields,
+                                                    d.get_search_metadata())
+                if changes:
+                    send_atomic_updates(si, indexed_pks, changes)
+            return 'partial'
+    si.add(d.as_search_list())
+    return 'full'
 
 
 @app.task(ignore_resutls=True)
@@ -70,6 +203,10 @@ def add_or_update_recap_docket(data, force_commit=False,
     updated it in Solr. If that date is after a threshold, we just don't do the
     update unless we know the docket has something new.
 
+    When the docket has nothing new and its documents in Solr are the ones in
+    the database, only the docket fields that changed are sent, as atomic
+    updates (see update_recap_docket).
+
     :param data: A dictionary containing the a key for 'docket_pk' and
     'content_updated'. 'docket_pk' will be used to find the docket to modify.
     'content_updated' is a boolean indicating whether the docket must be
@@ -82,7 +219,7 @@ def add_or_update_recap_docket(data, force_commit=False,
     if data is None:
         return
 
-    si = scorched.SolrInterface(settings.SOLR_RECAP_URL, mode='w')
+    si = get_solr_interface(settings.SOLR_RECAP_URL, mode='rw')
     some_time_ago = now() - timedelta(seconds=update_threshold)
     d = Docket.objects.get(pk=data['docket_pk'])
     too_fresh = d.date_last_index is not None and \
@@ -92,16 +229,51 @@ def add_or_update_recap_docket(data, force_commit=False,
         return
     else:
         try:
-            si.add(d.as_search_list())
+            update_recap_docket(
+                si, d, mode='auto' if update_not_required else 'full')
             if force_commit:
                 si.commit()
-        except SolrError as exc:
+        except (socket.error, SolrError, Timeout) as exc:
             add_or_update_recap_docket.retry(exc=exc, countdown=30)
         else:
+            bump_index_generation(settings.SOLR_RECAP_URL)
             d.date_last_index = now()
             d.save()
 
 
+@app.task
+def update_recap_dockets(docket_pks, mode='auto', force_commit=False,
+                         solr_url=None):
+    """Add or update the documents of many dockets in the RECAP index.
+
+    :param docket_pks: The IDs of the dockets.
+    :param mode: One of RECAP_UPDATE_MODES.
+    :param force_commit: Whether to send a commit to Solr after the updates.
+    :param solr_url: The URL of the core to update, if it isn't
+    settings.SOLR_RECAP_URL, such as a swap core.
+    """
+    solr_url = solr_url or settings.SOLR_RECAP_URL
+    si = get_solr_interface(solr_url, mode='rw')
+    dockets = Docket.objects.filter(pk__in=docket_pks).order_by()
+    if mode != 'partial':
+        # Full updates need everything that goes into the documents.
+        dockets = dockets.prefetch_related('docket_entries__recap_documents')
+    updated_pks = []
+    try:
+        for d in dockets:
+            if update_recap_docket(si, d, mode=mode) != 'skipped':
+                updated_pks.append(d.pk)
+        if force_commit:
+            si.commit()
+    except (socket.error, SolrError, Timeout) as exc:
+        update_recap_dockets.retry(exc=exc, countdown=30)
+    else:
+        bump_index_generation(solr_url)
+        # Skipped dockets keep their date, so they're updated next time.
+        Docket.objects.filter(pk__in=updated_pks).update(
+            date_last_index=now())
+
+
 @app.task
 def add_docket_to_solr_by_rds(item_pks, force_commit=False):
     """Add RECAPDocuments from a single Docket to Solr.
@@ -117,7 +289,7 @@ def add_docket_to_solr_by_rds(item_pks, force_commit=False):
     needed).
     :return: None
     """
-    si = scorched.SolrInterface(settings.SOLR_RECAP_URL, mode='w')
+    si = get_solr_interface(settings.SOLR_RECAP_URL, mode='w')
     rds = RECAPDocument.objects.filter(pk__in=item_pks).order_by()
     try:
         metadata = rds[0].get_docket_metadata()
@@ -130,14 +302,18 @@ def add_docket_to_solr_by_rds(item_pks, force_commit=False):
             si.commit()
     except SolrError as exc:
         add_docket_to_solr_by_rds.retry(exc=exc, countdown=30)
+    else:
+        bump_index_generation(settings.SOLR_RECAP_URL)
 
 
 @app.task
 def delete_items(items, app_label, force_commit=False):
-    si = scorched.SolrInterface(settings.SOLR_URLS[app_label], mode='w')
+    si = get_solr_interface(settings.SOLR_URLS[app_label], mode='w')
     try:
         si.delete_by_ids(list(items))
         if force_commit:
             si.commit()
     except SolrError as exc:
         delete_items.retry(exc=exc, countdown=30)
+    else:
+        bump_index_generation(settings.SOLR_URLS[app_label])
@@ -1,30 +1,53 @@
 # coding=utf-8
 import StringIO
+import json
 import os
+import shutil
+import tempfile
 
-from datetime import date
+from datetime import date, datetime
 
+import mock
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
 from django.core.management import call_command
 from django.urls import reverse
+from django.utils.timezone import utc
 from django.db import IntegrityError, transaction
-from django.http import HttpRequest
+from django.http import HttpRequest, QueryDict
 from django.test import RequestFactory
+from django.template import loader
 from django.test import TestCase, override_settings
 from lxml import etree, html
 from rest_framework.status import HTTP_200_OK
 from timeout_decorator import timeout_decorator
 
+from cl.audio.models import Audio
+from cl.lib.command_utils import read_checkpoint, write_checkpoint
+from cl.lib.redis_utils import make_redis_interface
+from cl.lib.search_index_utils import get_audio_text, get_opinion_text, \
+    get_person_text, get_recap_document_text, normalize_search_dicts, null_map
 from cl.lib.solr_core_admin import get_data_dir
 from cl.lib.test_helpers import SolrTestCase, IndexedSolrTestCase, \
-    EmptySolrTestCase
+    EmptySolrTestCase, EmptySolrTransactionTestCase
+from cl.people_db.models import Person
 from cl.search.feeds import JurisdictionFeed
-from cl.search.management.commands.cl_calculate_pagerank import Command
+from cl.search.forms import SearchForm
+from cl.search.management.commands.cl_calculate_pagerank import Command, \
+    load_edges, load_opinion_ids, load_pagerank_file, pagerank, \
+    write_pagerank_file
+from cl.search.management.commands.cl_update_index import chunk_iterable, \
+    solr_json_default, update_recap_dockets_batch
 from cl.search.models import Court, Docket, Opinion, OpinionCluster, \
     RECAPDocument, DocketEntry, Citation, sort_cites
-from cl.search.tasks import add_docket_to_solr_by_rds
+from cl.search.outbox import add_to_outbox, flush_outbox, \
+    get_outbox_stats, pop_from_outbox
+from cl.search.search_cache import GENERATION_KEY, bump_index_generation, \
+    cache_search, get_cached_search, make_search_cache_key
+from cl.search.search_dicts import make_search_dicts
+from cl.search.tasks import add_docket_to_solr_by_rds, \
+    get_changed_docket_fields, update_recap_dockets
 from cl.search.views import do_search
 from cl.tests.base import BaseSeleniumTest, SELENIUM_TIMEOUT
 
@@ -133,6 +156,101 @@ class UpdateIndexCommandTest(SolrTestCase):
         )
 
 
+class LocalIndexerTest(TestCase):
+    def test_chunking(self):
+        self.assertEqual(list(chunk_iterable(iter(range(5)), 2)),
+                         [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunk_iterable([], 2)), [])
+
+    def test_checkpoints(self):
+        path = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+        try:
+            self.assertIsNone(read_checkpoint(path))
+            write_checkpoint(path, 1234)
+            self.assertEqual(read_checkpoint(path), 1234)
+            write_checkpoint(path, 5678)
+            self.assertEqual(read_checkpoint(path), 5678)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_dates_are_serialized(self):
+        """Are dates in search dicts sent to Solr in its format?"""
+        d = {'dateFiled': datetime(2015, 8, 16, 7, tzinfo=utc), 'id': 1}
+        self.assertEqual(
+            json.loads(json.dumps(d, default=solr_json_default)),
+            {'dateFiled': '2015-08-16T07:00:00Z', 'id': 1},
+        )
+
+    @mock.patch('cl.search.management.commands.cl_update_index.'
+                'update_recap_dockets')
+    def test_dockets_use_the_update_mode(self, mock_update):
+        """Are dockets updated locally in the same mode as through Celery?"""
+        self.assertEqual(
+            update_recap_dockets_batch((('partial', 'http://solr/swap'),
+                                        [1, 2])),
+            (2, 2, None),
+        )
+        mock_update.assert_called_once_with([1, 2], 'partial',
+                                            solr_url='http://solr/swap')
+
+
+class LocalUpdateIndexCommandTest(EmptySolrTransactionTestCase):
+    """Does indexing with --local-workers work from start to finish?"""
+    fixtures = ['test_court.json', 'judge_judy.json',
+                'test_objects_search.json', 'test_objects_audio.json',
+                'authtest_data.json']
+
+    def setUp(self):
+        super(LocalUpdateIndexCommandTest, self).setUp()
+        self.checkpoint_dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.checkpoint_dir, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.checkpoint_dir)
+        super(LocalUpdateIndexCommandTest, self).tearDown()
+
+    def update_index(self, obj_type, core_name):
+        call_command(
+            'cl_update_index',
+            type=obj_type,
+            solr_url='%s/solr/%s' % (settings.SOLR_HOST, core_name),
+            update=True,
+            everything=True,
+            do_commit=True,
+            noinput=True,
+            local_workers=2,
+            chunk_size=2,
+            checkpoint=self.checkpoint,
+        )
+
+    def get_opinion_count(self):
+        return self.si_opinion.raw_query(q='*').execute().result.numFound
+
+    def test_indexing_and_resuming(self):
+        """Are all the items indexed, and does running it again resume after
+        the last one?
+        """
+        self.update_index('search.Opinion', self.core_name_opinion)
+        self.assertEqual(self.get_opinion_count(), Opinion.objects.count())
+        self.assertEqual(read_checkpoint(self.checkpoint),
+                         Opinion.objects.latest('pk').pk)
+
+        # Empty the core. Resuming from the checkpoint, nothing is indexed
+        # again.
+        self.si_opinion.delete_all()
+        self.si_opinion.commit()
+        self.update_index('search.Opinion', self.core_name_opinion)
+        self.assertEqual(self.get_opinion_count(), 0)
+
+    def test_dockets_are_marked_as_indexed(self):
+        d = Docket.objects.create(source=Docket.RECAP, court_id='test',
+                                  pacer_case_id='12345',
+                                  case_name='Lissner v. Saad')
+        self.update_index('search.Docket', self.core_name_recap)
+        d.refresh_from_db()
+        self.assertIsNotNone(d.date_last_index)
+
+
 class ModelTest(TestCase):
     fixtures = ['test_court.json']
 
@@ -287,6 +405,256 @@ class IndexingTest(EmptySolrTestCase):
         )
 
 
+class SearchDictTest(TestCase):
+    """Are search dicts made in bulk the same as ones made one at a time, and
+    do they take a fixed number of queries?"""
+    fixtures = ['test_objects_query_counts.json', 'attorney_party.json',
+                'test_objects_audio.json']
+
+    @staticmethod
+    def sort_dicts(search_dicts):
+        return sorted(search_dicts, key=lambda d: d['id'])
+
+    def assert_same_dicts(self, model, expected, query_count=None):
+        pks = model.objects.values_list('pk', flat=True)
+        if query_count is None:
+            search_dicts = make_search_dicts(model, pks)
+        else:
+            with self.assertNumQueries(query_count):
+                search_dicts = make_search_dicts(model, pks)
+        self.assertEqual(self.sort_dicts(search_dicts),
+                         self.sort_dicts(expected))
+
+    def test_opinions(self):
+        self.assert_same_dicts(
+            Opinion,
+            [o.as_search_dict() for o in Opinion.objects.all()],
+            query_count=7,
+        )
+
+    def test_clusters(self):
+        expected = []
+        for cluster in OpinionCluster.objects.all():
+            expected.extend(cluster.as_search_list())
+        self.assert_same_dicts(OpinionCluster, expected, query_count=7)
+
+    def test_recap_documents(self):
+        self.assert_same_dicts(
+            RECAPDocument,
+            [rd.as_search_dict() for rd in RECAPDocument.objects.all()],
+            query_count=5,
+        )
+
+    def test_dockets(self):
+        expected = []
+        for d in Docket.objects.all():
+            expected.extend(d.as_search_list())
+        self.assert_same_dicts(Docket, expected, query_count=7)
+
+    def test_audio(self):
+        self.assert_same_dicts(
+            Audio,
+            [a.as_search_dict() for a in Audio.objects.all()],
+            query_count=2,
+        )
+
+    def test_people(self):
+        self.assert_same_dicts(
+            Person,
+            [p.as_search_dict() for p in Person.objects.all()],
+            query_count=7,
+        )
+
+
+class IndexTextTest(TestCase):
+    """Is the text made for the search index the same as the text made by the
+    old templates?"""
+    fixtures = ['test_objects_query_counts.json', 'test_objects_audio.json',
+                'judge_judy.json']
+
+    def assert_same_text(self, template_name, context, text):
+        """Compare the text with the template's, ignoring whitespace."""
+        template = loader.get_template('indexes/%s' % template_name)
+        expected = template.render(context).translate(null_map)
+        self.assertEqual(text.split(), expected.split())
+
+    def test_opinion_text(self):
+        for opinion in Opinion.objects.all():
+            citation_string = opinion.cluster.citation_string
+            self.assert_same_text(
+                'opinion_text.txt',
+                {'item': opinion, 'citation_string': citation_string},
+                get_opinion_text(opinion, citation_string),
+            )
+
+    def test_opinion_html_text(self):
+        """Is HTML stripped the same way?"""
+        opinion = Opinion.objects.get(pk=1)
+        opinion.html_lawbox = ('<p class="x">Tom &amp; Jerry <i>v.</i> '
+                               '"Spike"</p><!-- a > b --><p>AT&T</p>')
+        self.assert_same_text(
+            'opinion_text.txt',
+            {'item': opinion, 'citation_string': ''},
+            get_opinion_text(opinion, ''),
+        )
+
+    def test_recap_document_text(self):
+        for rd in RECAPDocument.objects.all():
+            self.assert_same_text('dockets_text.txt', {'item': rd},
+                                  get_recap_document_text(rd))
+
+    def test_audio_text(self):
+        for audio in Audio.objects.all():
+            self.assert_same_text('audio_text.txt', {'item': audio},
+                                  get_audio_text(audio))
+
+    def test_person_text(self):
+        for person in Person.objects.all():
+            self.assert_same_text('person_text.txt', {'item': person},
+                                  get_person_text(person))
+
+
+class RecapPartialUpdateTest(TestCase):
+    fixtures = ['test_objects_query_counts.json', 'attorney_party.json']
+
+    def test_changed_docket_fields(self):
+        """Are only the docket fields that changed found?"""
+        d = Docket.objects.get(pk=1)
+        # What Solr would give back for the docket as it is now.
+        indexed = normalize_search_dicts(d.get_search_metadata())
+        for field, value in indexed.items():
+            if isinstance(value, datetime):
+                indexed[field] = value.astimezone(utc)
+            elif value == '':
+                del indexed[field]
+        self.assertEqual(get_changed_docket_fields(indexed,
+                                                   d.get_search_metadata()),
+                         {})
+
+        d.case_name = 'Lissner v. Saad'
+        d.date_terminated = date(2017, 1, 1)
+        d.save()
+        indexed['party'] = ['Someone else']
+        changes = get_changed_docket_fields(indexed, d.get_search_metadata())
+        self.assertEqual(sorted(changes.keys()),
+                         ['caseName', 'dateTerminated', 'party'])
+        self.assertEqual(changes['caseName'], 'Lissner v. Saad')
+
+    @mock.patch('cl.search.tasks.bump_index_generation')
+    @mock.patch('cl.search.tasks.get_solr_interface')
+    @mock.patch('cl.search.tasks.get_indexed_docket')
+    def test_partial_mode_skips_new_documents(self, mock_get_indexed, *args):
+        """Are dockets with documents that aren't in the index skipped by a
+        partial update, and left for the next update?
+        """
+        d = Docket.objects.get(pk=1)
+        metadata = normalize_search_dicts(d.get_search_metadata())
+        mock_get_indexed.return_value = (None, set())
+        update_recap_dockets([1], mode='partial')
+        d.refresh_from_db()
+        self.assertIsNone(d.date_last_index)
+
+        mock_get_indexed.return_value = (metadata, {1})
+        update_recap_dockets([1], mode='partial')
+        d.refresh_from_db()
+        self.assertIsNotNone(d.date_last_index)
+
+
+class IndexOutboxTest(TestCase):
+    @staticmethod
+    def flush_redis():
+        make_redis_interface('INDEX_OUTBOX').flushdb()
+        make_redis_interface('STATS').flushdb()
+
+    def setUp(self):
+        self.flush_redis()
+
+    def tearDown(self):
+        self.flush_redis()
+
+    def test_items_are_coalesced(self):
+        """Are items that are already in the outbox left alone?"""
+        self.assertEqual(add_to_outbox([1, 2], 'search.Opinion'), 2)
+        self.assertEqual(add_to_outbox([2, 3], 'search.Opinion',
+                                       reason='citation'), 1)
+        stats = get_outbox_stats()
+        self.assertEqual(stats['depth']['search.Opinion'], 3)
+        self.assertEqual(stats['added'], 4)
+        self.assertEqual(stats['added_by_reason'],
+                         {'save': 2, 'citation': 2, 'recap_upload': 0})
+        self.assertEqual(stats['coalesced'], 1)
+        self.assertAlmostEqual(stats['coalescing_ratio'], 4 / 3.0)
+
+        # Oldest first
+        self.assertEqual(pop_from_outbox('search.Opinion', 2), [1, 2])
+        self.assertEqual(pop_from_outbox('search.Opinion', 2), [3])
+        self.assertEqual(pop_from_outbox('search.Opinion', 2), [])
+
+    @mock.patch('cl.search.tasks.add_items_to_solr.apply_async')
+    def test_flush_in_batches(self, mock_apply_async):
+        """Is each batch of items sent to a single task?"""
+        add_to_outbox(range(1, 6), 'search.Opinion')
+        add_to_outbox([1], 'audio.Audio')
+        flushed = flush_outbox(batch_size=2)
+        self.assertEqual(flushed['search.Opinion'], 5)
+        self.assertEqual(flushed['audio.Audio'], 1)
+        self.assertEqual(
+            [c[1]['args'] for c in mock_apply_async.call_args_list],
+            [([1], 'audio.Audio'), ([1, 2], 'search.Opinion'),
+             ([3, 4], 'search.Opinion'), ([5], 'search.Opinion')],
+        )
+        self.assertEqual(sum(get_outbox_stats()['depth'].values()), 0)
+
+
+class SearchCacheTest(TestCase):
+    def setUp(self):
+        self.generation_keys = [GENERATION_KEY % url for url in
+                                (settings.SOLR_OPINION_URL,
+                                 settings.SOLR_RECAP_URL)]
+        make_redis_interface('CACHE').delete(*self.generation_keys)
+        make_redis_interface('STATS').flushdb()
+
+    def tearDown(self):
+        make_redis_interface('CACHE').delete(*self.generation_keys)
+        make_redis_interface('STATS').flushdb()
+
+    def make_key(self, query_string, **kwargs):
+        search_form = SearchForm(QueryDict(query_string))
+        self.assertTrue(search_form.is_valid())
+        return make_search_cache_key(search_form.cleaned_data,
+                                     search_form.fields, 'web', **kwargs)
+
+    def test_equivalent_searches_share_a_key(self):
+        """Do searches that only differ in order, whitespace or defaults get
+        the same key?
+        """
+        key = self.make_key('q=foo&type=o')
+        self.assertEqual(key, self.make_key('type=o&q=foo'))
+        self.assertEqual(key, self.make_key('q=+foo+'))
+        self.assertEqual(key, self.make_key('q=foo&order_by=score+desc'))
+        self.assertNotEqual(key, self.make_key('q=bar'))
+        self.assertNotEqual(key, self.make_key('q=foo&type=r'))
+        self.assertNotEqual(key, self.make_key('q=foo', page=2))
+
+    def test_bumping_the_generation(self):
+        """Does changing a core only invalidate the searches of that core?"""
+        opinion_key = self.make_key('q=foo')
+        recap_key = self.make_key('q=foo&type=r')
+        bump_index_generation(settings.SOLR_OPINION_URL)
+        self.assertNotEqual(opinion_key, self.make_key('q=foo'))
+        self.assertEqual(recap_key, self.make_key('q=foo&type=r'))
+
+    def test_hits_and_misses(self):
+        """Are hits and misses counted?"""
+        key = self.make_key('q=foo')
+        self.assertIsNone(get_cached_search(key, 'web'))
+        cache_search(key, ['some results'])
+        self.assertEqual(get_cached_search(key, 'web'), ['some results'])
+        r = make_redis_interface('STATS')
+        self.assertEqual(r.mget('search_cache.hit', 'search_cache.miss',
+                                'search_cache.hit.web'), ['1', '1', '1'])
+
+
 class SearchTest(IndexedSolrTestCase):
     @staticmethod
     def get_article_count(r):
@@ -857,6 +1225,42 @@ class PagerankTest(TestCase):
                             answers[key],)
             )
 
+    def test_pagerank_matches_igraph(self):
+        """Does the numpy pagerank give the same scores as igraph?"""
+        comm = Command()
+        igraph_results = comm.do_pagerank(method='igraph')
+        numpy_results = comm.do_pagerank(method='numpy')
+        self.assertEqual(len(igraph_results), len(numpy_results))
+        for igraph_score, numpy_score in zip(igraph_results, numpy_results):
+            self.assertAlmostEqual(igraph_score, numpy_score, places=6)
+
+    def test_pagerank_file_and_warm_start(self):
+        """Is the pagerank file sorted and complete, and can a new run start
+        from it?
+        """
+        citing, cited = load_edges()
+        node_count = max(citing.max(), cited.max()) + 1
+        scores, cold_iterations = pagerank(citing, cited, node_count)
+        opinion_ids = load_opinion_ids()
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'external_pagerank')
+            write_pagerank_file(scores, opinion_ids, path)
+            with open(path) as f:
+                ids = [int(line.split('=')[0]) for line in f]
+            self.assertEqual(ids, sorted(Opinion.objects.values_list(
+                'pk', flat=True)))
+
+            start = load_pagerank_file(path, node_count)
+            warm_scores, warm_iterations = pagerank(citing, cited, node_count,
+                                                    start=start)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertLess(warm_iterations, cold_iterations)
+        for score, warm_score in zip(scores, warm_scores):
+            self.assertAlmostEqual(score, warm_score, places=6)
+
 
 class OpinionSearchFunctionalTest(BaseSeleniumTest):
     """
@@ -24,12 +24,14 @@ from cl.custom_filters.templatetags.text_filters import naturalduration
 from cl.lib.bot_detector import is_bot
 from cl.lib.ratelimiter import ratelimit_if_not_whitelisted
 from cl.lib.redis_utils import make_redis_interface
-from cl.lib.scorched_utils import ExtraSolrInterface
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.search_utils import build_main_query, get_query_citation, \
     make_stats_variable, merge_form_with_courts, make_get_string, \
     regroup_snippets
 from cl.search.forms import SearchForm, _clean_form
 from cl.search.models import Court, Opinion
+from cl.search.search_cache import cache_search, get_cached_search, \
+    make_search_cache_key
 from cl.stats.models import Stat
 from cl.stats.utils import tally_stat
 from cl.visualizations.models import SCOTUSMap
@@ -52,16 +54,16 @@ def get_solr_result_objects(cd, facet):
     """
     search_type = cd['type']
     if search_type == 'o':
-        si = ExtraSolrInterface(settings.SOLR_OPINION_URL, mode='r')
+        si = get_solr_interface(settings.SOLR_OPINION_URL, mode='r')
         results = si.query().add_extra(**build_main_query(cd, facet=facet))
     elif search_type == 'r':
-        si = ExtraSolrInterface(settings.SOLR_RECAP_URL, mode='r')
+        si = get_solr_interface(settings.SOLR_RECAP_URL, mode='r')
         results = si.query().add_extra(**build_main_query(cd, facet=facet))
     elif search_type == 'oa':
-        si = ExtraSolrInterface(settings.SOLR_AUDIO_URL, mode='r')
+        si = get_solr_interface(settings.SOLR_AUDIO_URL, mode='r')
         results = si.query().add_extra(**build_main_query(cd, facet=facet))
     elif search_type == 'p':
-        si = ExtraSolrInterface(settings.SOLR_PEOPLE_URL, mode='r')
+        si = get_solr_interface(settings.SOLR_PEOPLE_URL, mode='r')
         results = si.query().add_extra(**build_main_query(cd, facet=facet))
     else:
         raise NotImplementedError("Unknown search type: %s" % search_type)
@@ -69,15 +71,22 @@ def get_solr_result_objects(cd, facet):
     return results
 
 
-def paginate_cached_solr_results(request, cd, results, rows, cache_key):
+def paginate_cached_solr_results(request, cd, results, rows, cache_key,
+                                 search_form=None, facet=True):
     # Run the query and set up pagination
+    page = int(request.GET.get('page', 1))
+    check_pagination_depth(page)
+
     if cache_key is not None:
         paged_results = cache.get(cache_key)
         if paged_results is not None:
             return paged_results
-
-    page = int(request.GET.get('page', 1))
-    check_pagination_depth(page)
+    elif search_form is not None and settings.SEARCH_CACHE_ENABLED:
+        search_cache_key = make_search_cache_key(
+            cd, search_form.fields, 'web', page=page, rows=rows, facet=facet)
+        paged_results = get_cached_search(search_cache_key, 'web')
+        if paged_results is not None:
+            return paged_results
 
     if cd['type'] == 'r':
         rows = 10
@@ -97,6 +106,8 @@ def paginate_cached_solr_results(request, cd, results, rows, cache_key):
     if cache_key is not None:
         six_hours = 60 * 60 * 6
         cache.set(cache_key, paged_results, six_hours)
+    elif search_form is not None and settings.SEARCH_CACHE_ENABLED:
+        cache_search(search_cache_key, paged_results)
 
     return paged_results
 
@@ -113,8 +124,9 @@ def do_search(request, rows=20, order_by=None, type=None, facet=True,
     :param facet: Whether to complete faceting in the query
     :param cache_key: A cache key with which to save the results. Note that it
     does not do anything clever with the actual query, so if you use this, your
-    cache key should *already* have factored in the query. If None, no caching
-    is set or used. Results are saved for six hours.
+    cache key should *already* have factored in the query. If None, the
+    results are cached briefly by the query itself (see
+    cl.search.search_cache). Results are saved for six hours.
     :return A big dict of variables for use in the search results, homepage, or
     other location.
     """
@@ -135,8 +147,9 @@ def do_search(request, rows=20, order_by=None, type=None, facet=True,
         # Do the query, hitting the cache if desired
         try:
             results = get_solr_result_objects(cd, facet)
-            paged_results = paginate_cached_solr_results(request, cd, results,
-                                                         rows, cache_key)
+            paged_results = paginate_cached_solr_results(
+                request, cd, results, rows, cache_key,
+                search_form=search_form, facet=facet)
         except (NotImplementedError, RequestException, SolrError) as e:
             error = True
             logger.warning("Error loading search page with "
@@ -144,6 +144,35 @@ SOLR_URLS = {
     'search.OpinionCluster': SOLR_OPINION_URL,
 }
 
+# Whether saved items are put in the index outbox (see cl.search.outbox) rather
+# than indexed right away. Like Celery tasks, they're indexed right away in
+# development.
+INDEX_OUTBOX_ENABLED = not DEVELOPMENT
+
+# How long to wait for each Solr core to answer a query, as a (connect, read)
+# tuple of seconds. Cores that aren't listed get the default. See
+# cl.lib.scorched_utils.get_solr_interface.
+SOLR_DEFAULT_TIMEOUT = (3.05, 30)
+SOLR_TIMEOUTS = {
+    SOLR_RECAP_URL: (3.05, 60),
+}
+# How long to keep the schema of a Solr core before fetching it again.
+SOLR_SCHEMA_TTL = 60 * 60
+
+# Whether search results are cached (see cl.search.search_cache), and for how
+# long, in seconds. Like the index outbox, it's off in development.
+SEARCH_CACHE_ENABLED = not DEVELOPMENT
+SEARCH_CACHE_TTL = 60 * 5
+
+# Whether real-time alerts are run against each batch of new items as it's
+# indexed (see cl.alerts.percolator), and the stand-in cores that the batches
+# are loaded into. The cores need the same schemas as the real ones.
+ALERT_PERCOLATION_ENABLED = False
+SOLR_PERCOLATOR_URLS = {
+    'o': '%s/solr/opinion_percolator' % SOLR_HOST,
+    'oa': '%s/solr/audio_percolator' % SOLR_HOST,
+}
+
 SOLR_OPINION_TEST_CORE_NAME = 'opinion_test'
 SOLR_AUDIO_TEST_CORE_NAME = 'audio_test'
 SOLR_PEOPLE_TEST_CORE_NAME = 'person_test'
@@ -178,6 +207,7 @@ REDIS_DATABASES = {
     'CACHE': 1,
     'STATS': 2,
     'ALERTS': 3,
+    'INDEX_OUTBOX': 4,
 }
 
 ##########
@@ -266,6 +296,10 @@ STATIC_ROOT = os.path.join(INSTALL_ROOT, 'cl/assets/static/')
 # Where should the bulk data be stored?
 BULK_DATA_DIR = os.path.join(INSTALL_ROOT, 'cl/assets/media/bulk-data/')
 
+# Where should the local citation index be stored?
+CITATION_INDEX_DIR = os.path.join(INSTALL_ROOT,
+                                  'cl/assets/media/citation-index/')
+
 
 #####################
 # Payments & Prices #
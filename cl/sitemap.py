@@ -5,7 +5,7 @@ from django.template import loader
 from django.utils.encoding import smart_str
 from django.views.decorators.cache import cache_page
 
-from cl.lib.scorched_utils import ExtraSolrInterface
+from cl.lib.scorched_utils import get_solr_interface
 from cl.lib.search_utils import build_court_count_query
 
 items_per_sitemap = 10000
@@ -53,7 +53,7 @@ def normalize_grouping(result):
 
 def make_solr_sitemap(request, solr_url, params, changefreq, low_priority_pages,
                       url_field):
-    solr = ExtraSolrInterface(solr_url)
+    solr = get_solr_interface(solr_url, mode='r')
     page = int(request.GET.get('p', 1))
     court = request.GET['court']
     params['start'] = (page - 1) * items_per_sitemap
@@ -101,7 +101,7 @@ def index_sitemap_maker(request):
     )
     sites = []
     for connection_string, path, group in connection_string_sitemap_path_pairs:
-        conn = ExtraSolrInterface(connection_string)
+        conn = get_solr_interface(connection_string, mode='r')
         response = conn.query().add_extra(**build_court_count_query(group)).execute()
         court_count_tuples = response.facet_counts.facet_fields['court_exact']
         for court, count in court_count_tuples: